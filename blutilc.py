@@ -27,6 +27,28 @@ VERBOSELEVEL=0
 SERIAL_TIMEOUT=2.0  #e.g 2.456 will mean 2456 milliseconds
 SERIAL_DEF_BAUD=115200
 
+#- AT response framing
+RESPONSE_OK=b'00\r'        #ends the response to a command that succeeded, on a line of its own
+RESPONSE_ERROR=b'\n01\t'   #starts the response to a command that failed, followed by the hex error code and \r
+
+#- app upload related
+UPLOAD_CHUNK_SIZES=(128, 96, 64, 32, 16)   #bytes per AT+FWR/AT+FWRH tried, largest first, until the module accepts one
+UPLOAD_PIPELINE=1           #number of file write commands sent before their responses are collected
+
+#- app upload steps, what the generator methods of BLDevice yield for run_steps() to carry out
+AT_COMMAND='command'        #(AT_COMMAND, command, expect_response), the response text is sent back
+AT_RESPONSE='response'      #(AT_RESPONSE, command), the response to a command sent ahead is sent back
+AT_SLEEP='sleep'            #(AT_SLEEP, seconds)
+
+#- batch command related
+BATCH_PIPELINE=1            #number of batch commands sent before their responses are collected
+BATCH_BARRIERS=('Z', '&F', '+RUN')  #commands that restart the module or start an app, never sent ahead of others
+
+#- error code descriptions
+ERROR_CODES_FILE='codes.csv'
+ERROR_CODES_SECTION='General'
+ERROR_CODES_CACHE=True      #Set to False to not keep a parsed copy of codes.csv beside it as codes.csv.json
+
 #- compilation related
 ALLOW_ONLINE_COMPILE=True   #Set to False to disallow online compiling for security reasons
 URL_XCOMPILE_SERVER='uwterminalx.lairdconnect.com'
@@ -35,7 +57,11 @@ ONLINE_SB_TEMPFILENAME='temp.sb'
 #-----------------------------------------------------------------------------
 # Module imports
 #-----------------------------------------------------------------------------
-import argparse, serial, time, subprocess, sys, os, re, tempfile, requests, json
+import argparse, serial, time, subprocess, sys, os, re, tempfile, requests, json, collections
+from sbcache import CompileCache
+from sbidentity import IdentityCache
+from sbpreprocess import Preprocessor, IncludeError
+import sblisten
 
 #-----------------------------------------------------------------------------
 #-----------------------------------------------------------------------------
@@ -50,6 +76,16 @@ if __name__ == "__main__":
         parser.add_argument('-t', '--timeout',
                              help="Timeout for commands like --send", default=SERIAL_TIMEOUT,type=float,
                              metavar="TIMEOUT")
+        parser.add_argument('--chunk', type=int, default=0, metavar="N",
+                             help="App upload: bytes per file write command, default=largest the module accepts")
+        parser.add_argument('--upload-pipeline', type=int, default=UPLOAD_PIPELINE, metavar="N",
+                             help=f"App upload: file write commands sent before collecting responses, default={UPLOAD_PIPELINE}")
+        parser.add_argument('--hex-only', action="store_true",
+                             help="App upload: only use AT+FWRH, never the AT+FWR string variant")
+        parser.add_argument('--no-compile-cache', action="store_true",
+                             help="Always compile, do not reuse or keep .uwc files in the compile cache")
+        parser.add_argument('--no-identity-cache', action="store_true",
+                             help="Always ask the module for its model, version and language hashes")
         cmd_arg = parser.add_mutually_exclusive_group(required=True)
         cmd_arg.add_argument('-c', '--compile', help="Compile specified smartBasic file to a .uwc file.", metavar="SBFILE")
         cmd_arg.add_argument('-l', '--load',
@@ -61,11 +97,23 @@ if __name__ == "__main__":
         cmd_arg.add_argument('-s', '--send',
                              help="Send the string CMD terminated by and listen for {SERIAL_TIMEOUT} seconds \\r",
                              metavar="CMD")
+        cmd_arg.add_argument('--batch', metavar="FILE",
+                             help="Send each AT command in FILE, or stdin if FILE is -, in one session and print the results as JSON")
         cmd_arg.add_argument('--ls', action="store_true", help="List all files uploaded to the device")
         cmd_arg.add_argument('--rm', metavar="FILE", help="Remove specified file from the device")
         cmd_arg.add_argument('--format', action="store_true", help="Erase all stored files from the device")
         cmd_arg.add_argument('--listen', action="store_true",
                              help="Listen over serial for incoming messages, e.g. from print statements in a running program")
+        parser.add_argument('--batch-pipeline', type=int, default=BATCH_PIPELINE, metavar="N",
+                             help=f"Batch: commands sent before collecting responses, default={BATCH_PIPELINE}")
+        parser.add_argument('--keep-going', action="store_true",
+                             help="Batch: carry on after a command returns an error")
+        parser.add_argument('--timestamps', action="store_true",
+                             help="Listen: prefix each line with the seconds since listening started")
+        parser.add_argument('--log', metavar="FILE", help="Listen: also append the lines to FILE, rotating it as it grows")
+        parser.add_argument('--log-max-bytes', type=int, default=sblisten.LOG_MAX_BYTES, metavar="N",
+                             help=f"Listen: size at which the --log file is rotated, default={sblisten.LOG_MAX_BYTES}")
+        parser.add_argument('--jsonl', metavar="FILE", help="Listen: also append the lines to FILE as JSON, one object per line")
         return parser
 
 #-----------------------------------------------------------------------------
@@ -81,32 +129,109 @@ class RuntimeError(Exception):
     pass
 
 
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class ResponseReader(object):
+    """
+    Buffers what the module sends and splits it into AT responses as bytes arrive,
+    reading everything the port has waiting at once rather than a byte at a time
+    """
+    def __init__(self, port):
+        self.port = port
+        self.buffer = bytearray()
+        self.scanned = 0    #bytes at the start of the buffer already searched for the end of a response
+
+    def fill(self):
+        """ Reads what is waiting, or waits up to the port timeout for a byte, and returns the count """
+        data = self.port.read(self.port.in_waiting or 1)
+        self.buffer += data
+        return len(data)
+
+    def find_response(self):
+        """ Returns (error, end) for the response at the start of the buffer, or None if it is incomplete """
+        if self.buffer.startswith(RESPONSE_ERROR):
+            end = self.buffer.find(b'\r', len(RESPONSE_ERROR))
+            return None if end < 0 else (True, end + 1)
+        while True:
+            end = self.buffer.find(b'\r', self.scanned)
+            if end < 0:
+                self.scanned = len(self.buffer)
+                return None
+            self.scanned = end + 1
+            start = end + 1 - len(RESPONSE_OK)
+            if self.buffer[start:end+1] == RESPONSE_OK and (start == 0 or self.buffer[start-1] == ord('\n')):
+                return (False, end + 1)
+
+    def take(self, length):
+        data = bytes(self.buffer[:length])
+        del self.buffer[:length]
+        self.scanned = 0
+        return data
+
+    def read_response(self, timeout):
+        """
+        Returns (error, response) for the next complete response, with error True for an error
+        response and False for success, or (None, whatever arrived) after 'timeout' seconds
+        """
+        start = time.time()
+        while True:
+            found = self.find_response()
+            if found is not None:
+                return (found[0], self.take(found[1]))
+            if time.time() >= start + timeout:
+                return (None, self.take(len(self.buffer)))
+            self.fill()
+
+    def read_available(self):
+        """ Returns whatever is buffered or arrives within the port timeout """
+        self.fill()
+        return self.take(len(self.buffer))
+
+    def reset(self):
+        """ Drops anything received but not yet read """
+        self.port.reset_input_buffer()
+        self.take(len(self.buffer))
+
+
 #-----------------------------------------------------------------------------
 #-----------------------------------------------------------------------------
 class BLDevice(object):
-    def __init__(self, args):
-        self.port = serial.Serial(args.port, args.baud, timeout=SERIAL_TIMEOUT)
+    def __init__(self, args, port=None):
+        #an already open port, e.g. from serial.serial_for_url, can be given instead of args.port
+        self.port = port if port is not None else serial.Serial(args.port, args.baud, timeout=SERIAL_TIMEOUT)
+        self.reader = ResponseReader(self.port)
+        #app upload settings, the chunk size is probed unless given
+        chunk = getattr(args, 'chunk', 0)
+        self.upload_sizes = [chunk] if chunk else list(UPLOAD_CHUNK_SIZES)
+        self.upload_pipeline = getattr(args, 'upload_pipeline', UPLOAD_PIPELINE)
+        self.upload_fwr = not getattr(args, 'hex_only', False)
+        self.upload_fwr_accepted = False
+        self.compile_cache = None if getattr(args, 'no_compile_cache', False) else CompileCache()
+        #the identity from AT I 0, 3 and 13 is remembered per port, unless the port is not named
+        self.port_name = getattr(args, 'port', None) if port is None else getattr(port, 'port', None)
+        self.identity_cache = None if getattr(args, 'no_identity_cache', False) else IdentityCache()
+        self.preprocessor = None
+        self.verbose = getattr(args, 'verbose', False)
 
     #when calling this remember to append \r if it is a command
     def writerawcmd(self, args, expect_response=True, timeout=0.5):
         self.port.write(bytearray(args, "ascii"))
         if not expect_response:
             return
-        response = b''
-        start = time.time()
-        while not response.endswith(b"00\r") and time.time() < start + timeout:
-            response += self.port.read(1)
-        if response.endswith(b"00\r"):
-            return str(response, "ascii")[:-3].strip()
+        return self.read_response(args, timeout)
+
+    def read_response(self, args, timeout=0.5):
+        error, response = self.reader.read_response(timeout)
+        if error is False:
+            return str(response, "ascii")[:-len(RESPONSE_OK)].strip()
+        elif error:
+            errorcode = str(response[len(RESPONSE_ERROR):-1].decode())
+            raise RuntimeError("Device returned error %s: %s" % (errorcode, get_errordesc(errorcode)))
+        elif len(response) == 0:
+            raise RuntimeError(
+                f"Got no response to command {repr(args)}. Not connected or not in interactive mode?")
         else:
-            if len(response) == 0:
-                raise RuntimeError(
-                    f"Got no response to command {repr(args)}. Not connected or not in interactive mode?")
-            elif len(response) > 4 and response[0:4] == b'\n01\t':
-                errorcode = str(response[4:].decode())[:-1]
-                raise RuntimeError("Device returned error %s: %s" % (errorcode, get_errordesc(errorcode)))
-            else:
-                raise RuntimeError("Got unexpected/error response to command 'AT%s': %s" % (args, response))
+            raise RuntimeError("Got unexpected/error response to command 'AT%s': %s" % (args, response))
 
     def writecmd(self, args, expect_response=True, timeout=0.5):
         command = f"AT{'' if args.startswith('+') else ' '}{args}\r"
@@ -119,7 +244,7 @@ class BLDevice(object):
         return self.writecmd("I %d" % param).split("\t")[-1]
 
     def reset_into_cmd_mode(self, brk_timeout=0.1, post_timeout=0.5):
-        if args.verbose:
+        if self.verbose:
             print("Resetting board via DTR and UART_BREAK into cmd mode ...")
         self.port.setDTR(False)
         self.port.break_condition=True
@@ -128,22 +253,40 @@ class BLDevice(object):
         self.port.setDTR(True)
         time.sleep(post_timeout)
         self.writecmd('')
-        if args.verbose:
+        if self.verbose:
             print("Cmd mode")
 
     def detect_model(self):
         print(f"Detecting...")
-        self.model = self.read_param(0)
+        if not self.cached_identity():
+            self.model = self.read_param(0)
+            self.version = self.read_param(3)
+            self.langhash = self.read_param(13).split()
+            self.save_identity()
+        elif self.verbose:
+            print("Identity cached")
         print(f"    Device   = {self.model}")
-        self.version = self.read_param(3)
         print(f"    Version  = {self.version}")
-        self.langhash = self.read_param(13).split()
-        if args.verbose:
+        if self.verbose:
             print(f"    Lang Hash= {self.langhash[0]} {self.langhash[1]}")
         self.xcompname = f"XComp_{self.model}_{self.langhash[0]}_{self.langhash[1]}.exe"
-        if args.verbose:
+        if self.verbose:
             print(f"Xcompiler name: {self.xcompname}")
 
+    def cached_identity(self):
+        """ Sets model, version and langhash from the identity cache and returns True if it has them """
+        if self.identity_cache is None:
+            return False
+        identity = self.identity_cache.load(self.port_name)
+        if identity is None:
+            return False
+        self.model, self.version, self.langhash = identity
+        return True
+
+    def save_identity(self):
+        if self.identity_cache is not None:
+            self.identity_cache.save(self.port_name, self.model, self.version, self.langhash)
+
     def compile(self, filepath):
         blutil_dir = os.path.dirname(sys.argv[0])
         compiler = os.path.join(blutil_dir, self.xcompname)
@@ -152,54 +295,73 @@ class BLDevice(object):
         filepath = os.path.abspath(filepath)
         if not os.path.exists(filepath):
             raise RuntimeError("File '%s' not found" % filepath)
+        if not os.path.exists(compiler) and not ALLOW_ONLINE_COMPILE:
+            raise RuntimeError("Compilation failed")
+        key = None
+        source = None
+        if self.compile_cache is not None:
+            source = self.preprocess(filepath)
+            key = self.compile_key(source, compiler)
+            if self.compile_cache.fetch(key, to_uwc(filepath)):
+                print("Compilation cached")
+                return
         if not os.path.exists(compiler):
-            if ALLOW_ONLINE_COMPILE:
-                return self.online_compile(filepath)
-            else:
-                raise RuntimeError("Compilation failed")  
-        #reaching here means a local xcompiler exe has been found          
-        if args.verbose:
+            self.online_compile(filepath, source)
+        else:
+            self.local_compile(filepath, compiler)
+        if key is not None:
+            self.compile_cache.store(key, to_uwc(filepath))
+
+    def compile_key(self, source, compiler):
+        """ Returns the compile cache key for the include expanded source and the compiler it goes to """
+        if os.path.exists(compiler):
+            stat = os.stat(compiler)
+            compiler_id = f"{compiler}|{stat.st_size}|{stat.st_mtime}"
+        else:
+            compiler_id = f"online|{URL_XCOMPILE_SERVER}"
+        return CompileCache.make_key(source, self.model, self.langhash, compiler_id)
+
+    def local_compile(self, filepath, compiler):
+        if self.verbose:
             print(f"Using local compiler: {os.path.basename(compiler)}")
         print("Compiling %s with %s..." % (filepath, os.path.basename(compiler)))
-        args = [compiler, filepath]
+        cmdline = [compiler, filepath]
         if os.name != 'nt':
             #if not on windows then test if 'wine' is installed
-            blutilc.test_wine()
+            test_wine()
             # 'wine' exists so prepend the args with it
-            args = ["wine"] + args
-        ret = subprocess.call(args, stdin=None, stdout=sys.stdout, stderr=sys.stderr, shell=False)
+            cmdline = ["wine"] + cmdline
+        ret = subprocess.call(cmdline, stdin=None, stdout=sys.stdout, stderr=sys.stderr, shell=False)
         if ret != 0:
             raise RuntimeError("Compilation failed")
         print("Compilation success")
 
-    def online_compile(self, filepath):
-        if args.verbose:
+    def online_compile(self, filepath, source=None):
+        if self.verbose:
             print('Using online compiler (Local compiler missing)')
         
         #get the xcompiler model index from online server
         url = f'http://{URL_XCOMPILE_SERVER}/supported.php?JSON=1'
         query=f"{url}&Dev={self.model}&HashA={self.langhash[0]}&HashB={self.langhash[1]}"
-        if args.verbose:
+        if self.verbose:
             print(f"Query={query}")
         response = requests.get(query)
-        if args.verbose:
+        if self.verbose:
             print(f"get resp_code={response.status_code}")
         if response.status_code // 100 != 2:
             error = json.loads(response.content, encoding=response.encoding)
             raise RuntimeError(f"Online compiler error code {error['Result']}: {error['Error']}")
         qresp=response.content.decode()
-        if args.verbose:
+        if self.verbose:
             print(f"QueryResp={response.content.decode()}")
         qresp=eval(qresp)
         #generate the payload for the PUT that comes next
         payload = {'file_XComp': f"{qresp['ID']}"}
 
-        #read the sb app source and replace #includes recursively with the code
-        with open(filepath, 'r') as f:
-            file_data = f.read()
-            file_dir = os.path.dirname(filepath)
-            file_data = self.do_include(file_data, file_dir)
-            file_data = file_data.encode('utf-8')
+        #read the sb app source and replace #includes with the code
+        if source is None:
+            source = self.preprocess(filepath)
+        file_data = source.encode('utf-8')
         #and write it to a temporary file
         with open(ONLINE_SB_TEMPFILENAME,'wb') as f:
             f.write(file_data)
@@ -208,12 +370,12 @@ class BLDevice(object):
         url = f'http://{URL_XCOMPILE_SERVER}/xcompile.php?JSON=1'
         files = {'file_sB': (os.path.basename(filepath), file_data, 'application/octet-stream')}
         response = requests.post(url, data=payload, files=files)
-        if args.verbose:
+        if self.verbose:
             print('resp_code=%d'%(response.status_code))
         if response.status_code // 100 != 2:
             error = json.loads(response.content, encoding=response.encoding)
             if error['Result'] == '-9':
-                raise RuntimeError(f"{error['Error']}:\n{error['Description']}")
+                raise RuntimeError(f"{error['Error']}:\n{self.map_error_lines(error['Description'])}")
             raise RuntimeError(f"Online compiler error code {error['Result']}: {error['Error']}")
 
         #save the compiled sb app to a file
@@ -221,7 +383,7 @@ class BLDevice(object):
         f.write(response.content)
         f.close()
         #remove the temporary file if not in verbose mode
-        if not args.verbose:
+        if not self.verbose:
             try:
                 os.remove(ONLINE_SB_TEMPFILENAME)
             except:
@@ -229,6 +391,43 @@ class BLDevice(object):
         print("Online compilation success")
 
     def upload(self, filepath):
+        filepath, appname, data = self.upload_file(filepath)
+        print("Uploading %s as %s" % (filepath, appname))
+        self.run_steps(self.upload_steps(appname, data))
+        print("Upload success")
+
+    def upload_data(self, appname, data, pipeline=1):
+        """ Writes 'data' to the file 'appname' on the module, probing the chunk size first """
+        self.run_steps(self.upload_data_steps(appname, data, pipeline))
+
+    def run_steps(self, steps):
+        """
+        Runs the generator 'steps', e.g. upload_steps(appname, data), sending the commands and
+        doing the sleeps it yields and returns what it returns
+        An error from a command is raised inside 'steps' so that it can retry
+        """
+        result = None
+        failure = None
+        while True:
+            try:
+                request = steps.send(result) if failure is None else steps.throw(failure)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                result, failure = self.perform(request), None
+            except BaseException as e:
+                result, failure = None, e
+
+    def perform(self, request):
+        if request[0] == AT_COMMAND:
+            return self.writecmd(request[1], request[2])
+        if request[0] == AT_RESPONSE:
+            return self.read_response(request[1])
+        time.sleep(request[1])
+        return None
+
+    def upload_file(self, filepath):
+        """ Returns (filepath, appname, data) of the compiled app for the source or .uwc 'filepath' """
         filepath = os.path.expanduser(filepath)
         filepath = os.path.abspath(filepath)
 
@@ -236,15 +435,83 @@ class BLDevice(object):
         if parts[1] != ".uwc":  # compiled files have .uwc extension
             filepath = "%s.uwc" % (parts[0],)
         appname = get_sbappname(filepath)
-        print("Uploading %s as %s" % (filepath, appname))
-        self.writecmd('+DEL "%s" +' % appname)
-        self.writecmd('+FOW "%s"' % appname)
         with open(filepath, "rb") as f:
-            for line in chunks(f, 16):
-                row = "".join(["%02x" % x for x in line])
-                self.writecmd('+FWRH "%s"' % row)
-        self.writecmd('+FCL')
-        print("Upload success")
+            data = f.read()
+        return (filepath, appname, data)
+
+    def upload_steps(self, appname, data):
+        """
+        Generator for run_steps() that uploads 'data' as 'appname', pipelined if upload_pipeline
+        is more than 1 and one command at a time if that fails
+        """
+        try:
+            yield from self.upload_data_steps(appname, data, self.upload_pipeline)
+        except RuntimeError as e:
+            if self.upload_pipeline <= 1:
+                raise
+            #a failed write part way through a pipeline leaves a gap in the file, so start again
+            if self.verbose:
+                print(f"Pipelined upload failed ({e}), retrying one command at a time")
+            yield (AT_SLEEP, 0.5)
+            self.reader.reset()
+            yield (AT_COMMAND, '+FCL', False)
+            yield (AT_SLEEP, 0.1)
+            self.reader.reset()
+            yield from self.upload_data_steps(appname, data, 1)
+
+    def upload_data_steps(self, appname, data, pipeline=1):
+        """ Generator for run_steps() that writes 'data' to the file 'appname', see upload_data """
+        yield (AT_COMMAND, '+DEL "%s" +' % appname, True)
+        yield (AT_COMMAND, '+FOW "%s"' % appname, True)
+        pos = 0
+        outstanding = 0
+        while pos < len(data):
+            chunk = data[pos:pos+self.upload_sizes[0]]
+            command = self.filewrite_command(chunk)
+            if pipeline > 1 and len(self.upload_sizes) == 1 and (self.upload_fwr_accepted or not command.startswith('+FWR ')):
+                #chunk size settled and the command known to work so send ahead of the responses
+                yield (AT_COMMAND, command, False)
+                outstanding += 1
+                if outstanding >= pipeline:
+                    yield (AT_RESPONSE, command)
+                    outstanding -= 1
+                pos += len(chunk)
+                continue
+            while outstanding > 0:
+                yield (AT_RESPONSE, '+FWRH')
+                outstanding -= 1
+            try:
+                yield (AT_COMMAND, command, True)
+            except RuntimeError:
+                if command.startswith('+FWR ') and self.upload_fwr:
+                    #string variant not supported, retry as hex
+                    self.upload_fwr = False
+                elif len(self.upload_sizes) > 1:
+                    #too long for the module, retry smaller
+                    self.upload_sizes.pop(0)
+                else:
+                    raise
+                continue
+            if command.startswith('+FWR '):
+                self.upload_fwr_accepted = True
+            if len(self.upload_sizes) > 1:
+                if self.verbose:
+                    print(f"Module accepts {self.upload_sizes[0]} bytes per write")
+                self.upload_sizes = self.upload_sizes[:1]
+            pos += len(chunk)
+        while outstanding > 0:
+            yield (AT_RESPONSE, '+FWRH')
+            outstanding -= 1
+        yield (AT_COMMAND, '+FCL', True)
+
+    def filewrite_command(self, chunk):
+        """ Returns the shorter of the AT+FWRH and, if allowed, AT+FWR commands that write 'chunk' """
+        command = '+FWRH "%s"' % "".join(["%02x" % x for x in chunk])
+        if self.upload_fwr:
+            text = "".join([chr(x) if 0x20 <= x < 0x7F and x not in (0x22, 0x5C) else "\\%02X" % x for x in chunk])
+            if len(text) < len(chunk) * 2:
+                command = '+FWR "%s"' % text
+        return command
 
     def run(self, filepath):
         appname = get_sbappname(filepath)
@@ -253,77 +520,123 @@ class BLDevice(object):
         # send run command
         print("Running %s..." % appname)
         self.writecmd('+RUN "%s"' % appname, expect_response=False)
-        # try to read up to 1024 bytes for timeout period
+        # wait for the program to end for timeout period
         self.port.timeout=1.0
-        output = self.port.read(1024)
-        if len(output):
-            if len(output) >= 3 and output[-3:] == b'00\r':
-                if len(output) > 3:
-                    print("Output:\n%s" % output[:-3].decode())
-                print("Program completed successfully.")
-            elif len(output) > 4 and output[0:4] == b'\n01\t':
-                errorcode = str(output[4:].decode())[:-1]
-                print("Error %s: %s" % (errorcode, get_errordesc(errorcode)))
-            elif output != b'\n00':
+        error, output = self.reader.read_response(1.0)
+        if error is False:
+            if len(output) > len(RESPONSE_OK):
+                print("Output:\n%s" % output[:-len(RESPONSE_OK)].decode())
+            print("Program completed successfully.")
+        elif error:
+            errorcode = str(output[len(RESPONSE_ERROR):-1].decode())
+            print("Error %s: %s" % (errorcode, get_errordesc(errorcode)))
+        elif len(output):
+            if output != b'\n00':
                 print("Immediate output:\n%s" % output.decode('utf-8'))
         else:
             print("No immediate output, program probably running...")
 
     def list(self):
-        if args.verbose:
+        if self.verbose:
             print("Listing files...")
         output = self.writecmd('+DIR')
         print(output)
 
     def delete(self, filename):
         filename = get_sbappname(filename)
-        if args.verbose:
+        if self.verbose:
             print("Removing %s..." % filename)
         self.writecmd('+DEL "%s"' % filename)
-        if args.verbose:
+        if self.verbose:
             print("Deleted all files")
 
     def format(self):
-        if args.verbose:
+        if self.verbose:
            print("Formatting filesystem only...")
         self.writerawcmd('AT&F 1\r', timeout=10)
         time.sleep(0.2)
-        self.port.read(1024)  # discard anything
-        if args.verbose:
+        self.reader.reset()  # discard anything
+        if self.verbose:
             print("Format complete. Reconnecting...")
         self.writecmd('')
 
-    def do_include(self, file, dirname):
-        pattern = re.compile(r'^#include\s+"(.*)"$', re.MULTILINE)
-        match = pattern.search(file)
-        if match is None:
-            return file
-
-        include_path = os.path.join(dirname, match.group(1))
-        include_path = os.path.abspath(include_path)
-
-        if not os.path.exists(include_path):
-            raise RuntimeError(f"Included file {include_path} does not exist")
-
-        with open(include_path, 'r') as include_file:
-            file_data = include_file.read()
-            include_dirname = os.path.dirname(include_path)
-            file_data = self.do_include(file_data, include_dirname)
-            file = f"{file[:match.start()]}\n{file_data}\n{file[match.end():]}"
-
-        file = self.do_include(file, dirname)
-
+    def preprocess(self, filepath):
+        """ Returns the source of 'filepath' with its #includes expanded, ready for the online compiler """
+        self.preprocessor = Preprocessor()
+        try:
+            file = self.preprocessor.expand(filepath)
+        except IncludeError as e:
+            raise RuntimeError(str(e))
         # the online compiler doesn't allow the string #include anywhere
         # UwTerminalX does this replace too
-        file = file.replace('#include', "")
-        return file
-
-    def listen(self):
-        try:
-            while True:
-                print(self.port.read(1).decode(), end='')
-        except KeyboardInterrupt:
-            print('\n')
+        return file.replace('#include', "")
+
+    def map_error_lines(self, text):
+        """ Adds the original file and line after each line number the compiler reports for the expanded source """
+        def original(match):
+            location = self.preprocessor.original_location(int(match.group(2)))
+            if location is None:
+                return match.group(0)
+            return f"{match.group(0)} ({os.path.basename(location[0])}:{location[1]})"
+        if self.preprocessor is None:
+            return text
+        return re.sub(r'(line\s*:?\s*)(\d+)', original, text, flags=re.IGNORECASE)
+
+    def batch(self, commands, pipeline=BATCH_PIPELINE, timeout=SERIAL_TIMEOUT, keep_going=False):
+        """
+        Sends the (line number, command) 'commands' one after another in this session and returns
+        a result dict for each command sent, with up to 'pipeline' commands sent ahead of their
+        responses, which the module answers in order
+        Stops at the first error response unless 'keep_going', and always when a command gets no
+        response as later responses could no longer be matched to their commands
+        """
+        results = []
+        outstanding = collections.deque()   #(line number, command, time sent) awaiting responses
+        stop = False
+        for line, command in commands:
+            barrier = is_batch_barrier(command)
+            while len(outstanding) > 0 and barrier:
+                stop = not self.batch_result(results, outstanding.popleft(), timeout, keep_going) or stop
+            if stop:
+                break
+            self.writeraw(f"{command}\r")
+            outstanding.append((line, command, time.monotonic()))
+            while len(outstanding) > (0 if barrier else max(pipeline, 1) - 1):
+                stop = not self.batch_result(results, outstanding.popleft(), timeout, keep_going) or stop
+            if stop:
+                break
+        while len(outstanding) > 0:
+            self.batch_result(results, outstanding.popleft(), timeout, keep_going)
+        return results
+
+    def batch_result(self, results, sent, timeout, keep_going):
+        """ Reads the response to the 'sent' command into 'results', returns False if the batch should stop """
+        line, command, started = sent
+        error, response = self.reader.read_response(timeout)
+        result = {'line': line, 'command': command, 'ok': error is False, 'latency': round(time.monotonic() - started, 6)}
+        if error is False:
+            result['response'] = str(response, "ascii", "replace")[:-len(RESPONSE_OK)].strip()
+        elif error:
+            errorcode = str(response[len(RESPONSE_ERROR):-1].decode())
+            result['error'] = errorcode
+            result['description'] = get_errordesc(errorcode)
+        else:
+            result['error'] = 'timeout'
+            result['response'] = str(response, "ascii", "replace").strip()
+        if self.verbose:
+            print(f"{command}: {result.get('error', 'ok')} in {result['latency']:.3f}s", file=sys.stderr)
+        results.append(result)
+        return error is False or (error is True and keep_going)
+
+    def listen(self, sinks=None):
+        """
+        Passes what the module prints, line by line, to 'sinks', stdout by default, until Ctrl-C
+        """
+        engine = sblisten.ListenEngine(self.port, sinks if sinks is not None else [sblisten.StdoutSink()])
+        engine.run(self.reader.take(len(self.reader.buffer)))
+        print('\n')
+        if engine.ring.dropped > 0:
+            print(f"{engine.ring.dropped} lines dropped, the output could not keep up")
 
 
 #-----------------------------------------------------------------------------
@@ -336,6 +649,43 @@ def chunks(somefile, chunklen):
         yield chunk
 
 
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def read_batch_script(stream):
+    """ Returns (line number, command) for each line of 'stream' that is not blank or a # comment """
+    commands = []
+    for number, line in enumerate(stream, 1):
+        command = line.strip()
+        if len(command) > 0 and not command.startswith('#'):
+            commands.append((number, command))
+    return commands
+
+def is_batch_barrier(command):
+    """ Returns True if 'command' restarts the module or starts an app, see BATCH_BARRIERS """
+    command = command.upper().replace(' ', '')
+    if command.startswith('AT'):
+        command = command[2:]
+    return command.startswith(BATCH_BARRIERS)
+
+def batch_summary(port, commands, results, elapsed):
+    """ Returns the JSON document that --batch prints for the 'results' of running 'commands' """
+    return {'port': port, 'commands': len(commands), 'sent': len(results),
+            'failed': len([result for result in results if not result['ok']]),
+            'elapsed': round(elapsed, 6), 'results': results}
+
+def run_batch(device, args):
+    """ Runs the --batch script in 'args' on 'device', prints the JSON results and returns the exit status """
+    if args.batch == '-':
+        commands = read_batch_script(sys.stdin)
+    else:
+        with open(args.batch) as f:
+            commands = read_batch_script(f)
+    start = time.monotonic()
+    results = device.batch(commands, args.batch_pipeline, args.timeout, args.keep_going)
+    summary = batch_summary(args.port, commands, results, time.monotonic() - start)
+    print(json.dumps(summary, indent=2))
+    return 0 if summary['failed'] == 0 and summary['sent'] == summary['commands'] else 2
+
 #-----------------------------------------------------------------------------
 #-----------------------------------------------------------------------------
 def get_sbappname(filepath):
@@ -361,15 +711,67 @@ def test_wine():
 
 #-----------------------------------------------------------------------------
 #-----------------------------------------------------------------------------
+error_codes = None     #{section: {code: description}}, built on the first lookup
+
+def parse_error_codes(f):
+    """ Parses the [section] and code="description" lines of codes.csv, the first entry for a code wins """
+    sections = {}
+    section = sections.setdefault(ERROR_CODES_SECTION, {})
+    for line in f:
+        line = line.strip()
+        if line.startswith('[') and line.endswith(']'):
+            section = sections.setdefault(line[1:-1], {})
+            continue
+        code, sep, desc = line.partition('=')
+        if not sep or not code.isdigit():
+            continue
+        if len(desc) >= 2 and desc.startswith('"') and desc.endswith('"'):
+            desc = desc[1:-1]
+        section.setdefault(int(code), desc.replace('\\"', '"'))
+    return sections
+
+def load_error_codes(path=None):
+    """
+    Returns the error code index for 'path', by default codes.csv beside this script,
+    reading the JSON cache beside it when that is newer than the csv file
+    """
+    if path is None:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), ERROR_CODES_FILE)
+    cache_path = f"{path}.json"
+    mtime = os.path.getmtime(path)
+    if ERROR_CODES_CACHE:
+        try:
+            with open(cache_path, 'r') as f:
+                cache = json.load(f)
+            if cache['mtime'] == mtime:
+                return {name: {int(code): desc for code, desc in section.items()}
+                        for name, section in cache['sections'].items()}
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+    with open(path, 'r') as f:
+        sections = parse_error_codes(f)
+    if ERROR_CODES_CACHE:
+        try:
+            with open(cache_path, 'w') as f:
+                json.dump({'mtime': mtime, 'sections': sections}, f)
+        except IOError:
+            pass    #the install directory may be read only, parsing again next time is fine
+    return sections
+
+def lookup_error(code, section=ERROR_CODES_SECTION):
+    """ Returns the "NAME,description" for integer error 'code' in 'section', or None if unknown """
+    global error_codes
+    if error_codes is None:
+        error_codes = load_error_codes()
+    return error_codes.get(section, {}).get(code)
+
 def get_errordesc(code):
-    """ Go through file with list of error codes to find description """
-    blutil_dir = os.path.dirname(sys.argv[0])
-    with open(os.path.join(blutil_dir, 'codes.csv')) as f:
-        for line in f:
-            if str(eval("0x" + code)) in line:
-                return line.split('"')[1]
-                break
-        return "(no description available)"
+    """ Look up the description of the hex error code string reported by the device """
+    try:
+        desc = lookup_error(int(code, 16))
+    except (ValueError, IOError):
+        desc = None
+    return desc if desc is not None else "(no description available)"
 
 #-----------------------------------------------------------------------------
 #-----------------------------------------------------------------------------
@@ -402,8 +804,8 @@ if __name__ == "__main__":
         if args.run:
             ops += ["run"]
 
-        #if break into command mode via reset/urt_break then do so
-        if not args.no_break:
+        #if break into command mode via reset/urt_break then do so, a batch runs in the session as it is
+        if not args.no_break and not args.batch:
             device.reset_into_cmd_mode()
 
         if args.compile:
@@ -428,14 +830,16 @@ if __name__ == "__main__":
             cmdstr=f"{args.send}\r"
             print(device.writerawcmd(cmdstr, timeout=args.timeout))
             print("Command completed")
+        if args.batch:
+            return run_batch(device, args)
         if args.listen:
-            device.listen()
+            device.listen(sblisten.sinks_from_args(args))
 
 #-----------------------------------------------------------------------------
 #-----------------------------------------------------------------------------
 if __name__ == "__main__":
     try:
-        main()
+        sys.exit(main())
     except RuntimeError as e:
         print(e)
         sys.exit(2)
@@ -0,0 +1,380 @@
+##########################################################################################
+# asyncio sessions with smartBASIC modules and their bootloader, many ports on one event loop
+##########################################################################################
+"""
+AsyncBLDevice and AsyncUwfProcessor offer the operations of blutilc.BLDevice and
+uwf_processor.UwfProcessor as coroutines. Waiting for the module never blocks the event
+loop, input is waited for with loop.add_reader where the port has a file descriptor, so
+one loop can drive many ports and any of them can be timed out or cancelled, e.g.
+
+    async def flash(ports, file_path):
+        return await asyncio.gather(*[sbasync.loadfirmware(port, 115200, file_path, 'BL654')
+                                      for port in ports])
+
+The firmware download is uwfloader's, the processor's generator methods are run with the
+reads and sleeps they yield awaited instead of blocking, so only the serial I/O differs.
+"""
+import asyncio
+import codecs
+import errno
+import os
+import sys
+import time
+
+import serial
+import blutilc
+import uwf_processor
+import uwfloader
+
+POLL_INTERVAL_SEC = 0.002      #how often ports without a file descriptor are checked for input
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class AsyncSerial(object):
+    """
+    A serial port read without blocking, only what in_waiting reports is ever read
+    'port' is a port name, opened with a zero timeout, or an already open port object
+    """
+    def __init__(self, port, baudrate=blutilc.SERIAL_DEF_BAUD, timeout=blutilc.SERIAL_TIMEOUT):
+        if isinstance(port, str):
+            self.port = serial.Serial(port, baudrate, timeout=0)
+            self.name = port
+        else:
+            self.port = port
+            # None if the port has no device name, e.g. an emulator
+            name = getattr(port, 'name', None)
+            self.name = name if isinstance(name, str) else None
+        # Default time to wait in read(), like the pyserial timeout
+        self.timeout = timeout
+        self.fd = None
+        if os.name != 'nt':
+            try:
+                self.fd = self.port.fileno()
+            except Exception:
+                # In-process ports and some URL handlers have none, they are polled
+                self.fd = None
+
+    def __str__(self):
+        return self.name or str(self.port)
+
+    @property
+    def baudrate(self):
+        return self.port.baudrate
+
+    @baudrate.setter
+    def baudrate(self, baudrate):
+        self.port.baudrate = baudrate
+
+    @property
+    def in_waiting(self):
+        return self.port.in_waiting
+
+    @property
+    def break_condition(self):
+        return self.port.break_condition
+
+    @break_condition.setter
+    def break_condition(self, state):
+        self.port.break_condition = state
+
+    def setDTR(self, state):
+        self.port.setDTR(state)
+
+    def write(self, data):
+        return self.port.write(data)
+
+    def reset_input_buffer(self):
+        self.port.reset_input_buffer()
+
+    def close(self):
+        self.port.close()
+
+    async def wait_readable(self, timeout):
+        """ Returns True once input is waiting, or False if none arrives within 'timeout' seconds """
+        if self.port.in_waiting > 0:
+            return True
+        if timeout <= 0:
+            return False
+        if self.fd is None:
+            deadline = time.monotonic() + timeout
+            while self.port.in_waiting == 0:
+                if time.monotonic() >= deadline:
+                    return False
+                await asyncio.sleep(POLL_INTERVAL_SEC)
+            return True
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        loop.add_reader(self.fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            await asyncio.wait_for(ready, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            loop.remove_reader(self.fd)
+        return True
+
+    async def read(self, size, timeout=None):
+        """ Returns 'size' bytes, or fewer if the rest do not arrive within 'timeout' seconds """
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        data = bytearray()
+        while len(data) < size:
+            if not await self.wait_readable(deadline - time.monotonic()):
+                break
+            waiting = self.port.in_waiting
+            if waiting == 0:
+                # Readable without data, e.g. the other end of a pty closed
+                await asyncio.sleep(POLL_INTERVAL_SEC)
+                continue
+            data += self.port.read(min(size - len(data), waiting))
+        return bytes(data)
+
+    async def readline(self, timeout=None):
+        """ Returns the bytes up to and including a newline, or fewer if none arrives within 'timeout' seconds """
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        line = bytearray()
+        while not line.endswith(b'\n'):
+            data = await self.read(1, deadline - time.monotonic())
+            if len(data) == 0:
+                break
+            line += data
+        return bytes(line)
+
+    async def read_available(self, timeout=None):
+        """ Returns what is waiting, waiting up to 'timeout' seconds for at least one byte """
+        if not await self.wait_readable(self.timeout if timeout is None else timeout):
+            return b''
+        return self.port.read(self.port.in_waiting)
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class AsyncResponseReader(blutilc.ResponseReader):
+    """ blutilc.ResponseReader filled from an AsyncSerial """
+    async def fill(self, timeout):
+        data = await self.port.read_available(timeout)
+        self.buffer += data
+        return len(data)
+
+    async def read_response(self, timeout):
+        start = time.monotonic()
+        while True:
+            found = self.find_response()
+            if found is not None:
+                return (found[0], self.take(found[1]))
+            remaining = start + timeout - time.monotonic()
+            if remaining <= 0:
+                return (None, self.take(len(self.buffer)))
+            await self.fill(remaining)
+
+    async def read_available(self, timeout=None):
+        await self.fill(self.port.timeout if timeout is None else timeout)
+        return self.take(len(self.buffer))
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class AsyncBLDevice(blutilc.BLDevice):
+    """
+    blutilc.BLDevice with its serial operations as coroutines
+    Compiling runs in the default executor as it waits on wine or the online compiler
+    """
+    def __init__(self, args, port=None):
+        if port is None:
+            port = args.port
+        if not isinstance(port, AsyncSerial):
+            port = AsyncSerial(port, args.baud)
+        blutilc.BLDevice.__init__(self, args, port)
+        self.reader = AsyncResponseReader(self.port)
+        self.port_name = self.port.name
+
+    async def writerawcmd(self, args, expect_response=True, timeout=0.5):
+        self.port.write(bytearray(args, "ascii"))
+        if not expect_response:
+            return
+        return await self.read_response(args, timeout)
+
+    async def read_response(self, args, timeout=0.5):
+        error, response = await self.reader.read_response(timeout)
+        return self.response_text(args, error, response)
+
+    def response_text(self, args, error, response):
+        if error is False:
+            return str(response, "ascii")[:-len(blutilc.RESPONSE_OK)].strip()
+        elif error:
+            errorcode = str(response[len(blutilc.RESPONSE_ERROR):-1].decode())
+            raise blutilc.RuntimeError("Device returned error %s: %s" % (errorcode, blutilc.get_errordesc(errorcode)))
+        elif len(response) == 0:
+            raise blutilc.RuntimeError(
+                f"Got no response to command {repr(args)}. Not connected or not in interactive mode?")
+        raise blutilc.RuntimeError("Got unexpected/error response to command 'AT%s': %s" % (args, response))
+
+    async def writecmd(self, args, expect_response=True, timeout=0.5):
+        command = f"AT{'' if args.startswith('+') else ' '}{args}\r"
+        return await self.writerawcmd(command, expect_response, timeout)
+
+    async def read_param(self, param):
+        return (await self.writecmd("I %d" % param)).split("\t")[-1]
+
+    async def reset_into_cmd_mode(self, brk_timeout=0.1, post_timeout=0.5):
+        if self.verbose:
+            print("Resetting board via DTR and UART_BREAK into cmd mode ...")
+        self.port.setDTR(False)
+        self.port.break_condition=True
+        await asyncio.sleep(brk_timeout)
+        self.port.break_condition=False
+        self.port.setDTR(True)
+        await asyncio.sleep(post_timeout)
+        await self.writecmd('')
+        if self.verbose:
+            print("Cmd mode")
+
+    async def detect_model(self):
+        if not self.cached_identity():
+            self.model = await self.read_param(0)
+            self.version = await self.read_param(3)
+            self.langhash = (await self.read_param(13)).split()
+            self.save_identity()
+        self.xcompname = f"XComp_{self.model}_{self.langhash[0]}_{self.langhash[1]}.exe"
+        if self.verbose:
+            print(f"{self.port}: {self.model} {self.version} {self.langhash[0]} {self.langhash[1]}")
+
+    async def compile(self, filepath):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, blutilc.BLDevice.compile, self, filepath)
+
+    async def upload(self, filepath):
+        filepath, appname, data = self.upload_file(filepath)
+        await self.run_steps(self.upload_steps(appname, data))
+
+    async def run_steps(self, steps):
+        """ BLDevice.run_steps, awaiting what 'steps' yields """
+        result = None
+        failure = None
+        while True:
+            try:
+                request = steps.send(result) if failure is None else steps.throw(failure)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                result, failure = await self.perform(request), None
+            except BaseException as e:
+                result, failure = None, e
+
+    async def perform(self, request):
+        if request[0] == blutilc.AT_COMMAND:
+            return await self.writecmd(request[1], request[2])
+        if request[0] == blutilc.AT_RESPONSE:
+            return await self.read_response(request[1])
+        await asyncio.sleep(request[1])
+        return None
+
+    async def run(self, filepath, timeout=1.0):
+        """
+        Starts the app and returns (error, output) as for ResponseReader.read_response,
+        error is None if the app is still running after 'timeout' seconds
+        """
+        appname = blutilc.get_sbappname(filepath)
+        await self.writecmd('')
+        await self.writecmd('+RUN "%s"' % appname, expect_response=False)
+        return await self.reader.read_response(timeout)
+
+    async def list(self):
+        return await self.writecmd('+DIR')
+
+    async def delete(self, filename):
+        await self.writecmd('+DEL "%s"' % blutilc.get_sbappname(filename))
+
+    async def format(self):
+        await self.writerawcmd('AT&F 1\r', timeout=10)
+        await asyncio.sleep(0.2)
+        self.reader.reset()  # discard anything
+        await self.writecmd('')
+
+    async def listen(self, output=None):
+        """ Passes everything the module prints to 'output', print by default, until cancelled """
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        while True:
+            text = decoder.decode(await self.reader.read_available())
+            if len(text) == 0:
+                continue
+            if output is None:
+                print(text, end='', flush=True)
+            else:
+                output(text)
+
+    def close(self):
+        self.port.close()
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class AsyncUwfProcessor(uwf_processor.UwfProcessor):
+    """
+    uwf_processor.UwfProcessor run on an AsyncSerial, awaiting the reads and sleeps that its
+    generator methods yield, e.g. await processor.run(processor.enter_bootloader())
+    The resets of the module type come from the class uwf_processor.processor_class picks
+    """
+    def __init__(self, port, baudrate, dev_type=None):
+        if dev_type == uwf_processor.DEVICE_TYPE_BL654IG:
+            raise Exception(f"{dev_type} enters its bootloader over DBus, which has no asyncio support here")
+        cls = uwf_processor.processor_class(dev_type)
+        if not isinstance(port, AsyncSerial):
+            port = AsyncSerial(port, baudrate, uwf_processor.SERIAL_TIMEOUT_SEC)
+        uwf_processor.UwfProcessor.__init__(self, port, baudrate)
+        self.bootloader_reset_delay = cls.bootloader_reset_delay
+        self.reboot_reset_delay = cls.reboot_reset_delay
+
+    async def run(self, steps):
+        """ UwfProcessor.run, awaiting what 'steps' yields """
+        result = None
+        failure = None
+        while True:
+            try:
+                request = steps.send(result) if failure is None else steps.throw(failure)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                result, failure = await self.perform(request), None
+            except BaseException as e:
+                result, failure = None, e
+
+    async def perform(self, request):
+        if request[0] == uwf_processor.IO_READ:
+            return await self.ser.read(request[1])
+        if request[0] == uwf_processor.IO_READLINE:
+            return await self.ser.readline()
+        await asyncio.sleep(request[1])
+        return None
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+async def loadfirmware(port, baudrate, file_path, dev_type=None, observer=None, **options):
+    """
+    uwfloader.loadfirmware as a coroutine, taking the same options and returning the same
+    errno style exit codes
+    If cancelled the last verified point is kept in the journal and the port is closed
+    """
+    image, exit_code = uwfloader.open_image(file_path)
+    if exit_code != uwfloader.EXIT_CODE_SUCCESS:
+        return exit_code
+
+    processor = None
+    try:
+        processor = AsyncUwfProcessor(port, baudrate, dev_type)
+        processor.observer = observer
+        error = await processor.run(uwfloader.download(processor, image, dev_type, **options))
+        if error != None:
+            sys.stderr.write(error)
+            exit_code = errno.EPERM
+    except asyncio.CancelledError:
+        if processor is not None:
+            processor.flush_checkpoint()
+            processor.ser.close()
+        raise
+    except Exception as e:
+        exit_code = uwfloader.failed_exit_code(e)
+    finally:
+        if image is not file_path:
+            image.close()
+
+    if exit_code != uwfloader.EXIT_CODE_SUCCESS and processor is not None:
+        # Keep the last verified point so that the download can be resumed
+        processor.flush_checkpoint()
+    return exit_code
@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+"""
+This is a command line tool for benchmarking the firmware download engine without hardware.
+
+Usage: python3 sbbench.py [pipeline|checksum|delta|erase|schedule|emulator|app] [options]
+           pipeline         time a firmware download for a range of pipeline windows (default)
+           checksum         CPU cost per MB of the data block checksums
+           delta            re-flash an image with one changed block, with and without --delta
+           erase            erase phase of an image with many erase blocks, one at a time,
+                            pipelined and skipping blank sectors
+           schedule         image of several regions, command by command and as one scheduled stream
+           emulator         the pipeline benchmark through pyserial and a uwfemu.py pseudo terminal
+           app              app upload and AT command rates against a sbemu.py module on a pty
+       options
+           --size KB        size of the synthetic firmware image, default 32
+           --baud BAUD      simulated line rate, default 115200
+           --latency SECS   simulated bootloader processing time per command, default 0.002
+           --windows N,..   pipeline windows to compare, 0 is stop-and-wait, default 0,4,8,16
+           --fast RATES     negotiate the download rate from this comma separated list
+           --max-baud BAUD  fastest rate the simulated bootloader can sync at, default 921600
+           --erase-time SECS  simulated time to erase one sector, default 0.085
+
+The download runs through uwfloader.loadfirmware exactly as it would for a real module,
+but the serial port is replaced by a uwfemu.LoopbackBootloader that models the time each byte
+spends on the wire and the time the bootloader takes to act on each command.
+The emulator benchmark runs the same download over a real pseudo terminal, so it also
+measures the serial stack, and reports round trips, the times the bootloader answered
+and then sat waiting for the host, per KB of firmware. It needs a POSIX host.
+The app benchmark uploads --size KB with the old 16 byte AT+FWRH lines, with the probed
+chunk size and with pipelining, then times AT I 0 and AT+DIR round trips and a batch of
+AT+CFG commands sent one at a time and pipelined.
+The checksum benchmark only uses the --size option.
+"""
+
+#-----------------------------------------------------------------------------
+# constants
+#-----------------------------------------------------------------------------
+
+VERBOSELEVEL=0
+
+DEFAULT_IMAGE_KB=32
+DEFAULT_BAUD=115200
+DEFAULT_LATENCY=0.002
+DEFAULT_WINDOWS='0,4,8,16'
+DEFAULT_MAX_BAUD=921600
+DEFAULT_ERASE_TIME=0.085    #nRF52 page erase
+
+BENCH_PLATFORM_ID=0x0A0B0C0D
+BENCH_BASE_ADDRESS=0
+BENCH_SECTOR_SIZE=4096
+BENCH_SECTORS=256
+BENCH_REGIONS=4
+BENCH_WRITE_SIZE=2048       #bytes per write command in the multi-region image
+BENCH_CFG_COMMANDS=30       #AT+CFG commands in the batch of the app benchmark
+
+BOOTLOADER_ATS=b'SBBENCH LOADER'
+
+#-----------------------------------------------------------------------------
+# Module imports
+#-----------------------------------------------------------------------------
+import uwfloader
+import uwf_processor
+import uwf_checksum
+import uwf_image
+import uwf_stats
+import uwfemu
+import argparse
+import os
+import random
+import struct
+import tempfile
+import time
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def bench_loopback(baudrate=DEFAULT_BAUD, latency=DEFAULT_LATENCY, max_baudrate=DEFAULT_MAX_BAUD, erase_time=0.0):
+    """ Returns a uwfemu.LoopbackBootloader with the flash layout and ATS of the benchmark images """
+    model = uwfemu.BootloaderModel(((BENCH_SECTORS, BENCH_SECTOR_SIZE),), BENCH_BASE_ADDRESS, ats=BOOTLOADER_ATS)
+    return uwfemu.LoopbackBootloader(model, baudrate, latency, max_baudrate, erase_time)
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def uwf_command(cmd, payload):
+    return cmd.encode('utf-8') + b'\x00' + struct.pack('<I', len(payload)) + payload
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def make_image(size, data=None):
+    """ Returns the bytes of a single region .uwf image that erases and writes 'size' bytes """
+    if data is None:
+        data = bytes(random.getrandbits(8) for i in range(size))
+    bank_size = BENCH_SECTOR_SIZE * BENCH_SECTORS
+    image = uwf_command('T', struct.pack('<I', BENCH_PLATFORM_ID))
+    image += uwf_command('G', struct.pack('<BIBIB', 0, BENCH_BASE_ADDRESS, 1, bank_size, 1))
+    image += uwf_command('S', struct.pack('BB', 0, 0))
+    image += uwf_command('M', struct.pack('<II', BENCH_SECTORS, BENCH_SECTOR_SIZE))
+    image += uwf_command('E', struct.pack('<II', 0, size))
+    image += uwf_command('W', struct.pack('<II', 0, 0) + data)
+    image += uwf_command('U', struct.pack('B', 0))
+    return image
+
+def make_erase_image(size, erase_size, data=None):
+    """
+    Returns the bytes of a single region .uwf image that erases 'size' bytes with erase blocks of
+    'erase_size' bytes, which share sectors when they are not a multiple of the sector size
+    """
+    if data is None:
+        data = bytes(random.getrandbits(8) for i in range(size))
+    bank_size = BENCH_SECTOR_SIZE * BENCH_SECTORS
+    image = uwf_command('T', struct.pack('<I', BENCH_PLATFORM_ID))
+    image += uwf_command('G', struct.pack('<BIBIB', 0, BENCH_BASE_ADDRESS, 1, bank_size, 1))
+    image += uwf_command('S', struct.pack('BB', 0, 0))
+    image += uwf_command('M', struct.pack('<II', BENCH_SECTORS, BENCH_SECTOR_SIZE))
+    for offset in range(0, size, erase_size):
+        image += uwf_command('E', struct.pack('<II', offset, min(erase_size, size - offset)))
+    image += uwf_command('W', struct.pack('<II', 0, 0) + data)
+    image += uwf_command('U', struct.pack('B', 0))
+    return image
+
+def make_region_image(size, regions, data=None):
+    """
+    Returns the bytes of a .uwf image that writes 'size' bytes in 'regions' regions, each one
+    selecting the bank again with its own sector map, erase block and write commands
+    """
+    if data is None:
+        data = bytes(random.getrandbits(8) for i in range(size))
+    bank_size = BENCH_SECTOR_SIZE * BENCH_SECTORS
+    region_size = -(-size // regions // BENCH_SECTOR_SIZE) * BENCH_SECTOR_SIZE
+    image = uwf_command('T', struct.pack('<I', BENCH_PLATFORM_ID))
+    image += uwf_command('G', struct.pack('<BIBIB', 0, BENCH_BASE_ADDRESS, 1, bank_size, 1))
+    for start in range(0, size, region_size):
+        end = min(size, start + region_size)
+        image += uwf_command('S', struct.pack('BB', 0, 0))
+        image += uwf_command('M', struct.pack('<II', BENCH_SECTORS, BENCH_SECTOR_SIZE))
+        image += uwf_command('E', struct.pack('<II', start, end - start))
+        for offset in range(start, end, BENCH_WRITE_SIZE):
+            image += uwf_command('W', struct.pack('<II', offset, 0) + data[offset:min(end, offset + BENCH_WRITE_SIZE)])
+    image += uwf_command('U', struct.pack('B', 0))
+    return image
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def bench_pipeline(image_path, size, baud, latency, windows, baud_ladder=None, max_baud=DEFAULT_MAX_BAUD):
+    print(f"Firmware download of {size} bytes at {baud} baud, {latency*1000:.1f}ms per command")
+    if baud_ladder:
+        print(f"Negotiating from {baud_ladder}, bootloader syncs up to {max_baud} baud")
+    print(f"{'window':>8} {'baud':>8} {'seconds':>9} {'bytes/s':>9} {'commands':>9} {'result':>7}")
+    for window in windows:
+        device = bench_loopback(baud, latency, max_baudrate=max_baud)
+        start = time.monotonic()
+        exit_code = uwfloader.loadfirmware(device, baud, image_path, 'GENERIC', pipeline_window=window,
+                                           baud_ladder=baud_ladder, journal_path=None, identity_path=None)
+        elapsed = time.monotonic() - start
+        print(f"{window:>8} {device.baudrate:>8} {elapsed:>9.3f} {size/elapsed:>9.0f} {device.commands:>9} {exit_code:>7}")
+    print(f"Wire limit for the data alone is {device.baudrate/10:.0f} bytes/s")
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def bench_emulator(image_path, size, baud, latency, windows):
+    print(f"Firmware download of {size} bytes over a pty at {baud} baud, {latency*1000:.1f}ms per command")
+    print(f"{'window':>8} {'seconds':>9} {'bytes/s':>9} {'commands':>9} {'trips/KB':>9} {'result':>7} {'matches':>8}")
+    data = make_image_data(image_path)
+    for window in windows:
+        model = uwfemu.BootloaderModel(((BENCH_SECTORS, BENCH_SECTOR_SIZE),), BENCH_BASE_ADDRESS, ats=BOOTLOADER_ATS)
+        emulator = uwfemu.BootloaderEmulator(model, 10.0 / baud, latency)
+        path = emulator.open_pty()
+        try:
+            exit_code = uwfloader.loadfirmware(path, baud, image_path, 'GENERIC',
+                                               pipeline_window=window, journal_path=None, identity_path=None)
+        finally:
+            emulator.stop()
+        # Time from the sync byte to the reboot, leaving out the wait for a reply to AT+FUP
+        elapsed = emulator.active_seconds()
+        matches = model.flash[:size] == data
+        print(f"{window:>8} {elapsed:>9.3f} {size/elapsed:>9.0f} {model.commands:>9} {emulator.round_trips*1024/size:>9.1f} {exit_code:>7} {str(matches):>8}")
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def bench_app(size, baud, latency, commands=100, files=32):
+    # Only this benchmark needs blutilc and the packages it imports
+    import blutilc
+    import sbemu
+    data = bytes(random.getrandbits(8) for i in range(size))
+    # (name, chunk size or 0 to probe, upload pipeline, AT+FWRH only)
+    configs = [('16 byte hex', 16, 1, True), ('probed', 0, 1, False), ('probed, pipeline 8', 0, 8, False)]
+    print(f"App upload of {size} bytes over a pty at {baud} baud, {latency*1000:.1f}ms per command")
+    print(f"{'upload':>20} {'seconds':>9} {'bytes/s':>9} {'commands':>9} {'matches':>8}")
+    for name, chunk, pipeline, hex_only in configs:
+        model = sbemu.ModuleModel(capacity=size)
+        emulator = uwfemu.BootloaderEmulator(model, 10.0 / baud, latency)
+        path = emulator.open_pty()
+        try:
+            device = blutilc.BLDevice(argparse.Namespace(port=path, baud=baud, chunk=chunk, upload_pipeline=pipeline,
+                                                         hex_only=hex_only, no_compile_cache=True,
+                                                         no_identity_cache=True))
+            start = time.monotonic()
+            device.upload_data('bench', data, pipeline)
+            elapsed = time.monotonic() - start
+            device.port.close()
+        finally:
+            emulator.stop()
+        print(f"{name:>20} {elapsed:>9.3f} {size/elapsed:>9.0f} {model.commands:>9} {str(model.files.get('bench') == data):>8}")
+
+    model = sbemu.ModuleModel()
+    for i in range(files):
+        model.files[f"app{i}"] = b''
+    emulator = uwfemu.BootloaderEmulator(model, 10.0 / baud, latency)
+    path = emulator.open_pty()
+    try:
+        device = blutilc.BLDevice(argparse.Namespace(port=path, baud=baud, no_compile_cache=True,
+                                                     no_identity_cache=True))
+        for name, command in [('AT I 0', 'I 0'), (f"AT+DIR of {files}", '+DIR')]:
+            start = time.monotonic()
+            for i in range(commands):
+                device.writecmd(command)
+            elapsed = time.monotonic() - start
+            print(f"{name:>20} {commands/elapsed:>9.1f} commands/s")
+        script = [(i + 1, f"AT+CFG {100 + i} {i}") for i in range(BENCH_CFG_COMMANDS)]
+        for pipeline in [1, 8]:
+            start = time.monotonic()
+            results = device.batch(script, pipeline)
+            elapsed = time.monotonic() - start
+            ok = all([result['ok'] for result in results]) and len(results) == len(script)
+            name = f"batch, pipeline {pipeline}"
+            print(f"{name:>20} {elapsed:>9.3f} seconds for {len(script)} AT+CFG, all ok {ok}")
+        device.port.close()
+    finally:
+        emulator.stop()
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def make_image_data(image_path):
+    """ Returns the data written by the last write command of an image from make_image """
+    with uwf_image.UwfImage(image_path) as image:
+        writes = [command for command in image if command.cmd == uwf_image.UWF_COMMAND_WRITE]
+        return bytes(writes[-1].payload[uwf_image.UWF_WRITE_BLOCK_LENGTH:])
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def bench_delta(image_path, size, baud, latency, window):
+    """ Flashes the image, then an update with one changed byte, with and without delta mode """
+    with open(image_path, 'rb') as f:
+        image = f.read()
+    changed = bytearray(image)
+    changed[len(image) // 2] ^= 0xFF
+    fd, changed_path = tempfile.mkstemp(suffix='.uwf')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(changed)
+
+    print(f"Re-flash of {size} bytes with one byte changed at {baud} baud, {latency*1000:.1f}ms per command")
+    print(f"{'delta':>8} {'seconds':>9} {'commands':>9} {'result':>7} {'matches':>8}")
+    try:
+        for delta in (False, True):
+            device = bench_loopback(baud, latency)
+            uwfloader.loadfirmware(device, baud, image_path, 'GENERIC', pipeline_window=window,
+                                   journal_path=None, identity_path=None)
+            device.commands = 0
+            start = time.monotonic()
+            exit_code = uwfloader.loadfirmware(device, baud, changed_path, 'GENERIC',
+                                               pipeline_window=window, delta=delta, journal_path=None, identity_path=None)
+            elapsed = time.monotonic() - start
+            data = changed[-size-uwf_image.UWF_COMMAND_HEADER_LENGTH-1:-uwf_image.UWF_COMMAND_HEADER_LENGTH-1]
+            matches = device.flash[BENCH_BASE_ADDRESS:BENCH_BASE_ADDRESS+size] == data
+            print(f"{str(delta):>8} {elapsed:>9.3f} {device.commands:>9} {exit_code:>7} {str(matches):>8}")
+    finally:
+        os.remove(changed_path)
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def bench_erase(size, baud, latency, erase_time, window):
+    """ Times the erase phase of an image whose erase blocks are 1.5 sectors each """
+    erase_size = BENCH_SECTOR_SIZE * 3 // 2
+    data = bytes(random.getrandbits(8) for i in range(size))
+    fd, image_path = tempfile.mkstemp(suffix='.uwf')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(make_erase_image(size, erase_size, data))
+
+    print(f"Erase of {size} bytes in {erase_size} byte erase blocks at {baud} baud, {erase_time*1000:.0f}ms per sector erase")
+    print(f"{'erase':>24} {'erase s':>9} {'total s':>9} {'e cmds':>7} {'v cmds':>7} {'result':>7} {'matches':>8}")
+    # (name, pipeline window, skip blank sectors, flash the image first so no sector is blank)
+    configs = [('one at a time', 0, False, False), (f"pipeline {window}", window, False, False),
+               (f"pipeline {window}, blank", window, True, False), (f"pipeline {window}, not blank", window, True, True)]
+    try:
+        for name, pipeline, skip_blank, programmed in configs:
+            device = bench_loopback(baud, latency, erase_time=erase_time)
+            if programmed:
+                uwfloader.loadfirmware(device, baud, image_path, 'GENERIC', pipeline_window=window,
+                                       journal_path=None, identity_path=None)
+            device.model.counts.clear()
+            stats = uwf_stats.UwfStats()
+            start = time.monotonic()
+            exit_code = uwfloader.loadfirmware(device, baud, image_path, 'GENERIC', pipeline_window=pipeline,
+                                               journal_path=None, identity_path=None, observer=stats, skip_blank=skip_blank)
+            elapsed = time.monotonic() - start
+            totals = stats.phase_totals()
+            erase_seconds = sum([totals[phase]['seconds'] for phase in ('erase_check', 'erase') if phase in totals])
+            matches = device.flash[:size] == data
+            print(f"{name:>24} {erase_seconds:>9.3f} {elapsed:>9.3f} {device.model.counts['e']:>7} {device.model.counts['v']:>7} {exit_code:>7} {str(matches):>8}")
+    finally:
+        os.remove(image_path)
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def bench_schedule(size, baud, latency, erase_time, window):
+    """ Times an image of BENCH_REGIONS regions sent command by command and as one scheduled stream """
+    data = bytes(random.getrandbits(8) for i in range(size))
+    fd, image_path = tempfile.mkstemp(suffix='.uwf')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(make_region_image(size, BENCH_REGIONS, data))
+
+    print(f"Download of {size} bytes in {BENCH_REGIONS} regions at {baud} baud, {latency*1000:.1f}ms per command, {erase_time*1000:.0f}ms per sector erase")
+    print(f"{'mode':>24} {'seconds':>9} {'bytes/s':>9} {'idle s':>9} {'overlaps':>9} {'result':>7} {'matches':>8}")
+    configs = [('one at a time', 0, False), (f"pipeline {window}", window, False), (f"pipeline {window}, scheduled", window, True)]
+    try:
+        for name, pipeline, schedule in configs:
+            device = bench_loopback(baud, latency, erase_time=erase_time)
+            stats = uwf_stats.UwfStats()
+            start = time.monotonic()
+            exit_code = uwfloader.loadfirmware(device, baud, image_path, 'GENERIC', pipeline_window=pipeline,
+                                               journal_path=None, identity_path=None, observer=stats, schedule=schedule)
+            elapsed = time.monotonic() - start
+            overlap = stats.phase_totals().get('overlap', {'count': 0, 'seconds': 0.0})
+            matches = device.flash[:size] == data
+            print(f"{name:>24} {elapsed:>9.3f} {size/elapsed:>9.0f} {overlap['seconds']:>9.3f} {overlap['count']:>9} {exit_code:>7} {str(matches):>8}")
+    finally:
+        os.remove(image_path)
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def legacy_checksums(data, block_size):
+    """ The per byte struct.unpack loop that process_command_write_blocks used to run """
+    checksums = []
+    for pos in range(0, len(data), block_size):
+        block = data[pos:pos+block_size]
+        i = 0
+        checksum = 0
+        while i < len(block):
+            checksum += struct.unpack('B', block[i:i+1])[0]
+            i += 1
+        checksums.append(checksum)
+    return checksums
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def bench_checksum(size):
+    data = bytes(random.getrandbits(8) for i in range(size))
+    block_size = uwf_processor.DATA_BLOCK_SIZE
+    megabytes = size / (1024 * 1024)
+    print(f"Checksums of {size} bytes in blocks of {block_size}, numpy {'available' if uwf_checksum.numpy else 'not available'}")
+    print(f"{'method':>16} {'cpu secs':>9} {'cpu ms/MB':>10}")
+    methods = [('struct loop', legacy_checksums), ('block_checksums', uwf_checksum.block_checksums)]
+    expected = None
+    for name, method in methods:
+        start = time.process_time()
+        checksums = method(data, block_size)
+        elapsed = time.process_time() - start
+        if expected is None:
+            expected = checksums
+        elif checksums != expected:
+            print(f"{name} does not match the struct loop")
+        print(f"{name:>16} {elapsed:>9.3f} {elapsed*1000/megabytes:>10.1f}")
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def setup_arg_parser():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the firmware download engine against a simulated bootloader.')
+    parser.add_argument('bench', nargs='?', choices=['pipeline', 'checksum', 'delta', 'erase', 'schedule', 'emulator', 'app'], default='pipeline',
+                        help="Benchmark to run, default=pipeline")
+    parser.add_argument('--size', type=int, default=DEFAULT_IMAGE_KB, metavar="KB",
+                        help=f"Size of the synthetic firmware image, default={DEFAULT_IMAGE_KB}")
+    parser.add_argument('--baud', type=int, default=DEFAULT_BAUD,
+                        help=f"Simulated line rate, default={DEFAULT_BAUD}")
+    parser.add_argument('--latency', type=float, default=DEFAULT_LATENCY, metavar="SECS",
+                        help=f"Simulated processing time per command, default={DEFAULT_LATENCY}")
+    parser.add_argument('--windows', default=DEFAULT_WINDOWS, metavar="N,..",
+                        help=f"Pipeline windows to compare, 0 is stop-and-wait, default={DEFAULT_WINDOWS}")
+    parser.add_argument('--fast', metavar="RATES",
+                        help="Negotiate the download rate from a comma separated list")
+    parser.add_argument('--max-baud', type=int, default=DEFAULT_MAX_BAUD, metavar="BAUD",
+                        help=f"Fastest rate the simulated bootloader syncs at, default={DEFAULT_MAX_BAUD}")
+    parser.add_argument('--erase-time', type=float, default=DEFAULT_ERASE_TIME, metavar="SECS",
+                        help=f"Simulated time to erase one sector, default={DEFAULT_ERASE_TIME}")
+    return parser
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def main():
+    parser=setup_arg_parser()
+    args = parser.parse_args()
+    uwf_processor.VERBOSELEVEL=VERBOSELEVEL
+    size = args.size * 1024
+    windows = [int(w) for w in args.windows.split(',')]
+
+    if args.bench == 'checksum':
+        bench_checksum(size)
+        return
+    if args.bench == 'app':
+        bench_app(size, args.baud, args.latency)
+        return
+    if args.bench == 'erase':
+        bench_erase(size, args.baud, args.latency, args.erase_time, windows[-1])
+        return
+    if args.bench == 'schedule':
+        bench_schedule(size, args.baud, args.latency, args.erase_time, windows[-1])
+        return
+
+    fd, image_path = tempfile.mkstemp(suffix='.uwf')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(make_image(size))
+        if args.bench == 'delta':
+            bench_delta(image_path, size, args.baud, args.latency, windows[-1])
+            return
+        if args.bench == 'emulator':
+            bench_emulator(image_path, size, args.baud, args.latency, windows)
+            return
+        baud_ladder = uwfloader.parse_baud_ladder(args.fast) if args.fast else None
+        bench_pipeline(image_path, size, args.baud, args.latency, windows, baud_ladder, args.max_baud)
+    finally:
+        os.remove(image_path)
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+if __name__ == "__main__":
+    main()
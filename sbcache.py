@@ -0,0 +1,72 @@
+##########################################################################################
+# Content addressed cache of compiled smartBASIC applications
+##########################################################################################
+import hashlib
+import os
+import shutil
+from sbstore import replace_file, STORE_DIR
+
+CACHE_DIR = os.path.join(STORE_DIR, 'compile_cache')
+CACHE_SIZE_LIMIT = 32 * 1024 * 1024     #bytes of .uwc files kept before the least recently used go
+
+class CompileCache():
+    """
+    Keeps .uwc files named by the hash of everything that decides the compiler output,
+    the include expanded source, the module model, its language hashes and the compiler,
+    so the same application is only compiled once however many devices it goes to
+    """
+    def __init__(self, directory=CACHE_DIR, size_limit=CACHE_SIZE_LIMIT):
+        self.directory = directory
+        self.size_limit = size_limit
+
+    @staticmethod
+    def make_key(source, model, langhash, compiler_id):
+        sha = hashlib.sha256()
+        for part in [model, langhash[0], langhash[1], compiler_id]:
+            sha.update(part.encode('utf-8'))
+            sha.update(b'\0')
+        sha.update(source if isinstance(source, bytes) else source.encode('utf-8'))
+        return sha.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.uwc")
+
+    def fetch(self, key, uwc_path):
+        """
+        Copies the cached .uwc for 'key' to 'uwc_path' and returns True, or returns False on a miss
+        """
+        path = self.path(key)
+        try:
+            shutil.copyfile(path, uwc_path)
+            # the modification time orders entries for eviction
+            os.utime(path)
+        except OSError:
+            return False
+        return True
+
+    def store(self, key, uwc_path):
+        if replace_file(self.path(key), lambda temp_path: shutil.copyfile(uwc_path, temp_path), 'Compile cache'):
+            self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in its size limit
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.uwc'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue    #removed by another process
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum([entry[1] for entry in entries])
+        for mtime, size, name in sorted(entries):
+            if total <= self.size_limit:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
@@ -0,0 +1,423 @@
+#!/usr/bin/env python3
+"""
+This is a long running service that keeps Laird "SmartBASIC" modules open in command mode
+and serves the operations of sbutil.py to clients over a Unix socket, so that a CI job
+calling the tool many times pays for opening, resetting and identifying a module once.
+
+Usage: python3 sbdaemon.py [options]
+       options
+           --socket PATH     Unix socket to listen on, default ~/.sbutil/sbdaemon.sock
+           -b BAUD           baud rate of ports a request does not give one for, default 115200
+           -n, --no-break    do not reset modules with DTR and BREAK, only use them if already in command mode
+           --idle SECS       close ports not used for SECS seconds, 0 keeps them open, default 600
+           -v                print each request
+
+Clients are sbutil.py with --daemon, e.g.
+    python3 sbutil.py --daemon ~/.sbutil/sbdaemon.sock -p /dev/ttyUSB0 -r app.sb
+
+Each request is one JSON object on a line of its own, answered by one JSON object on a line,
+and a connection can carry any number of them:
+    {"op": "send", "port": "/dev/ttyUSB0", "command": "AT I 3"}
+    {"ok": true, "output": "10\\t3\\t29.4.6.0"}
+The ops are info, send, ls, rm, format, compile, upload, run, firmware, status and close,
+see Daemon.op_*. File paths are read by the daemon, so they are made absolute by the client.
+
+A port is opened, reset into command mode and kept open at its first request. Each later
+request first checks with an AT that the module is still in command mode and only resets
+it if it is not. The model, version and language hashes from AT I 0, 3 and 13 are asked for
+once and kept until a firmware download. The requests of one port run one after another,
+those of different ports run at the same time on one asyncio event loop.
+"""
+
+#-----------------------------------------------------------------------------
+# constants
+#-----------------------------------------------------------------------------
+
+VERBOSELEVEL=0
+DEFAULT_IDLE_SEC=600        #ports unused for this long are closed so that other tools can open them
+CHECK_TIMEOUT_SEC=0.5       #time the module has to answer the AT sent before each request
+
+#-----------------------------------------------------------------------------
+# Module imports
+#-----------------------------------------------------------------------------
+import blutilc
+import sbasync
+import uwf_processor
+import uwfloader
+import argparse
+import asyncio
+import errno
+import json
+import os
+import signal
+import socket
+import sys
+import time
+import serial
+
+SOCKET_PATH = os.path.join(os.path.expanduser('~'), '.sbutil', 'sbdaemon.sock')
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class DaemonError(Exception):
+    pass
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class DeviceSession(object):
+    """ A module kept open in command mode, with its identity once asked for """
+    def __init__(self, args, name, baudrate):
+        self.args = args
+        self.name = name
+        self.baudrate = baudrate
+        self.device = None
+        self.identity = None    #{'model', 'version', 'langhash'} from AT I 0, 3 and 13
+        self.upload_options = None  #(chunk, upload_pipeline, hex_only) the device was set up with
+        self.lock = asyncio.Lock()
+        self.last_used = time.monotonic()
+        self.requests = 0
+        self.resets = 0
+
+    async def ready(self, baudrate=None):
+        """ Opens the port if needed and makes sure the module is in command mode """
+        if baudrate is not None and baudrate != self.baudrate:
+            self.baudrate = baudrate
+            if self.device is not None:
+                self.device.port.baudrate = baudrate
+        if self.device is None:
+            self.device = sbasync.AsyncBLDevice(self.args, sbasync.AsyncSerial(self.name, self.baudrate))
+            self.upload_options = None
+        else:
+            try:
+                await self.device.writecmd('', timeout=CHECK_TIMEOUT_SEC)
+                return
+            except blutilc.RuntimeError:
+                # Running an app or part way through a response
+                self.device.reader.reset()
+        if self.args.no_break:
+            await self.device.writecmd('')
+        else:
+            self.resets += 1
+            await self.device.reset_into_cmd_mode()
+
+    async def identify(self):
+        """ Returns the identity of the module, asking it only the first time """
+        if self.identity is None:
+            await self.device.detect_model()
+            self.identity = {'model': self.device.model, 'version': self.device.version,
+                             'langhash': ' '.join(self.device.langhash)}
+        return self.identity
+
+    def upload_with(self, request):
+        """
+        Sets the device up with the app upload options of 'request', those of sbutil.py
+        What it learnt about the module's file writes is kept while the options stay the same
+        """
+        options = (request.get('chunk', 0), request.get('upload_pipeline', blutilc.UPLOAD_PIPELINE),
+                   request.get('hex_only', False))
+        if options != self.upload_options:
+            chunk, self.device.upload_pipeline, hex_only = options
+            self.device.upload_sizes = [chunk] if chunk else list(blutilc.UPLOAD_CHUNK_SIZES)
+            self.device.upload_fwr = not hex_only
+            self.upload_options = options
+
+    def forget(self):
+        """ Drops the identity, e.g. after new firmware, so that it is asked for again """
+        self.identity = None
+
+    def close(self):
+        if self.device is not None:
+            self.device.close()
+            self.device = None
+        self.forget()
+
+    def status(self):
+        return {'port': self.name, 'baud': self.baudrate, 'open': self.device is not None,
+                'identity': self.identity, 'requests': self.requests, 'resets': self.resets,
+                'idle': round(time.monotonic() - self.last_used, 1)}
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class Daemon(object):
+    """
+    Serves requests from clients on a Unix socket, keeping a DeviceSession per port
+    'args' are the daemon's options, also passed to sbasync.AsyncBLDevice, the app upload
+    options come with each request
+    """
+    def __init__(self, args):
+        self.args = args
+        self.sessions = {}
+
+    def session(self, request):
+        name = request.get('port')
+        if not name:
+            raise DaemonError("Request has no port")
+        if name not in self.sessions:
+            self.sessions[name] = DeviceSession(self.args, name, request.get('baud') or self.args.baud)
+        return self.sessions[name]
+
+    async def handle(self, request):
+        """ Runs one request and returns its response """
+        op = request.get('op')
+        handler = getattr(self, f"op_{op}", None) if isinstance(op, str) else None
+        if handler is None:
+            return {'ok': False, 'error': f"Unknown op {op!r}"}
+        if self.args.verbose:
+            print(f"{request.get('port', '-')}: {op}", flush=True)
+        if op in ('status', 'close'):
+            return dict({'ok': True}, **await handler(None, request))
+        session = self.session(request)
+        async with session.lock:
+            session.last_used = time.monotonic()
+            session.requests += 1
+            try:
+                await session.ready(request.get('baud'))
+                response = dict({'ok': True}, **await handler(session, request))
+            except serial.SerialException as e:
+                # Unplugged or taken by another program, open it afresh next time
+                session.close()
+                response = {'ok': False, 'error': str(e)}
+            except (blutilc.RuntimeError, DaemonError, IOError) as e:
+                response = {'ok': False, 'error': str(e)}
+            session.last_used = time.monotonic()
+        return response
+
+    async def op_info(self, session, request):
+        return {'identity': await session.identify()}
+
+    async def op_send(self, session, request):
+        timeout = request.get('timeout', blutilc.SERIAL_TIMEOUT)
+        return {'output': await session.device.writerawcmd(f"{request['command']}\r", timeout=timeout)}
+
+    async def op_ls(self, session, request):
+        return {'output': await session.device.list()}
+
+    async def op_rm(self, session, request):
+        await session.device.delete(request['file'])
+        return {}
+
+    async def op_format(self, session, request):
+        await session.device.format()
+        return {}
+
+    async def op_compile(self, session, request):
+        """ Compiles the .sb 'file' for this module, with the identity it reported before """
+        await session.identify()
+        await session.device.compile(request['file'])
+        return {'file': blutilc.to_uwc(request['file'])}
+
+    async def op_upload(self, session, request):
+        """ Uploads 'file', compiling it first if it is a .sb file """
+        filepath = request['file']
+        if os.path.splitext(filepath)[1] == ".sb":
+            await self.op_compile(session, request)
+        session.upload_with(request)
+        await session.device.upload(filepath)
+        return {'app': blutilc.get_sbappname(filepath)}
+
+    async def op_run(self, session, request):
+        """
+        Runs 'file', uploading it first if it is a .sb or .uwc file as sbutil.py -r does, and
+        returns what it printed within 'timeout' seconds
+        """
+        filepath = request['file']
+        if os.path.splitext(filepath)[1] in (".sb", ".uwc"):
+            await self.op_upload(session, request)
+        error, output = await session.device.run(filepath, request.get('timeout', 1.0))
+        if error:
+            errorcode = str(output[len(blutilc.RESPONSE_ERROR):-1].decode())
+            raise DaemonError("Error %s: %s" % (errorcode, blutilc.get_errordesc(errorcode)))
+        if error is False:
+            output = output[:-len(blutilc.RESPONSE_OK)].rstrip(b'\n')
+        return {'output': output.decode('utf-8', 'replace'), 'running': error is None}
+
+    async def op_firmware(self, session, request):
+        """
+        Downloads the .uwf 'file' over the open port with sbasync.loadfirmware, the options
+        are those of sbutil.py
+        The loader closes the port once the module reboots, so it is opened again at the next
+        request, and the identity is asked for again as the version changes
+        """
+        ladder = request.get('fast')
+        port = session.device.port
+        try:
+            exit_code = await sbasync.loadfirmware(port, session.baudrate, request['file'], request.get('module'),
+                                                   pipeline_window=request.get('pipeline', uwf_processor.PIPELINE_WINDOW),
+                                                   baud_ladder=uwfloader.parse_baud_ladder(ladder) if ladder else None,
+                                                   delta=request.get('delta', False), resume=request.get('resume', False),
+                                                   adaptive=request.get('adaptive', False),
+                                                   skip_blank=request.get('skip_blank', False),
+                                                   schedule=request.get('schedule', False))
+        finally:
+            session.close()
+        if exit_code != uwfloader.EXIT_CODE_SUCCESS:
+            return {'ok': False, 'exit_code': exit_code, 'error': f"Firmware download failed: {errno.errorcode.get(exit_code, exit_code)}"}
+        return {'exit_code': exit_code}
+
+    async def op_status(self, session, request):
+        return {'sessions': [session.status() for session in self.sessions.values()]}
+
+    async def op_close(self, session, request):
+        """ Closes 'port', or every port if none is given, so that other tools can open them """
+        names = [request['port']] if request.get('port') else list(self.sessions)
+        for name in names:
+            if name in self.sessions:
+                async with self.sessions[name].lock:
+                    self.sessions.pop(name).close()
+        return {'closed': names}
+
+    async def serve_client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if len(line) == 0:
+                    break
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError("Request is not a JSON object")
+                    response = await self.handle(request)
+                except (ValueError, KeyError, DaemonError) as e:
+                    response = {'ok': False, 'error': f"Bad request: {e}"}
+                writer.write((json.dumps(response) + '\n').encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def close_idle(self, idle):
+        while True:
+            await asyncio.sleep(min(idle, 10))
+            now = time.monotonic()
+            for name, session in list(self.sessions.items()):
+                if not session.lock.locked() and now - session.last_used > idle:
+                    if self.args.verbose:
+                        print(f"{name}: closed after {idle}s idle", flush=True)
+                    self.sessions.pop(name).close()
+
+    async def run(self, path):
+        if os.path.exists(path):
+            # Left behind by a daemon that did not exit cleanly, unless one is still serving it
+            try:
+                request(path, {'op': 'status'})
+                raise DaemonError(f"A daemon is already serving {path}")
+            except (ConnectionError, FileNotFoundError):
+                os.remove(path)
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        server = await asyncio.start_unix_server(self.serve_client, path)
+        os.chmod(path, 0o600)
+        idle = asyncio.ensure_future(self.close_idle(self.args.idle)) if self.args.idle > 0 else None
+        stop = asyncio.get_running_loop().create_future()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            asyncio.get_running_loop().add_signal_handler(signum, lambda: stop.done() or stop.set_result(None))
+        print(f"Serving on {path}", flush=True)
+        try:
+            async with server:
+                await stop
+        finally:
+            if idle is not None:
+                idle.cancel()
+            for session in self.sessions.values():
+                session.close()
+            if os.path.exists(path):
+                os.remove(path)
+
+#-----------------------------------------------------------------------------
+# Client side, used by sbutil.py --daemon
+#-----------------------------------------------------------------------------
+def request(path, message):
+    """ Sends one request to the daemon on the Unix socket 'path' and returns its response """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall((json.dumps(message) + '\n').encode())
+        with sock.makefile('rb') as f:
+            line = f.readline()
+    if len(line) == 0:
+        raise ConnectionError(f"{path} closed the connection without a response")
+    return json.loads(line)
+
+def request_from_args(args):
+    """ Returns the request that does what the sbutil.py options in 'args' ask for """
+    base = {'port': args.port, 'baud': args.baud}
+    upload = {'chunk': args.chunk, 'upload_pipeline': args.upload_pipeline, 'hex_only': args.hex_only}
+    if args.firmware:
+        return dict(base, op='firmware', file=os.path.abspath(args.firmware), module=args.module,
+                    pipeline=args.pipeline, fast=args.fast, delta=args.delta, resume=args.resume,
+                    adaptive=args.adaptive, skip_blank=args.skip_blank, schedule=args.schedule)
+    if args.send:
+        return dict(base, op='send', command=args.send, timeout=args.timeout)
+    if args.ls:
+        return dict(base, op='ls')
+    if args.rm:
+        return dict(base, op='rm', file=args.rm)
+    if args.format:
+        return dict(base, op='format')
+    if args.compile:
+        return dict(base, op='compile', file=os.path.abspath(args.compile))
+    if args.load:
+        return dict(base, op='upload', file=os.path.abspath(args.load), **upload)
+    if args.run:
+        return dict(base, op='run', file=os.path.abspath(args.run), **upload)
+    raise DaemonError("Only --firmware, --send, --ls, --rm, --format, --compile, --load and --run are served by the daemon")
+
+def client_main(args):
+    """ Runs what sbutil.py was asked to do through the daemon at args.daemon, returns the exit status """
+    try:
+        message = request_from_args(args)
+        response = request(os.path.expanduser(args.daemon), message)
+    except DaemonError as e:
+        print(e)
+        return 2
+    except (ConnectionError, FileNotFoundError) as e:
+        print(f"No daemon on {args.daemon}: {e}")
+        return 3
+    if not response.get('ok'):
+        print(response.get('error'))
+        return response.get('exit_code', errno.EPERM) if message['op'] == 'firmware' else 2
+    if response.get('output'):
+        print(response['output'])
+    if message['op'] == 'send':
+        print("Command completed")
+    elif message['op'] == 'run' and response.get('running'):
+        print("No immediate output, program probably running...")
+    return 0
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def setup_arg_parser():
+    parser = argparse.ArgumentParser(
+        description='Keep Laird modules open in command mode and serve sbutil.py --daemon clients over a Unix socket.')
+    parser.add_argument('--socket', default=SOCKET_PATH, metavar="PATH", help=f"Unix socket to listen on, default={SOCKET_PATH}")
+    parser.add_argument('-b', '--baud', type=int, default=blutilc.SERIAL_DEF_BAUD,
+                        help=f"Baud rate of ports a request gives none for, default={blutilc.SERIAL_DEF_BAUD}")
+    parser.add_argument('-n', '--no-break', action="store_true", help="Do not reset modules with DTR and BREAK")
+    parser.add_argument('--idle', type=float, default=DEFAULT_IDLE_SEC, metavar="SECS",
+                        help=f"Close ports not used for SECS seconds, 0 keeps them open, default={DEFAULT_IDLE_SEC}")
+    parser.add_argument('-v', '--verbose', action="store_true", help="Print each request")
+    parser.add_argument('--no-compile-cache', action="store_true",
+                        help="Always compile, do not reuse or keep .uwc files in the compile cache")
+    # Each session keeps the identity of its module, so the ~/.sbutil cache is not used as well
+    parser.set_defaults(no_identity_cache=True)
+    return parser
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def main():
+    parser=setup_arg_parser()
+    args = parser.parse_args()
+    try:
+        asyncio.run(Daemon(args).run(os.path.expanduser(args.socket)))
+    except KeyboardInterrupt:
+        pass
+    except DaemonError as e:
+        print(e)
+        return 2
+    return 0
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+if __name__ == "__main__":
+    sys.exit(main())
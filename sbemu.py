@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+This is a stand-in for a Laird smartBASIC module in interactive mode, for testing and benchmarking
+app uploads and AT commands without hardware.
+
+Usage: python3 sbemu.py [options]
+       options
+           --tcp PORT          listen on a TCP port instead of creating a pseudo terminal
+           --model NAME        reported by AT I 0, default BL654
+           --version TEXT      reported by AT I 3, default 29.4.6.0
+           --langhash "A B"    language hashes reported by AT I 13, default "9E56 5F81"
+           --max-write N       most bytes one AT+FWR/AT+FWRH may write, default 128
+           --no-fwr            reject AT+FWR so that uploads must use AT+FWRH
+           --byte-delay SECS   time each byte spends on the line, default 10/115200
+           --latency SECS      processing time per command, default 0.002
+
+Supported commands are AT, AT I n, AT+CFG n value, AT+CFG n ?, AT+DIR, AT+DEL "name" [+],
+AT+FOW "name", AT+FWRH "hex", AT+FWR "string", AT+FCL, AT+RUN "name" and AT&F 1, answered
+with the module's own "\\n00\\r" and "\\n01\\t<hex code>\\r" framing. Files and config keys
+live in memory only. AT+RUN does not run anything, it answers as an app that ends without
+output would.
+
+A pseudo terminal cannot drive DTR or BREAK, so use sbutil.py with -n/--no-break, e.g.
+    python3 sbutil.py -p /dev/pts/5 -n --ls
+"""
+
+#-----------------------------------------------------------------------------
+# constants
+#-----------------------------------------------------------------------------
+
+DEFAULT_MODEL='BL654'
+DEFAULT_VERSION='29.4.6.0'
+DEFAULT_LANGHASH='9E56 5F81'
+DEFAULT_MAX_WRITE=128
+DEFAULT_CAPACITY=64*1024    #bytes of file data the filesystem holds
+
+# Error codes, as listed in codes.csv
+ERROR_SYNTAX_ERROR=0xE005
+ERROR_UNKNOWN_COMMAND=0xE007
+ERROR_PARM_OUT_OF_RANGE=0xE001
+ERROR_INCORRECT_MODE=0xE00E
+ERROR_MEDIA_FULL=0xE010
+ERROR_FILE_MISSING=0xE018
+ERROR_CONST_TRUNCATION=0xE021
+ERROR_NO_FILE_TO_CLOSE=0xE037
+ERROR_FILE_NOT_OPEN=0xE038
+
+#-----------------------------------------------------------------------------
+# Module imports
+#-----------------------------------------------------------------------------
+import uwfemu
+import argparse
+import collections
+import re
+import time
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class ModuleError(Exception):
+    def __init__(self, code):
+        Exception.__init__(self, f"{code:04X}")
+        self.code = code
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class ModuleModel(object):
+    """
+    The interactive mode AT commands of a smartBASIC module and an in-memory filesystem
+    Served by uwfemu.BootloaderEmulator, which only needs frame_length, handle and times_frame
+    """
+    def __init__(self, model=DEFAULT_MODEL, version=DEFAULT_VERSION, langhash=DEFAULT_LANGHASH,
+                 max_write=DEFAULT_MAX_WRITE, fwr=True, capacity=DEFAULT_CAPACITY, format_delay=0.0):
+        self.info = {0: model, 3: version, 13: langhash}
+        self.config = {}
+        self.max_write = max_write
+        self.fwr = fwr
+        self.capacity = capacity
+        self.format_delay = format_delay
+        self.files = collections.OrderedDict()
+        self.open_name = None
+        self.open_data = None
+        self.commands = 0
+        self.counts = collections.Counter()
+        self.faults = 0
+        self.handlers = [
+            (re.compile(r'I\s+(\d+)$'), self.info_command),
+            (re.compile(r'\+CFG\s+(\d+)\s+(\S+)$'), self.cfg_command),
+            (re.compile(r'\+DIR$'), self.dir_command),
+            (re.compile(r'\+DEL\s+"([^"]*)"(\s*\+)?$'), self.del_command),
+            (re.compile(r'\+FOW\s+"([^"]*)"$'), self.fow_command),
+            (re.compile(r'\+FWRH\s+"(.*)"$'), self.fwrh_command),
+            (re.compile(r'\+FWR\s+"(.*)"$'), self.fwr_command),
+            (re.compile(r'\+FCL$'), self.fcl_command),
+            (re.compile(r'\+RUN\s+"([^"]*)"$'), self.run_command),
+            (re.compile(r'&F\s*1$'), self.format_command),
+        ]
+
+    def frame_length(self, rx):
+        end = rx.find(b'\r')
+        return end + 1 if end >= 0 else 0
+
+    def times_frame(self, frame):
+        return True
+
+    def handle(self, frame):
+        """ Executes one command line and returns the response bytes """
+        line = frame[:-1].decode('latin-1').strip()
+        self.commands += 1
+        if not line.upper().startswith('AT'):
+            # Not a command, interactive mode ignores it
+            return b''
+        command = line[2:].strip()
+        try:
+            if command == '':
+                return b'\n00\r'
+            for pattern, handler in self.handlers:
+                match = pattern.match(command)
+                if match is not None:
+                    self.counts[command.split()[0].split('"')[0]] += 1
+                    return f"{handler(*match.groups())}\n00\r".encode('latin-1')
+            raise ModuleError(ERROR_UNKNOWN_COMMAND)
+        except ModuleError as e:
+            self.faults += 1
+            return f"\n01\t{e.code:04X}\r".encode('latin-1')
+
+    def info_command(self, param):
+        if int(param) not in self.info:
+            raise ModuleError(ERROR_PARM_OUT_OF_RANGE)
+        return f"\n10\t{param}\t{self.info[int(param)]}\r"
+
+    def cfg_command(self, key, value):
+        if value == '?':
+            value = self.config.get(int(key), 0)
+            return f"\n27\t{key}\t{value} (0x{value:08X})\r"
+        try:
+            self.config[int(key)] = int(value, 0)
+        except ValueError:
+            raise ModuleError(ERROR_SYNTAX_ERROR)
+        return ''
+
+    def dir_command(self):
+        return ''.join([f"\n06\t{name}\r" for name in self.files])
+
+    def del_command(self, name, force):
+        if name == self.open_name:
+            raise ModuleError(ERROR_INCORRECT_MODE)
+        if name not in self.files and not force:
+            raise ModuleError(ERROR_FILE_MISSING)
+        self.files.pop(name, None)
+        return ''
+
+    def fow_command(self, name):
+        if self.open_name is not None:
+            raise ModuleError(ERROR_INCORRECT_MODE)
+        self.open_name = name
+        self.open_data = bytearray()
+        return ''
+
+    def write(self, data):
+        if self.open_name is None:
+            raise ModuleError(ERROR_FILE_NOT_OPEN)
+        if len(data) > self.max_write:
+            raise ModuleError(ERROR_CONST_TRUNCATION)
+        used = sum([len(contents) for contents in self.files.values()]) + len(self.open_data)
+        if used + len(data) > self.capacity:
+            raise ModuleError(ERROR_MEDIA_FULL)
+        self.open_data += data
+        return ''
+
+    def fwrh_command(self, text):
+        try:
+            data = bytes.fromhex(text)
+        except ValueError:
+            raise ModuleError(ERROR_SYNTAX_ERROR)
+        return self.write(data)
+
+    def fwr_command(self, text):
+        if not self.fwr:
+            raise ModuleError(ERROR_UNKNOWN_COMMAND)
+        data = bytearray()
+        pos = 0
+        while pos < len(text):
+            if text[pos] == '\\':
+                try:
+                    data.append(int(text[pos+1:pos+3], 16))
+                except ValueError:
+                    raise ModuleError(ERROR_SYNTAX_ERROR)
+                pos += 3
+            else:
+                data.append(ord(text[pos]))
+                pos += 1
+        return self.write(data)
+
+    def fcl_command(self):
+        if self.open_name is None:
+            raise ModuleError(ERROR_NO_FILE_TO_CLOSE)
+        self.files[self.open_name] = bytes(self.open_data)
+        self.open_name = None
+        self.open_data = None
+        return ''
+
+    def run_command(self, name):
+        if name not in self.files:
+            raise ModuleError(ERROR_FILE_MISSING)
+        return ''
+
+    def format_command(self):
+        time.sleep(self.format_delay)
+        self.files.clear()
+        self.open_name = None
+        self.open_data = None
+        return ''
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def setup_arg_parser():
+    parser = argparse.ArgumentParser(
+        description='Emulate a smartBASIC module in interactive mode on a pseudo terminal or TCP socket.')
+    parser.add_argument('--tcp', type=int, metavar="PORT", help="Listen on a TCP port instead of a pty")
+    parser.add_argument('--model', default=DEFAULT_MODEL, help=f"Reported by AT I 0, default={DEFAULT_MODEL}")
+    parser.add_argument('--version', default=DEFAULT_VERSION, help=f"Reported by AT I 3, default={DEFAULT_VERSION}")
+    parser.add_argument('--langhash', default=DEFAULT_LANGHASH, metavar='"A B"',
+                        help=f"Language hashes reported by AT I 13, default={DEFAULT_LANGHASH}")
+    parser.add_argument('--max-write', type=int, default=DEFAULT_MAX_WRITE, metavar="N",
+                        help=f"Most bytes one file write may carry, default={DEFAULT_MAX_WRITE}")
+    parser.add_argument('--no-fwr', action="store_true", help="Reject AT+FWR so uploads must use AT+FWRH")
+    parser.add_argument('--byte-delay', type=float, default=uwfemu.DEFAULT_BYTE_DELAY, metavar="SECS",
+                        help=f"Line time per byte, default={uwfemu.DEFAULT_BYTE_DELAY:.7f}")
+    parser.add_argument('--latency', type=float, default=uwfemu.DEFAULT_LATENCY, metavar="SECS",
+                        help=f"Processing time per command, default={uwfemu.DEFAULT_LATENCY}")
+    return parser
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def main():
+    parser=setup_arg_parser()
+    args = parser.parse_args()
+    model = ModuleModel(args.model, args.version, args.langhash, args.max_write, not args.no_fwr)
+    emulator = uwfemu.BootloaderEmulator(model, args.byte_delay, args.latency)
+    if args.tcp is not None:
+        emulator.listen_tcp(args.tcp)
+    else:
+        emulator.open_pty()
+    print(f"smartBASIC module emulator on {emulator.path}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    emulator.stop()
+    print(f"{model.commands} commands {dict(model.counts)}, {model.faults} errors, {len(model.files)} files")
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+##########################################################################################
+# Cache of the identity that modules report to AT I 0, 3 and 13
+##########################################################################################
+import os
+import time
+from sbstore import JsonStore, STORE_DIR
+try:
+    from serial.tools import list_ports
+except ImportError:
+    list_ports = None
+
+IDENTITY_PATH = os.path.join(STORE_DIR, 'identity.json')
+IDENTITY_TTL = 3600     #seconds an identity is trusted for before the module is asked again
+
+def port_fingerprint(port):
+    """
+    Returns what tells the adapter on 'port' apart from another plugged into the same port, its
+    USB serial number or else its vendor, product and USB location, or None if it is not a USB
+    port, in which case nothing is cached for it
+    """
+    if list_ports is None or port is None:
+        return None
+    path = os.path.realpath(port)
+    for info in list_ports.comports():
+        if info.device in (port, path):
+            if info.serial_number:
+                return info.serial_number
+            if info.vid is not None:
+                return f"{info.vid:04X}:{info.pid:04X}:{info.location}"
+            return None
+    return None
+
+class IdentityCache(JsonStore):
+    """
+    Remembers the model, version and language hashes of the module on each port, keyed by the
+    port and its port_fingerprint so that a different adapter on the same port is asked afresh
+    Entries expire after 'ttl' seconds and are removed by a firmware download to the port
+    """
+    def __init__(self, path=IDENTITY_PATH, ttl=IDENTITY_TTL):
+        JsonStore.__init__(self, path, 'Identity cache')
+        self.ttl = ttl
+
+    def key(self, port):
+        fingerprint = port_fingerprint(port)
+        return None if fingerprint is None else f"{port}|{fingerprint}"
+
+    def load(self, port):
+        """
+        Returns (model, version, langhash) remembered for 'port', langhash being the pair of
+        language hashes, or None if there is no entry or it has expired
+        """
+        key = self.key(port)
+        if key is None:
+            return None
+        entry = self.get(key)
+        if entry is None or time.time() - entry['time'] > self.ttl:
+            return None
+        return (entry['model'], entry['version'], entry['langhash'].split())
+
+    def save(self, port, model, version, langhash):
+        key = self.key(port)
+        if key is None:
+            return
+        def change(entries):
+            # Drop what has expired so the file does not grow with every adapter ever used
+            entries = {k: v for k, v in entries.items() if time.time() - v['time'] <= self.ttl}
+            entries[key] = {'model': model, 'version': version, 'langhash': ' '.join(langhash), 'time': time.time()}
+            return entries
+        self.update(change)
+
+    def invalidate(self, port):
+        """ Forgets the identity of whatever is on 'port', e.g. once new firmware goes to it """
+        def change(entries):
+            kept = {k: v for k, v in entries.items() if k.rsplit('|', 1)[0] != port}
+            return kept if len(kept) != len(entries) else None
+        self.update(change)
@@ -0,0 +1,280 @@
+##########################################################################################
+# Listen mode: reads what a module prints in bulk and passes it on line by line
+##########################################################################################
+import codecs
+import collections
+import json
+import os
+import sys
+import threading
+import time
+
+READ_SIZE = 4096            #most bytes taken from the port by one read
+RING_LINES = 8192           #lines held for the writer thread before the oldest are dropped
+POLL_INTERVAL_SEC = 0.05    #port timeout while listening, a partial line is passed on after this long without data
+LOG_MAX_BYTES = 10*1024*1024
+LOG_BACKUPS = 5
+
+# 't' is seconds since listening started, from time.monotonic(), and 'time' the wall clock time
+# of the same moment, both taken when the first byte of the line was read, 'port' and 'model'
+# tag the lines of a monitor of several ports
+ListenLine = collections.namedtuple('ListenLine', ['t', 'time', 'text', 'complete', 'port', 'model'],
+                                    defaults=(None, None))
+
+class LineSplitter():
+    """
+    Decodes UTF-8 as it arrives and splits it into lines, holding back a character or a line
+    split across reads until the rest of it arrives
+    Lines end at \\n, a \\r before it is dropped
+    """
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self.partial = ''
+        self.started = None     #when the first byte of the partial line was read
+
+    def feed(self, data, now):
+        """ Returns [(started, text)] for the lines that 'data', read at 'now', completes """
+        text = self.decoder.decode(data)
+        if len(text) == 0:
+            return []
+        if self.started is None:
+            self.started = now
+        parts = (self.partial + text).split('\n')
+        self.partial = parts.pop()
+        lines = []
+        for part in parts:
+            lines.append((self.started, part[:-1] if part.endswith('\r') else part))
+            self.started = now
+        if len(self.partial) == 0:
+            self.started = None
+        return lines
+
+    def flush(self):
+        """ Returns (started, text) for the partial line and forgets it, or None if there is none """
+        if len(self.partial) == 0:
+            return None
+        line = (self.started, self.partial)
+        self.partial = ''
+        self.started = None
+        return line
+
+class LineRing():
+    """
+    Bounded queue of lines between the port reader and the writer thread, when the sinks fall
+    behind the oldest lines are dropped and counted rather than holding up the reader
+    """
+    def __init__(self, capacity=RING_LINES):
+        self.lines = collections.deque()
+        self.capacity = capacity
+        self.dropped = 0
+        self.dropped_ports = collections.Counter()  #{port: lines dropped}
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def put(self, lines):
+        with self.condition:
+            self.lines.extend(lines)
+            while len(self.lines) > self.capacity:
+                self.dropped += 1
+                self.dropped_ports[self.lines.popleft().port] += 1
+            self.condition.notify()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+    def take(self):
+        """ Waits for lines and returns all of them, or [] once closed and empty """
+        with self.condition:
+            while len(self.lines) == 0 and not self.closed:
+                self.condition.wait()
+            lines = list(self.lines)
+            self.lines.clear()
+            return lines
+
+class TextSink():
+    """
+    Writes lines to a text stream, stdout by default, prefixed with their time in seconds
+    since listening started if 'timestamps' is set, and with their port and model if tagged
+    """
+    def __init__(self, stream=None, timestamps=False):
+        self.stream = stream if stream is not None else sys.stdout
+        self.timestamps = timestamps
+        self.line_start = {}    #{port: False while a partial line from it is being carried on}
+
+    def format(self, line):
+        text = line.text + ('\n' if line.complete else '')
+        if self.line_start.get(line.port, True):
+            if line.port is not None:
+                text = f"{line.port} {line.model or '?'}: {text}"
+            if self.timestamps:
+                text = f"[{line.t:10.3f}] {text}"
+        # A partial line is carried on by the next one from the same port without another prefix
+        self.line_start[line.port] = line.complete
+        return text
+
+    def write(self, lines):
+        self.stream.write(''.join([self.format(line) for line in lines]))
+        self.stream.flush()
+
+    def close(self):
+        self.stream.flush()
+
+class StdoutSink(TextSink):
+    def __init__(self, timestamps=False):
+        TextSink.__init__(self, sys.stdout, timestamps)
+
+class RotatingFileSink(TextSink):
+    """
+    Appends lines to the file at 'path', moving it to path.1, path.1 to path.2 and so on up to
+    'backups' files once it reaches 'max_bytes'
+    """
+    def __init__(self, path, timestamps=False, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        TextSink.__init__(self, open(path, 'a', encoding='utf-8'), timestamps)
+
+    def write(self, lines):
+        text = ''.join([self.format(line) for line in lines])
+        if self.max_bytes > 0 and self.stream.tell() + len(text) > self.max_bytes and self.stream.tell() > 0:
+            self.rotate()
+        self.stream.write(text)
+        self.stream.flush()
+
+    def rotate(self):
+        self.stream.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i+1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        self.stream = open(self.path, 'w', encoding='utf-8')
+
+    def close(self):
+        self.stream.close()
+
+class JsonlSink():
+    """ Appends one JSON object per line to the file at 'path' """
+    def __init__(self, path):
+        self.stream = open(path, 'a', encoding='utf-8')
+
+    def write(self, lines):
+        self.stream.write(''.join([json.dumps(self.record(line)) + '\n' for line in lines]))
+        self.stream.flush()
+
+    def record(self, line):
+        record = {'t': round(line.t, 6), 'time': round(line.time, 6), 'line': line.text, 'partial': not line.complete}
+        if line.port is not None:
+            record['port'] = line.port
+            record['model'] = line.model
+        return record
+
+    def close(self):
+        self.stream.close()
+
+class SinkWriter():
+    """
+    Thread that takes the lines queued in a LineRing and writes them to each of the 'sinks'
+    A sink is anything with write(lines) and close(), see TextSink
+    """
+    def __init__(self, ring, sinks):
+        self.ring = ring
+        self.sinks = list(sinks)
+        self.thread = threading.Thread(target=self.run, name='listen-writer', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def finish(self):
+        """ Closes the ring, waits for the lines still in it to be written and closes the sinks """
+        self.ring.close()
+        if self.thread.is_alive():
+            self.thread.join()
+        for sink in self.sinks:
+            sink.close()
+
+    def run(self):
+        while True:
+            lines = self.ring.take()
+            if len(lines) == 0:
+                return
+            for sink in list(self.sinks):
+                try:
+                    sink.write(lines)
+                except (IOError, OSError) as e:
+                    # Keep the other sinks going rather than stalling the reader
+                    sys.stderr.write(f"Listen output dropped: {e}\n")
+                    self.sinks.remove(sink)
+
+class ListenEngine():
+    """
+    Reads everything waiting on 'port' at once, splits it into timestamped lines and queues
+    them in a LineRing for a SinkWriter that passes them to each of the 'sinks', so that a
+    slow console or disk never holds up reading the port
+    """
+    def __init__(self, port, sinks, ring_lines=RING_LINES):
+        self.port = port
+        self.ring = LineRing(ring_lines)
+        self.writer = SinkWriter(self.ring, sinks)
+        self.splitter = LineSplitter()
+        self.origin = time.monotonic()
+        self.started = time.time()
+        self.bytes_read = 0
+        self.lines = 0
+        self.stop_event = threading.Event()
+
+    def line(self, started, text, complete):
+        return ListenLine(started - self.origin, self.started + started - self.origin, text, complete)
+
+    def feed(self, data, now):
+        """ Splits the bytes read at 'now' into lines and queues the complete ones """
+        self.bytes_read += len(data)
+        lines = [self.line(started, text, True) for started, text in self.splitter.feed(data, now)]
+        if len(lines) > 0:
+            self.lines += len(lines)
+            self.ring.put(lines)
+
+    def idle(self):
+        """ Passes on a partial line, e.g. a prompt, once nothing more arrives for a while """
+        partial = self.splitter.flush()
+        if partial is not None:
+            self.ring.put([self.line(partial[0], partial[1], False)])
+
+    def run(self, initial=b''):
+        """
+        Listens until stop() is called or Ctrl-C, 'initial' is anything already read from the
+        port before listening started
+        """
+        timeout = self.port.timeout
+        self.port.timeout = POLL_INTERVAL_SEC
+        self.writer.start()
+        try:
+            if len(initial) > 0:
+                self.feed(initial, time.monotonic())
+            while not self.stop_event.is_set():
+                data = self.port.read(min(READ_SIZE, self.port.in_waiting) or 1)
+                if len(data) > 0:
+                    self.feed(data, time.monotonic())
+                else:
+                    self.idle()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.idle()
+            self.writer.finish()
+            self.port.timeout = timeout
+
+    def stop(self):
+        self.stop_event.set()
+
+def sinks_from_args(args):
+    """ Returns the sinks that the --timestamps, --log, --log-max-bytes and --jsonl options ask for """
+    timestamps = getattr(args, 'timestamps', False)
+    sinks = [StdoutSink(timestamps)]
+    if getattr(args, 'log', None):
+        sinks.append(RotatingFileSink(args.log, timestamps, getattr(args, 'log_max_bytes', LOG_MAX_BYTES)))
+    if getattr(args, 'jsonl', None):
+        sinks.append(JsonlSink(args.jsonl))
+    return sinks
@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""
+This is a command line tool for watching what many Laird "SmartBASIC" modules print at once,
+e.g. the telemetry of every module in a soak test.
+
+Usage: python3 sbmonitor.py [options] port [port ...]
+           port      serial port or glob, e.g. COM12 or "/dev/ttyUSB*"
+       options
+           -b BAUD           baud rate, default 115200
+           --no-detect       do not ask each module for its model with AT I 0 first
+           --timestamps      prefix each line with the seconds since monitoring started
+           --quiet           do not print the merged lines on stdout
+           --log FILE        append the merged lines to FILE, rotating it as it grows
+           --log-max-bytes N size at which log files are rotated, default 10MB
+           --per-device DIR  append the lines of each module to its own file in DIR
+           --jsonl FILE      append the merged lines to FILE as JSON, one object per line
+           --stats SECS      report bytes/s, overruns and dropped lines on stderr every SECS seconds
+           --duration SECS   stop after SECS seconds instead of at Ctrl-C
+
+Every port is read on one asyncio event loop, taking all that is waiting at once. Each line
+is tagged with its port and the model the module reported and the lines of all the ports
+are merged in the order their first bytes arrived. Files are written by a separate thread.
+Overruns are those the Linux serial driver counted, where it can tell, plus the partial
+lines cut short because they held the others back for too long. Lines dropped because the
+output could not keep up are counted separately. A summary per port is printed on stderr
+at the end.
+"""
+
+#-----------------------------------------------------------------------------
+# constants
+#-----------------------------------------------------------------------------
+
+VERBOSELEVEL=0
+DEFAULT_BAUD=115200
+DETECT_TIMEOUT_SEC=2.0
+READ_COALESCE_SEC=0.02      #wait after a short read so that each read takes more, the kernel buffers far longer
+RING_LINES=65536            #merged lines held for the writer thread before the oldest are dropped
+PARTIAL_LINE_SEC=1.0        #longest a partial line holds back the lines of the other ports before it is cut
+PARTIAL_LINE_CHARS=4096     #longest a partial line grows before it is cut
+TIOCGICOUNT=0x545D          #Linux ioctl returning the serial_icounter_struct of a port
+
+#-----------------------------------------------------------------------------
+# Module imports
+#-----------------------------------------------------------------------------
+import blutilc
+import sbasync
+import sblisten
+import uwfmulti
+import argparse
+import asyncio
+import heapq
+import os
+import re
+import struct
+import sys
+import time
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def kernel_overruns(port):
+    """
+    Returns the UART and buffer overruns the Linux serial driver counted on the AsyncSerial
+    'port' since it was opened, or None where that is not known, e.g. a pty or another OS
+    """
+    if fcntl is None or port.fd is None:
+        return None
+    try:
+        # cts, dsr, rng, dcd, rx, tx, frame, overrun, parity, brk, buf_overrun, reserved[9]
+        counts = struct.unpack('20i', fcntl.ioctl(port.fd, TIOCGICOUNT, bytes(80)))
+    except OSError:
+        return None
+    return counts[7] + counts[10]
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class PortMonitor(object):
+    """ One port being monitored, its line splitter and its counters """
+    def __init__(self, name, baudrate):
+        self.name = name
+        self.port = sbasync.AsyncSerial(name, baudrate)
+        self.model = None
+        self.splitter = sblisten.LineSplitter()
+        self.bytes = 0
+        self.lines = 0
+        self.reported_bytes = 0
+        self.cut_lines = 0      #partial lines passed on before their end arrived
+        self.first_overruns = kernel_overruns(self.port)
+
+    def overruns(self):
+        """
+        Returns the overruns the driver counted since monitoring started plus the lines cut short,
+        or None if the driver cannot tell and no line was cut
+        """
+        overruns = kernel_overruns(self.port)
+        if overruns is None or self.first_overruns is None:
+            return self.cut_lines if self.cut_lines > 0 else None
+        return overruns - self.first_overruns + self.cut_lines
+
+    def next_start(self, now):
+        """ Returns the earliest time a line from this port not yet complete can have started """
+        return self.splitter.started if self.splitter.started is not None else now
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class PerDeviceSink(object):
+    """ Appends the lines of each port to its own sblisten.RotatingFileSink in 'directory' """
+    def __init__(self, directory, timestamps=False, max_bytes=sblisten.LOG_MAX_BYTES):
+        self.directory = directory
+        self.timestamps = timestamps
+        self.max_bytes = max_bytes
+        self.sinks = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def write(self, lines):
+        groups = {}
+        for line in lines:
+            # The file says which port the lines are from
+            groups.setdefault(line.port, []).append(line._replace(port=None))
+        for port, group in groups.items():
+            if port not in self.sinks:
+                path = os.path.join(self.directory, re.sub(r'[^\w.-]', '_', port.strip('/')) + '.log')
+                self.sinks[port] = sblisten.RotatingFileSink(path, self.timestamps, self.max_bytes)
+            self.sinks[port].write(group)
+
+    def close(self):
+        for sink in self.sinks.values():
+            sink.close()
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class Monitor(object):
+    """
+    Reads many ports on one event loop and merges their lines, tagged with the port and model,
+    into a single stream ordered by when each line started, which a sblisten.SinkWriter
+    passes to the sinks
+    A line is held back until no port can still produce one that started earlier, which is at
+    most until a port's partial line is passed on after sblisten.POLL_INTERVAL_SEC idle, or cut
+    after 'partial_sec' or 'partial_chars' if the port keeps sending without ending it
+    """
+    def __init__(self, ports, baudrate, sinks, ring_lines=RING_LINES, partial_sec=PARTIAL_LINE_SEC,
+                 partial_chars=PARTIAL_LINE_CHARS):
+        self.partial_sec = partial_sec
+        self.partial_chars = partial_chars
+        self.origin = time.monotonic()
+        self.started = time.time()
+        self.monitors = [PortMonitor(port, baudrate) for port in ports]
+        self.ring = sblisten.LineRing(ring_lines)
+        self.writer = sblisten.SinkWriter(self.ring, sinks)
+        self.pending = []       #heap of (t, sequence, line) not yet released to the ring
+        self.sequence = 0
+
+    async def detect(self, monitor, args):
+        """ Asks the module for its model, leaving it None if it does not answer in time """
+        device = sbasync.AsyncBLDevice(args, monitor.port)
+        try:
+            await asyncio.wait_for(device.detect_model(), DETECT_TIMEOUT_SEC)
+        except (asyncio.TimeoutError, blutilc.RuntimeError, IndexError):
+            pass
+        # AT I 0 may have answered even if a later query did not
+        monitor.model = getattr(device, 'model', None)
+        # Whatever the module printed around the responses is monitored too
+        leftover = device.reader.take(len(device.reader.buffer))
+        if len(leftover) > 0:
+            self.feed(monitor, leftover, time.monotonic())
+
+    def line(self, monitor, started, text, complete):
+        return sblisten.ListenLine(started - self.origin, self.started + started - self.origin, text, complete,
+                                   monitor.name, monitor.model)
+
+    def queue(self, line):
+        heapq.heappush(self.pending, (line.t, self.sequence, line))
+        self.sequence += 1
+
+    def feed(self, monitor, data, now):
+        monitor.bytes += len(data)
+        for started, text in monitor.splitter.feed(data, now):
+            monitor.lines += 1
+            self.queue(self.line(monitor, started, text, True))
+        splitter = monitor.splitter
+        if splitter.started is not None and (now - splitter.started >= self.partial_sec or len(splitter.partial) >= self.partial_chars):
+            # Cut the line rather than hold back every port until it ends
+            partial = splitter.flush()
+            monitor.cut_lines += 1
+            self.queue(self.line(monitor, partial[0], partial[1], False))
+        self.release(now)
+
+    def idle(self, monitor, now):
+        partial = monitor.splitter.flush()
+        if partial is not None:
+            self.queue(self.line(monitor, partial[0], partial[1], False))
+            self.release(now)
+
+    def release(self, now):
+        """ Passes on the lines that started before any line still to come from any port """
+        watermark = min([monitor.next_start(now) for monitor in self.monitors]) - self.origin
+        lines = []
+        while len(self.pending) > 0 and self.pending[0][0] <= watermark:
+            lines.append(heapq.heappop(self.pending)[2])
+        if len(lines) > 0:
+            self.ring.put(lines)
+
+    async def read_port(self, monitor):
+        while True:
+            data = await monitor.port.read_available(sblisten.POLL_INTERVAL_SEC)
+            now = time.monotonic()
+            if len(data) == 0:
+                self.idle(monitor, now)
+                continue
+            self.feed(monitor, data, now)
+            if len(data) < sblisten.READ_SIZE:
+                await asyncio.sleep(READ_COALESCE_SEC)
+
+    async def report(self, interval, stream):
+        last = time.monotonic()
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            received = sum([monitor.bytes - monitor.reported_bytes for monitor in self.monitors])
+            for monitor in self.monitors:
+                monitor.reported_bytes = monitor.bytes
+            overruns = sum([monitor.overruns() or 0 for monitor in self.monitors])
+            stream.write(f"{now - self.origin:8.1f}s {received / (now - last):10.0f} bytes/s from {len(self.monitors)} ports, "
+                         f"{overruns} overruns, {self.ring.dropped} lines dropped\n")
+            stream.flush()
+            last = now
+
+    async def run(self, detect_args=None, duration=None, stats_interval=None, stats_stream=None):
+        """
+        Monitors every port until 'duration' seconds have passed, or forever, detecting the
+        models first if 'detect_args' are given
+        """
+        self.writer.start()
+        tasks = []
+        try:
+            if detect_args is not None:
+                await asyncio.gather(*[self.detect(monitor, detect_args) for monitor in self.monitors])
+            tasks = [asyncio.ensure_future(self.read_port(monitor)) for monitor in self.monitors]
+            if stats_interval:
+                tasks.append(asyncio.ensure_future(self.report(stats_interval, stats_stream or sys.stderr)))
+            if duration is not None:
+                await asyncio.sleep(duration)
+            else:
+                await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            now = time.monotonic()
+            for monitor in self.monitors:
+                self.idle(monitor, now)
+            self.ring.put([entry[2] for entry in sorted(self.pending)])
+            self.pending = []
+            self.writer.finish()
+            for monitor in self.monitors:
+                monitor.port.close()
+
+    def summary(self):
+        elapsed = time.monotonic() - self.origin
+        return [{'port': monitor.name, 'model': monitor.model, 'bytes': monitor.bytes, 'lines': monitor.lines,
+                 'bytes_per_sec': int(monitor.bytes / elapsed) if elapsed > 0 else 0,
+                 'overruns': monitor.overruns(), 'dropped': self.ring.dropped_ports[monitor.name]}
+                for monitor in self.monitors]
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def print_summary(results, stream):
+    stream.write(f"{'port':<20} {'model':<10} {'bytes':>10} {'lines':>9} {'bytes/s':>9} {'overruns':>9} {'dropped':>8}\n")
+    for result in results:
+        overruns = '-' if result['overruns'] is None else result['overruns']
+        stream.write(f"{result['port']:<20} {result['model'] or '?':<10} {result['bytes']:>10} {result['lines']:>9} "
+                     f"{result['bytes_per_sec']:>9} {overruns:>9} {result['dropped']:>8}\n")
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def setup_arg_parser():
+    parser = argparse.ArgumentParser(
+        description='Watch what several Laird modules print, merged into one stream or a file per module.')
+    parser.add_argument('ports', nargs='+', help='Serial ports or globs like "/dev/ttyUSB*"')
+    parser.add_argument('-b', '--baud', type=int, default=DEFAULT_BAUD, help=f"Baud rate, default={DEFAULT_BAUD}")
+    parser.add_argument('--no-detect', action="store_true",
+                        help="Do not send AT I commands to find each module's model, e.g. while an app is running")
+    parser.add_argument('--timestamps', action="store_true",
+                        help="Prefix each line with the seconds since monitoring started")
+    parser.add_argument('--quiet', action="store_true", help="Do not print the merged lines on stdout")
+    parser.add_argument('--log', metavar="FILE", help="Append the merged lines to FILE, rotating it as it grows")
+    parser.add_argument('--log-max-bytes', type=int, default=sblisten.LOG_MAX_BYTES, metavar="N",
+                        help=f"Size at which log files are rotated, default={sblisten.LOG_MAX_BYTES}")
+    parser.add_argument('--per-device', metavar="DIR", help="Append the lines of each module to its own file in DIR")
+    parser.add_argument('--jsonl', metavar="FILE", help="Append the merged lines to FILE as JSON, one object per line")
+    parser.add_argument('--stats', type=float, metavar="SECS",
+                        help="Report bytes/s, overruns and dropped lines on stderr every SECS seconds")
+    parser.add_argument('--duration', type=float, metavar="SECS", help="Stop after SECS seconds instead of at Ctrl-C")
+    return parser
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def main():
+    parser=setup_arg_parser()
+    args = parser.parse_args()
+
+    ports = uwfmulti.expand_ports(args.ports)
+    if len(ports) == 0:
+        print("No serial ports match")
+        return 2
+
+    sinks = [] if args.quiet else [sblisten.StdoutSink(args.timestamps)]
+    if args.log:
+        sinks.append(sblisten.RotatingFileSink(args.log, args.timestamps, args.log_max_bytes))
+    if args.jsonl:
+        sinks.append(sblisten.JsonlSink(args.jsonl))
+    if args.per_device:
+        sinks.append(PerDeviceSink(args.per_device, args.timestamps, args.log_max_bytes))
+
+    # The detection only needs what blutilc.BLDevice reads from args
+    detect_args = None if args.no_detect else argparse.Namespace(verbose=False, no_compile_cache=True)
+    monitor = Monitor(ports, args.baud, sinks)
+    try:
+        asyncio.run(monitor.run(detect_args, args.duration, args.stats))
+    except KeyboardInterrupt:
+        pass
+    print_summary(monitor.summary(), sys.stderr)
+    return 0
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,83 @@
+##########################################################################################
+# #include expansion for smartBASIC sources, with a dependency graph and a line map
+##########################################################################################
+import os
+import re
+
+INCLUDE_PATTERN = re.compile(r'^#include\s+"(.*)"$')
+
+class IncludeError(Exception):
+    pass
+
+class Preprocessor():
+    """
+    Expands #include "file" lines in one pass over the source, reading each file once
+    however often it is included. Nested includes are followed with an explicit stack,
+    an include of a file that is already being expanded is reported as a cycle.
+    After expand() the Preprocessor holds:
+        line_map   (path, line number) of every output line, both 1 based
+        graph      {path: [paths it includes directly]} for every file read
+    """
+    def __init__(self):
+        self.files = {}     #{path: [lines]}, read once and kept for later expansions
+        self.line_map = []
+        self.graph = {}
+
+    def read(self, path):
+        if path not in self.files:
+            if not os.path.exists(path):
+                raise IncludeError(f"Included file {path} does not exist")
+            with open(path, 'r') as f:
+                self.files[path] = f.read().splitlines()
+        return self.files[path]
+
+    def expand(self, path):
+        """ Returns the source of 'path' with every #include replaced by the file it names """
+        path = os.path.abspath(path)
+        output = []
+        self.line_map = []
+        self.graph = {}
+        # each entry is [path, its lines, index of the next line to emit]
+        stack = [[path, self.read(path), 0]]
+        self.graph[path] = []
+        while stack:
+            entry = stack[-1]
+            current, lines, index = entry
+            if index == len(lines):
+                stack.pop()
+                continue
+            entry[2] = index + 1
+            line = lines[index]
+            match = INCLUDE_PATTERN.match(line)
+            if match is None:
+                output.append(line)
+                self.line_map.append((current, index + 1))
+                continue
+            include_path = os.path.abspath(os.path.join(os.path.dirname(current), match.group(1)))
+            if any([include_path == other[0] for other in stack]):
+                chain = ' -> '.join([other[0] for other in stack] + [include_path])
+                raise IncludeError(f"Include cycle: {chain}")
+            if include_path not in self.graph[current]:
+                self.graph[current].append(include_path)
+            stack.append([include_path, self.read(include_path), 0])
+            self.graph.setdefault(include_path, [])
+        output.append('')
+        return '\n'.join(output)
+
+    def original_location(self, line):
+        """ Returns (path, line number) of 1 based output 'line', or None if it is out of range """
+        if 1 <= line <= len(self.line_map):
+            return self.line_map[line - 1]
+        return None
+
+    def dependencies(self):
+        """ Returns every file the last expanded source was built from """
+        return sorted(self.graph)
+
+    def is_stale(self, target):
+        """ Returns True if 'target' is missing or older than any file it was built from """
+        try:
+            built = os.path.getmtime(target)
+        except OSError:
+            return True
+        return any([os.path.getmtime(path) > built for path in self.graph])
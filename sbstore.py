@@ -0,0 +1,68 @@
+##########################################################################################
+# Files under ~/.sbutil that remember things between runs
+##########################################################################################
+import json
+import os
+import sys
+import threading
+
+STORE_DIR = os.path.join(os.path.expanduser('~'), '.sbutil')
+
+# Sessions and downloads on several threads share the store files
+store_lock = threading.Lock()
+
+def replace_file(path, fill, name):
+    """
+    Creates or replaces 'path' by calling 'fill' with the path of a temp file beside it and
+    then renaming that over it, so a reader never sees a half written file
+    What is stored only saves time later, so a failure is reported as '<name> not written'
+    and otherwise ignored, returns False if it failed
+    """
+    try:
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        fill(temp_path)
+        os.replace(temp_path, path)
+    except OSError as e:
+        sys.stderr.write(f"{name} not written: {e}\n")
+        return False
+    return True
+
+class JsonStore():
+    """
+    A dict of entries kept in one JSON file, read afresh for every access so that processes
+    sharing the file see each other's changes
+    """
+    def __init__(self, path, name):
+        self.path = path
+        self.name = name
+
+    def read(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def write(self, entries):
+        def fill(temp_path):
+            with open(temp_path, 'w') as f:
+                json.dump(entries, f, indent=1)
+        replace_file(self.path, fill, self.name)
+
+    def get(self, key):
+        """ Returns the entry for 'key', or None if there is none """
+        with store_lock:
+            return self.read().get(key)
+
+    def update(self, change):
+        """
+        Calls 'change' with the entries and writes back what it returns, nothing is written
+        if it returns None
+        """
+        with store_lock:
+            entries = change(self.read())
+            if entries is not None:
+                self.write(entries)
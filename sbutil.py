@@ -29,7 +29,10 @@ DEFAULT_MODULE='BL654'
 # Module imports
 #-----------------------------------------------------------------------------
 import blutilc
+import sblisten
+import sbdaemon
 import uwfloader
+import uwf_stats
 import os
 import sys
 import serial
@@ -50,6 +53,32 @@ def setup_arg_parser():
                          help="Timeout for commands like --send", default=blutilc.SERIAL_TIMEOUT,type=float,
                          metavar="TIMEOUT")
     parser.add_argument('-m', '--module', default=DEFAULT_MODULE, help=f"Module type, default={DEFAULT_MODULE}")
+    parser.add_argument('--pipeline', type=int, default=uwfloader.uwf_processor.PIPELINE_WINDOW, metavar="N",
+                        help=f"Firmware download: number of write frames sent ahead of their acks, 0 is stop-and-wait, default={uwfloader.uwf_processor.PIPELINE_WINDOW}")
+    parser.add_argument('--delta', action="store_true",
+                        help="Firmware download: only erase and write the sectors whose contents differ from the image")
+    parser.add_argument('--skip-blank', action="store_true",
+                        help="Firmware download: skip erasing sectors that a verify shows are already blank")
+    parser.add_argument('--schedule', action="store_true",
+                        help="Firmware download: send all erases and writes as one pipelined stream, erasing each region while the one before it is written")
+    parser.add_argument('--adaptive', action="store_true",
+                        help="Firmware download: tune the write block size and blocks per verify as the download runs, remembering the best per module type")
+    parser.add_argument('--resume', action="store_true",
+                        help="Firmware download: keep a checkpoint journal and continue an interrupted download from its last checkpoint without erasing again")
+    parser.add_argument('--fast', nargs='?', const=','.join(map(str, uwfloader.uwf_processor.BAUD_LADDER)), metavar="RATES",
+                        help=f"Firmware download: sync with the bootloader at the fastest working rate from a comma separated list, default={','.join(map(str, uwfloader.uwf_processor.BAUD_LADDER))}")
+    parser.add_argument('--stats', metavar="FILE",
+                        help="Firmware download: write per phase timings, round trip histograms, byte counts and retries to FILE, as CSV if it ends in .csv, else JSON")
+    parser.add_argument('--chunk', type=int, default=0, metavar="N",
+                        help="App upload: bytes per file write command, default=largest the module accepts")
+    parser.add_argument('--upload-pipeline', type=int, default=blutilc.UPLOAD_PIPELINE, metavar="N",
+                        help=f"App upload: file write commands sent before collecting responses, default={blutilc.UPLOAD_PIPELINE}")
+    parser.add_argument('--hex-only', action="store_true",
+                        help="App upload: only use AT+FWRH, never the AT+FWR string variant")
+    parser.add_argument('--no-compile-cache', action="store_true",
+                        help="Always compile, do not reuse or keep .uwc files in the compile cache")
+    parser.add_argument('--no-identity-cache', action="store_true",
+                        help="Always ask the module for its model, version and language hashes")
     cmd_arg = parser.add_mutually_exclusive_group(required=True)
     cmd_arg.add_argument('-f', '--firmware', help="Download a .uwf firmware file to device", metavar="UWF_FILE")
     cmd_arg.add_argument('-c', '--compile', help="Compile specified smartBasic file to a .uwc file.", metavar="SBFILE")
@@ -62,11 +91,25 @@ def setup_arg_parser():
     cmd_arg.add_argument('-s', '--send',
                          help="Send the string CMD (\\r will be auto appended) and listen for {SERIAL_TIMEOUT} seconds",
                          metavar="CMD")
+    cmd_arg.add_argument('--batch', metavar="FILE",
+                         help="Send each AT command in FILE, or stdin if FILE is -, in one session and print the results as JSON")
     cmd_arg.add_argument('--ls', action="store_true", help="List all files uploaded to the device")
     cmd_arg.add_argument('--rm', metavar="FILE", help="Remove specified file from the device")
     cmd_arg.add_argument('--format', action="store_true", help="Erase all stored files from the device")
     cmd_arg.add_argument('--listen', action="store_true",
                          help="Listen over serial for incoming messages, e.g. from print statements in a running program")
+    parser.add_argument('--daemon', metavar="SOCK",
+                        help="Have the sbdaemon.py serving the Unix socket SOCK do it, on the port it keeps open")
+    parser.add_argument('--batch-pipeline', type=int, default=blutilc.BATCH_PIPELINE, metavar="N",
+                        help=f"Batch: commands sent before collecting responses, default={blutilc.BATCH_PIPELINE}")
+    parser.add_argument('--keep-going', action="store_true",
+                        help="Batch: carry on after a command returns an error")
+    parser.add_argument('--timestamps', action="store_true",
+                        help="Listen: prefix each line with the seconds since listening started")
+    parser.add_argument('--log', metavar="FILE", help="Listen: also append the lines to FILE, rotating it as it grows")
+    parser.add_argument('--log-max-bytes', type=int, default=sblisten.LOG_MAX_BYTES, metavar="N",
+                        help=f"Listen: size at which the --log file is rotated, default={sblisten.LOG_MAX_BYTES}")
+    parser.add_argument('--jsonl', metavar="FILE", help="Listen: also append the lines to FILE as JSON, one object per line")
     return parser
 
 #-----------------------------------------------------------------------------
@@ -75,10 +118,13 @@ def main():
     parser=setup_arg_parser()
     global args
     args = parser.parse_args()
+    if args.schedule and args.pipeline <= 1:
+        parser.error("--schedule needs --pipeline 2 or more")
     
+    if args.daemon:
+        return sbdaemon.client_main(args)
+
     if args.firmware is None:
-        #make the args visible to blutilc
-        blutilc.args=args
         #create an instance of a smartBASIC device as per the class in blutilc.py
         device = blutilc.BLDevice(args)
 
@@ -103,7 +149,7 @@ def main():
             ops += ["run"]
 
         #if break into command mode via reset/urt_break then do so
-        if not args.send:
+        if not args.send and not args.batch:
             if not args.no_break:
                 device.reset_into_cmd_mode()
 
@@ -129,18 +175,27 @@ def main():
             cmdstr=f"{args.send}\r"
             print(device.writerawcmd(cmdstr, timeout=args.timeout))
             print("Command completed")
+        if args.batch:
+            return blutilc.run_batch(device, args)
         if args.listen:
-            device.listen()
+            device.listen(sblisten.sinks_from_args(args))
     else:
         #download firmware
-        uwfloader.loadfirmware(args.port,args.baud,args.firmware,args.module)
+        stats = uwf_stats.UwfStats(args.port) if args.stats else None
+        uwfloader.loadfirmware(args.port,args.baud,args.firmware,args.module,
+                               pipeline_window=args.pipeline,
+                               baud_ladder=uwfloader.parse_baud_ladder(args.fast) if args.fast else None,
+                               delta=args.delta, resume=args.resume, observer=stats,
+                               adaptive=args.adaptive, skip_blank=args.skip_blank, schedule=args.schedule)
+        if stats is not None:
+            stats.dump(args.stats)
         
         
 #-----------------------------------------------------------------------------
 #-----------------------------------------------------------------------------
 if __name__ == "__main__":
     try:
-        main()
+        sys.exit(main())
     except RuntimeError as e:
         print(e)
         sys.exit(2)
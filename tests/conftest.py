@@ -0,0 +1,79 @@
+import os
+import random
+import struct
+import sys
+
+import pytest
+
+# The tools are scripts at the top of the repo rather than a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import uwfemu
+
+def uwf_command(cmd, payload):
+    return cmd.encode('utf-8') + b'\x00' + struct.pack('<I', len(payload)) + payload
+
+def uwf_image_bytes(data, regions=1, sector_size=uwfemu.DEFAULT_SECTOR_SIZE, sectors=uwfemu.DEFAULT_SECTORS):
+    """
+    Returns a .uwf image that writes 'data' from the start of the bank in 'regions' regions, each
+    selecting the bank again with its own sector map, erase block and write command
+    """
+    region_size = -(-len(data) // regions // sector_size) * sector_size
+    image = uwf_command('T', struct.pack('<I', 0))
+    image += uwf_command('G', struct.pack('<BIBIB', 0, uwfemu.DEFAULT_BASE_ADDRESS, 1, sector_size * sectors, 1))
+    for start in range(0, len(data), region_size):
+        end = min(len(data), start + region_size)
+        image += uwf_command('S', struct.pack('BB', 0, 0))
+        image += uwf_command('M', struct.pack('<II', sectors, sector_size))
+        image += uwf_command('E', struct.pack('<II', start, end - start))
+        image += uwf_command('W', struct.pack('<II', start, 0) + data[start:end])
+    image += uwf_command('U', struct.pack('B', 0))
+    return image
+
+def random_data(size, seed):
+    rng = random.Random(seed)
+    return bytes(rng.getrandbits(8) for i in range(size))
+
+@pytest.fixture
+def make_data():
+    """ Returns random bytes for an image, the same every run for a given seed """
+    return random_data
+
+@pytest.fixture
+def write_image(tmp_path):
+    """ Writes a .uwf image of 'data', see uwf_image_bytes, and returns its path """
+    def write(name, data, regions=1):
+        path = tmp_path / name
+        path.write_bytes(uwf_image_bytes(data, regions))
+        return str(path)
+    return write
+
+@pytest.fixture
+def loopback():
+    """
+    Returns an in-process bootloader with no latency that NAKs the commands numbered in 'nak_at'
+    A 'name' makes it look like a port opened on that device
+    """
+    def make(nak_at=(), name=None, **options):
+        device = uwfemu.LoopbackBootloader(uwfemu.BootloaderModel(nak_at=nak_at), latency=0.0, **options)
+        if name is not None:
+            device.name = name
+        return device
+    return make
+
+@pytest.fixture
+def module():
+    """
+    Serves the sbemu.ModuleModel passed to it on a pseudo terminal, with no line or processing
+    delays, and returns the path to open
+    """
+    if not hasattr(os, 'openpty'):
+        pytest.skip('needs pseudo terminals')
+    emulators = []
+    def serve(model):
+        emulator = uwfemu.BootloaderEmulator(model, 0.0, 0.0)
+        emulators.append(emulator)
+        return emulator.open_pty()
+    yield serve
+    for emulator in emulators:
+        emulator.stop()
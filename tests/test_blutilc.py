@@ -0,0 +1,195 @@
+"""
+Framing of AT responses by blutilc.ResponseReader, fed through a pyserial loop:// port, and
+app uploads and batches by blutilc.BLDevice to the module of sbemu
+"""
+import argparse
+import io
+import json
+import os
+
+import pytest
+import serial
+
+import blutilc
+import sbemu
+
+@pytest.fixture
+def port():
+    port = serial.serial_for_url('loop://', timeout=0.01)
+    yield port
+    port.close()
+
+def test_response_in_pieces(port):
+    reader = blutilc.ResponseReader(port)
+    port.write(b'\n10\t0\tBL6')
+    assert reader.read_response(0.05) == (None, b'\n10\t0\tBL6')
+    port.write(b'\n10\t0\tBL654\r')
+    port.write(b'\n00')
+    port.write(b'\r')
+    assert reader.read_response(0.5) == (False, b'\n10\t0\tBL654\r\n00\r')
+
+def test_responses_back_to_back(port):
+    reader = blutilc.ResponseReader(port)
+    port.write(b'\n10\t3\t29.4.6.0\r\n00\r\n00\r\n01\tE007\r')
+    assert reader.read_response(0.5) == (False, b'\n10\t3\t29.4.6.0\r\n00\r')
+    assert reader.read_response(0.5) == (False, b'\n00\r')
+    assert reader.read_response(0.5) == (True, b'\n01\tE007\r')
+    assert reader.read_response(0.05) == (None, b'')
+
+def test_ok_only_ends_a_response_on_a_line_of_its_own(port):
+    reader = blutilc.ResponseReader(port)
+    port.write(b'\n06\tapp1200\r')
+    port.write(b'\n00\r')
+    assert reader.read_response(0.5) == (False, b'\n06\tapp1200\r\n00\r')
+
+def test_error_response(port):
+    reader = blutilc.ResponseReader(port)
+    port.write(b'\n01\tE0')
+    port.write(b'07\r\n00\r')
+    assert reader.read_response(0.5) == (True, b'\n01\tE007\r')
+    assert reader.read_response(0.5) == (False, b'\n00\r')
+
+def test_reset_drops_what_was_received(port):
+    reader = blutilc.ResponseReader(port)
+    port.write(b'\nhello from the app')
+    assert reader.read_available() == b'\nhello from the app'
+    port.write(b'\nleft over')
+    reader.fill()
+    reader.reset()
+    port.write(b'\n00\r')
+    assert reader.read_response(0.5) == (False, b'\n00\r')
+
+def open_device(path, **options):
+    options.setdefault('no_compile_cache', True)
+    options.setdefault('no_identity_cache', True)
+    return blutilc.BLDevice(argparse.Namespace(port=path, baud=115200, **options))
+
+@pytest.mark.parametrize('max_write', [128, 64, 16])
+def test_upload_probes_the_largest_write_the_module_takes(module, make_data, max_write):
+    model = sbemu.ModuleModel(max_write=max_write)
+    device = open_device(module(model))
+    data = make_data(1000, 1)
+    try:
+        device.upload_data('app', data)
+    finally:
+        device.port.close()
+    assert device.upload_sizes == [max_write]
+    assert model.faults == len([size for size in blutilc.UPLOAD_CHUNK_SIZES if size > max_write])
+    assert model.files['app'] == data
+
+def test_upload_falls_back_to_hex_writes(module):
+    model = sbemu.ModuleModel(fwr=False)
+    device = open_device(module(model))
+    data = b'print "hello"\n' * 40
+    try:
+        device.upload_data('app', data)
+    finally:
+        device.port.close()
+    assert not device.upload_fwr
+    assert model.counts['+FWR'] == 1
+    assert model.files['app'] == data
+
+def test_pipelined_upload_in_chunks_given(module, make_data):
+    model = sbemu.ModuleModel()
+    device = open_device(module(model), chunk=32, upload_pipeline=8)
+    data = make_data(1000, 2)
+    try:
+        device.upload_data('app', data, device.upload_pipeline)
+    finally:
+        device.port.close()
+    assert model.faults == 0
+    assert model.counts['+FWR'] + model.counts['+FWRH'] == -(-len(data) // 32)
+    assert model.files['app'] == data
+
+CODES = '''# comment
+[General]
+12="SHORT,The code 12"
+112="LONGER,Not the code 12"
+12="SECOND,Ignored, the first entry wins"
+13="QUOTED,Say \\"hi\\""
+[Other]
+12="OTHER,From another section"
+'''
+
+def test_error_codes_match_exactly():
+    sections = blutilc.parse_error_codes(CODES.splitlines())
+    assert sections['General'][12] == 'SHORT,The code 12'
+    assert sections['General'][112] == 'LONGER,Not the code 12'
+    assert sections['General'][13] == 'QUOTED,Say "hi"'
+    assert sections['Other'][12] == 'OTHER,From another section'
+
+def test_error_codes_are_cached_until_the_file_changes(tmp_path):
+    path = tmp_path / 'codes.csv'
+    path.write_text(CODES)
+    assert blutilc.load_error_codes(str(path))['General'][12] == 'SHORT,The code 12'
+    assert (tmp_path / 'codes.csv.json').exists()
+    assert blutilc.load_error_codes(str(path))['General'][12] == 'SHORT,The code 12'
+
+    path.write_text(CODES.replace('The code 12', 'Changed'))
+    os.utime(str(path), (0, 1))
+    assert blutilc.load_error_codes(str(path))['General'][12] == 'SHORT,Changed'
+
+def test_errordesc_of_the_hex_code_reported():
+    assert blutilc.get_errordesc('E007') == 'UNKNOWN_COMMAND,The provided command does not exist.'
+    assert blutilc.get_errordesc('zz') == '(no description available)'
+
+def test_batch_barriers():
+    assert all(blutilc.is_batch_barrier(command) for command in ['AT Z', 'atz', 'AT&F 1', 'AT+RUN "app"', 'at + run "app"'])
+    assert not any(blutilc.is_batch_barrier(command) for command in ['AT I 0', 'AT+CFG 100 ?', 'AT+DIR'])
+
+def test_batch_script():
+    script = io.StringIO('# setup\nAT I 0\n\n  AT+CFG 100 ?  \n')
+    assert blutilc.read_batch_script(script) == [(2, 'AT I 0'), (4, 'AT+CFG 100 ?')]
+
+class RecordingDevice(blutilc.BLDevice):
+    """ Records when each batch command is sent and its response read """
+    def __init__(self):
+        blutilc.BLDevice.__init__(self, argparse.Namespace(no_compile_cache=True, no_identity_cache=True),
+                                  serial.serial_for_url('loop://'))
+        self.events = []
+
+    def writeraw(self, args):
+        self.events.append(('send', args.strip()))
+
+    def batch_result(self, results, sent, timeout, keep_going):
+        self.events.append(('result', sent[1]))
+        results.append({'command': sent[1], 'ok': True})
+        return True
+
+def test_batch_never_sends_a_barrier_ahead():
+    device = RecordingDevice()
+    commands = [(1, 'AT I 0'), (2, 'AT I 3'), (3, 'ATZ'), (4, 'AT I 13'), (5, 'AT I 0')]
+    device.batch(commands, pipeline=3)
+    assert device.events == [('send', 'AT I 0'), ('send', 'AT I 3'), ('result', 'AT I 0'), ('result', 'AT I 3'),
+                             ('send', 'ATZ'), ('result', 'ATZ'),
+                             ('send', 'AT I 13'), ('send', 'AT I 0'), ('result', 'AT I 13'), ('result', 'AT I 0')]
+
+@pytest.mark.parametrize('pipeline', [1, 4])
+@pytest.mark.parametrize('keep_going', [False, True])
+def test_batch_stops_at_an_error(module, pipeline, keep_going):
+    device = open_device(module(sbemu.ModuleModel()))
+    commands = [(1, 'AT I 0'), (2, 'AT+NOPE'), (3, 'AT I 3'), (4, 'AT+CFG 100 ?')]
+    try:
+        results = device.batch(commands, pipeline, 1.0, keep_going)
+    finally:
+        device.port.close()
+    assert [result['ok'] for result in results][:2] == [True, False]
+    assert results[0]['response'] == '10\t0\t' + sbemu.DEFAULT_MODEL
+    assert results[1]['error'] == 'E007'
+    # Commands already sent ahead of the error are still answered, none are sent after it
+    assert len(results) == (2 if pipeline == 1 and not keep_going else 4)
+
+def test_run_batch_prints_json(module, tmp_path, capsys):
+    path = module(sbemu.ModuleModel())
+    script = tmp_path / 'batch.txt'
+    script.write_text('AT I 0\nAT+CFG 100 5\nAT+CFG 100 ?\n')
+    args = argparse.Namespace(port=path, baud=115200, batch=str(script), batch_pipeline=2, timeout=1.0, keep_going=False,
+                              no_compile_cache=True, no_identity_cache=True)
+    device = blutilc.BLDevice(args)
+    try:
+        assert blutilc.run_batch(device, args) == 0
+    finally:
+        device.port.close()
+    summary = json.loads(capsys.readouterr().out)
+    assert (summary['commands'], summary['sent'], summary['failed']) == (3, 3, 0)
+    assert summary['results'][2]['response'] == '27\t100\t5 (0x00000005)'
@@ -0,0 +1,60 @@
+"""
+The compile cache of sbcache and BLDevice.compile reusing what it holds
+"""
+import argparse
+import os
+
+import serial
+
+import blutilc
+from sbcache import CompileCache
+
+LANGHASH = ('9E56', '5F81')
+
+def test_miss_then_hit(tmp_path):
+    cache = CompileCache(str(tmp_path / 'cache'))
+    uwc_path = str(tmp_path / 'app.uwc')
+    key = CompileCache.make_key('print "hi"\n', 'BL654', LANGHASH, 'online')
+    assert not cache.fetch(key, uwc_path)
+    assert not os.path.exists(uwc_path)
+
+    (tmp_path / 'compiled.uwc').write_bytes(b'compiled')
+    cache.store(key, str(tmp_path / 'compiled.uwc'))
+    assert cache.fetch(key, uwc_path)
+    assert open(uwc_path, 'rb').read() == b'compiled'
+
+def test_key_covers_everything_that_changes_the_output():
+    key = CompileCache.make_key('print "hi"\n', 'BL654', LANGHASH, 'online')
+    assert key == CompileCache.make_key(b'print "hi"\n', 'BL654', LANGHASH, 'online')
+    assert key != CompileCache.make_key('print "ho"\n', 'BL654', LANGHASH, 'online')
+    assert key != CompileCache.make_key('print "hi"\n', 'BL653', LANGHASH, 'online')
+    assert key != CompileCache.make_key('print "hi"\n', 'BL654', ('9E56', '0000'), 'online')
+    assert key != CompileCache.make_key('print "hi"\n', 'BL654', LANGHASH, 'local')
+
+def test_least_recently_used_are_evicted(tmp_path):
+    cache = CompileCache(str(tmp_path / 'cache'), size_limit=300)
+    (tmp_path / 'compiled.uwc').write_bytes(b'x' * 100)
+    for n, key in enumerate(['a', 'b', 'c']):
+        cache.store(key, str(tmp_path / 'compiled.uwc'))
+        os.utime(cache.path(key), (n, n))
+    os.utime(cache.path('a'), (10, 10))
+    cache.size_limit = 250
+    cache.store('d', str(tmp_path / 'compiled.uwc'))
+    assert sorted(os.listdir(str(tmp_path / 'cache'))) == ['a.uwc', 'd.uwc']
+
+def test_compile_uses_the_cached_app(tmp_path):
+    source = tmp_path / 'app.sb'
+    source.write_text('print "hi"\n')
+    device = blutilc.BLDevice(argparse.Namespace(no_identity_cache=True), serial.serial_for_url('loop://'))
+    device.compile_cache = CompileCache(str(tmp_path / 'cache'))
+    device.model = 'BL654'
+    device.langhash = LANGHASH
+    device.xcompname = 'XComp_missing.exe'
+    # Any compiler that does not exist is keyed as the online one
+    compiler = str(tmp_path / device.xcompname)
+    (tmp_path / 'compiled.uwc').write_bytes(b'compiled')
+    device.compile_cache.store(device.compile_key(device.preprocess(str(source)), compiler), str(tmp_path / 'compiled.uwc'))
+
+    # No compiler or server is asked, the online compiler would fail here
+    device.compile(str(source))
+    assert (tmp_path / 'app.uwc').read_bytes() == b'compiled'
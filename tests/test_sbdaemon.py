@@ -0,0 +1,78 @@
+"""
+The requests sbdaemon serves, against the module of sbemu on a pseudo terminal
+"""
+import asyncio
+
+import pytest
+
+import sbdaemon
+import sbemu
+
+@pytest.fixture
+def daemon():
+    return sbdaemon.Daemon(sbdaemon.setup_arg_parser().parse_args(['-n']))
+
+def serve(daemon, *requests):
+    """ Returns the responses to 'requests', handled one after another on one event loop """
+    async def handle_all():
+        try:
+            return [await daemon.handle(request) for request in requests]
+        finally:
+            for session in daemon.sessions.values():
+                session.close()
+    return asyncio.run(handle_all())
+
+def test_identity_is_asked_for_once(daemon, module):
+    model = sbemu.ModuleModel()
+    port = module(model)
+    first, second = serve(daemon, {'op': 'info', 'port': port}, {'op': 'info', 'port': port})
+    assert first == second == {'ok': True, 'identity': {'model': sbemu.DEFAULT_MODEL, 'version': sbemu.DEFAULT_VERSION,
+                                                        'langhash': sbemu.DEFAULT_LANGHASH}}
+    assert model.counts['I'] == 3
+
+def test_send_ls_upload_and_rm(daemon, module, tmp_path):
+    model = sbemu.ModuleModel()
+    port = module(model)
+    app = tmp_path / 'app.uwc'
+    app.write_bytes(bytes(range(256)))
+    responses = serve(daemon, {'op': 'send', 'port': port, 'command': 'AT+CFG 100 ?'},
+                      {'op': 'upload', 'port': port, 'file': str(app), 'chunk': 64},
+                      {'op': 'ls', 'port': port},
+                      {'op': 'rm', 'port': port, 'file': 'app'},
+                      {'op': 'ls', 'port': port})
+    assert responses == [{'ok': True, 'output': '27\t100\t0 (0x00000000)'}, {'ok': True, 'app': 'app'},
+                         {'ok': True, 'output': '06\tapp'}, {'ok': True}, {'ok': True, 'output': ''}]
+    # The chunk size came with the request, so nothing was probed
+    assert model.faults == 0
+    assert model.counts['+FWR'] + model.counts['+FWRH'] == 4
+
+def test_errors_are_responses(daemon, module):
+    port = module(sbemu.ModuleModel())
+    bad_op, failed = serve(daemon, {'op': 'nope', 'port': port}, {'op': 'rm', 'port': port, 'file': 'missing'})
+    assert bad_op == {'ok': False, 'error': "Unknown op 'nope'"}
+    assert not failed['ok'] and 'E018' in failed['error']
+    with pytest.raises(sbdaemon.DaemonError):
+        serve(daemon, {'op': 'ls'})
+
+def test_status_and_close(daemon, module):
+    port = module(sbemu.ModuleModel())
+    send, status, close, after = serve(daemon, {'op': 'send', 'port': port, 'command': 'AT'}, {'op': 'status'},
+                                       {'op': 'close', 'port': port}, {'op': 'status'})
+    assert status['sessions'][0]['port'] == port
+    assert status['sessions'][0]['open'] and status['sessions'][0]['requests'] == 1
+    assert close == {'ok': True, 'closed': [port]}
+    assert after == {'ok': True, 'sessions': []}
+
+def test_requests_over_the_socket(daemon, module, tmp_path):
+    port = module(sbemu.ModuleModel())
+    path = str(tmp_path / 'sbdaemon.sock')
+    async def client():
+        server = await asyncio.start_unix_server(daemon.serve_client, path)
+        loop = asyncio.get_running_loop()
+        try:
+            async with server:
+                return await loop.run_in_executor(None, sbdaemon.request, path, {'op': 'send', 'port': port, 'command': 'AT I 0'})
+        finally:
+            for session in daemon.sessions.values():
+                session.close()
+    assert asyncio.run(client()) == {'ok': True, 'output': '10\t0\t' + sbemu.DEFAULT_MODEL}
@@ -0,0 +1,70 @@
+"""
+The AT commands and filesystem of the module emulated by sbemu
+"""
+import argparse
+
+import blutilc
+import sbemu
+
+def command(model, line):
+    return model.handle(f"{line}\r".encode('latin-1'))
+
+def test_identity():
+    model = sbemu.ModuleModel(model='BL653', version='1.2.3.4', langhash='AAAA BBBB')
+    assert command(model, 'AT I 0') == b'\n10\t0\tBL653\r\n00\r'
+    assert command(model, 'AT I 3') == b'\n10\t3\t1.2.3.4\r\n00\r'
+    assert command(model, 'AT I 13') == b'\n10\t13\tAAAA BBBB\r\n00\r'
+    assert command(model, 'AT I 99') == b'\n01\tE001\r'
+
+def test_file_write_and_list():
+    model = sbemu.ModuleModel()
+    assert command(model, 'AT+FOW "app"') == b'\n00\r'
+    assert command(model, 'AT+FWRH "0102ff"') == b'\n00\r'
+    assert command(model, 'AT+FWR "ab\\22c"') == b'\n00\r'
+    assert command(model, 'AT+FCL') == b'\n00\r'
+    assert model.files['app'] == b'\x01\x02\xffab"c'
+    assert command(model, 'AT+DIR') == b'\n06\tapp\r\n00\r'
+    assert command(model, 'AT+DEL "app"') == b'\n00\r'
+    assert command(model, 'AT+DEL "app"') == b'\n01\tE018\r'
+    assert command(model, 'AT+DEL "app" +') == b'\n00\r'
+
+def test_errors():
+    model = sbemu.ModuleModel(max_write=4, fwr=False, capacity=6)
+    assert command(model, 'AT+FWRH "00"') == b'\n01\tE038\r'
+    assert command(model, 'AT+FCL') == b'\n01\tE037\r'
+    assert command(model, 'AT+NOPE') == b'\n01\tE007\r'
+    command(model, 'AT+FOW "app"')
+    assert command(model, 'AT+FOW "other"') == b'\n01\tE00E\r'
+    assert command(model, 'AT+FWR "ab"') == b'\n01\tE007\r'
+    assert command(model, 'AT+FWRH "0001020304"') == b'\n01\tE021\r'
+    assert command(model, 'AT+FWRH "00010203"') == b'\n00\r'
+    assert command(model, 'AT+FWRH "000102"') == b'\n01\tE010\r'
+    assert model.faults == 7
+
+def test_config_and_format():
+    model = sbemu.ModuleModel()
+    assert command(model, 'AT+CFG 100 0x10') == b'\n00\r'
+    assert command(model, 'AT+CFG 100 ?') == b'\n27\t100\t16 (0x00000010)\r\n00\r'
+    command(model, 'AT+FOW "app"')
+    command(model, 'AT+FCL')
+    assert command(model, 'AT&F 1') == b'\n00\r'
+    assert model.files == {}
+
+def test_text_that_is_not_a_command_is_ignored():
+    model = sbemu.ModuleModel()
+    assert command(model, 'hello') == b''
+
+def test_bldevice_over_a_pty(module):
+    model = sbemu.ModuleModel()
+    path = module(model)
+    device = blutilc.BLDevice(argparse.Namespace(port=path, baud=115200, no_compile_cache=True, no_identity_cache=True))
+    try:
+        device.detect_model()
+        device.upload_data('app', b'print "hi"\n')
+        assert device.writecmd('+DIR') == '06\tapp'
+        device.delete('app.uwc')
+    finally:
+        device.port.close()
+    assert device.model == sbemu.DEFAULT_MODEL
+    assert device.langhash == sbemu.DEFAULT_LANGHASH.split()
+    assert model.files == {}
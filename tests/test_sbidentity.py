@@ -0,0 +1,89 @@
+"""
+The module identity cache of sbidentity, its expiry and its invalidation by a firmware download
+"""
+import argparse
+
+import pytest
+
+import blutilc
+import sbemu
+import sbidentity
+import uwfloader
+
+IDENTITY = ('BL654', '29.4.6.0', ['9E56', '5F81'])
+
+@pytest.fixture
+def usb(monkeypatch):
+    """ Makes the ports in the returned dict look like USB adapters with those serial numbers """
+    serials = {}
+    monkeypatch.setattr(sbidentity, 'port_fingerprint', lambda port: serials.get(port))
+    return serials
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(sbidentity.time, 'time', lambda: now[0])
+    return now
+
+def test_saved_per_port_and_adapter(usb, tmp_path):
+    usb.update({'/dev/ttyUSB0': 'A1', '/dev/ttyUSB1': 'B2'})
+    cache = sbidentity.IdentityCache(str(tmp_path / 'identity.json'))
+    cache.save('/dev/ttyUSB0', *IDENTITY)
+    assert cache.load('/dev/ttyUSB0') == IDENTITY
+    assert cache.load('/dev/ttyUSB1') is None
+    # Another adapter plugged into the same port
+    usb['/dev/ttyUSB0'] = 'C3'
+    assert cache.load('/dev/ttyUSB0') is None
+
+def test_ports_that_are_not_usb_are_not_cached(usb, tmp_path):
+    cache = sbidentity.IdentityCache(str(tmp_path / 'identity.json'))
+    cache.save('/dev/ttyS0', *IDENTITY)
+    assert cache.load('/dev/ttyS0') is None
+    assert cache.read() == {}
+
+def test_entries_expire(usb, clock, tmp_path):
+    usb.update({'/dev/ttyUSB0': 'A1', '/dev/ttyUSB1': 'B2'})
+    cache = sbidentity.IdentityCache(str(tmp_path / 'identity.json'), ttl=60)
+    cache.save('/dev/ttyUSB0', *IDENTITY)
+    clock[0] += 60
+    assert cache.load('/dev/ttyUSB0') == IDENTITY
+    clock[0] += 1
+    assert cache.load('/dev/ttyUSB0') is None
+    # Saving another drops the expired entry
+    cache.save('/dev/ttyUSB1', *IDENTITY)
+    assert list(cache.read()) == ['/dev/ttyUSB1|B2']
+
+def test_invalidate_drops_only_that_port(usb, tmp_path):
+    usb.update({'/dev/ttyUSB0': 'A1', '/dev/ttyUSB1': 'B2'})
+    cache = sbidentity.IdentityCache(str(tmp_path / 'identity.json'))
+    cache.save('/dev/ttyUSB0', *IDENTITY)
+    cache.save('/dev/ttyUSB1', *IDENTITY)
+    cache.invalidate('/dev/ttyUSB0')
+    assert cache.load('/dev/ttyUSB0') is None
+    assert cache.load('/dev/ttyUSB1') == IDENTITY
+
+def test_detect_model_uses_the_cache(usb, module, tmp_path):
+    model = sbemu.ModuleModel()
+    path = module(model)
+    usb[path] = 'A1'
+    args = argparse.Namespace(port=path, baud=115200, no_compile_cache=True)
+    for i in range(2):
+        device = blutilc.BLDevice(args)
+        device.identity_cache = sbidentity.IdentityCache(str(tmp_path / 'identity.json'))
+        try:
+            device.detect_model()
+        finally:
+            device.port.close()
+        assert (device.model, device.version, device.langhash) == (sbemu.DEFAULT_MODEL, sbemu.DEFAULT_VERSION,
+                                                                   sbemu.DEFAULT_LANGHASH.split())
+    assert model.counts['I'] == 3
+
+def test_firmware_download_drops_the_identity(usb, loopback, write_image, make_data, tmp_path):
+    usb['loopback0'] = 'A1'
+    identity_path = str(tmp_path / 'identity.json')
+    sbidentity.IdentityCache(identity_path).save('loopback0', *IDENTITY)
+    device = loopback(name='loopback0')
+
+    assert uwfloader.loadfirmware(device, device.baudrate, write_image('image.uwf', make_data(4096, 1)), 'GENERIC',
+                                  journal_path=None, identity_path=identity_path) == uwfloader.EXIT_CODE_SUCCESS
+    assert sbidentity.IdentityCache(identity_path).load('loopback0') is None
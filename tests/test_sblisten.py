@@ -0,0 +1,101 @@
+"""
+Line splitting, the line ring, the sinks and the listen engine of sblisten
+"""
+import io
+import json
+import threading
+import time
+
+import serial
+
+import sblisten
+from sblisten import ListenLine
+
+def test_lines_split_across_reads():
+    splitter = sblisten.LineSplitter()
+    assert splitter.feed(b'one\r\ntw', 1.0) == [(1.0, 'one')]
+    assert splitter.feed(b'o\nthree\nfo', 2.0) == [(1.0, 'two'), (2.0, 'three')]
+    assert splitter.started == 2.0
+    assert splitter.flush() == (2.0, 'fo')
+    assert splitter.flush() is None
+    assert splitter.started is None
+
+def test_a_character_split_across_reads_is_held_back():
+    splitter = sblisten.LineSplitter()
+    text = 'café\n'.encode('utf-8')
+    assert splitter.feed(text[:4], 1.0) == []
+    assert splitter.flush() == (1.0, 'caf')
+    assert splitter.feed(text[4:], 2.0) == [(2.0, 'é')]
+    assert splitter.feed(b'\xff\n', 3.0) == [(3.0, '�')]
+
+def test_ring_drops_the_oldest_lines():
+    ring = sblisten.LineRing(3)
+    ring.put([ListenLine(i, i, str(i), True, 'a' if i < 3 else 'b') for i in range(5)])
+    assert ring.dropped == 2
+    assert ring.dropped_ports['a'] == 2
+    assert [line.text for line in ring.take()] == ['2', '3', '4']
+    ring.close()
+    assert ring.take() == []
+
+def test_text_sink_carries_on_partial_lines():
+    stream = io.StringIO()
+    sink = sblisten.TextSink(stream, timestamps=True)
+    sink.write([ListenLine(1.5, 0, 'prompt> ', False), ListenLine(2.0, 0, 'answer', True),
+                ListenLine(3.0, 0, 'next', True)])
+    assert stream.getvalue() == '[     1.500] prompt> answer\n[     3.000] next\n'
+
+def test_text_sink_tags_the_lines_of_each_port():
+    stream = io.StringIO()
+    sink = sblisten.TextSink(stream)
+    sink.write([ListenLine(1.0, 0, 'a', False, 'p1', 'BL654'), ListenLine(1.1, 0, 'b', True, 'p2', None),
+                ListenLine(1.2, 0, 'c', True, 'p1', 'BL654')])
+    assert stream.getvalue() == 'p1 BL654: ap2 ?: b\nc\n'
+
+def test_rotating_file_sink(tmp_path):
+    path = str(tmp_path / 'listen.log')
+    sink = sblisten.RotatingFileSink(path, max_bytes=10, backups=2)
+    for text in ['first', 'second', 'third', 'fourth']:
+        sink.write([ListenLine(0, 0, text, True)])
+    sink.close()
+    assert open(path).read() == 'fourth\n'
+    assert open(f"{path}.1").read() == 'third\n'
+    assert open(f"{path}.2").read() == 'second\n'
+
+def test_jsonl_sink(tmp_path):
+    path = str(tmp_path / 'listen.jsonl')
+    sink = sblisten.JsonlSink(path)
+    sink.write([ListenLine(1.25, 100.5, 'hello', True), ListenLine(2.0, 101.0, '>', False, 'p1', 'BL654')])
+    sink.close()
+    records = [json.loads(line) for line in open(path)]
+    assert records == [{'t': 1.25, 'time': 100.5, 'line': 'hello', 'partial': False},
+                       {'t': 2.0, 'time': 101.0, 'line': '>', 'partial': True, 'port': 'p1', 'model': 'BL654'}]
+
+class ListSink():
+    def __init__(self):
+        self.lines = []
+
+    def write(self, lines):
+        self.lines += lines
+
+    def close(self):
+        pass
+
+def test_engine_passes_on_lines_and_the_last_partial_line():
+    port = serial.serial_for_url('loop://', timeout=0.5)
+    sink = ListSink()
+    engine = sblisten.ListenEngine(port, [sink])
+    port.write(b'one\ntwo\nprompt> ')
+    thread = threading.Thread(target=engine.run, args=(b'before\n',))
+    thread.start()
+    try:
+        deadline = time.monotonic() + 5
+        while len(sink.lines) < 4 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        engine.stop()
+        thread.join()
+        port.close()
+    assert [(line.text, line.complete) for line in sink.lines] == [('before', True), ('one', True), ('two', True), ('prompt> ', False)]
+    assert engine.lines == 3
+    # The port's own timeout is put back
+    assert port.timeout == 0.5
@@ -0,0 +1,59 @@
+"""
+Merging of the lines of several ports by sbmonitor.Monitor, fed directly rather than read
+"""
+import os
+
+import pytest
+
+import sbmonitor
+
+@pytest.fixture
+def ports():
+    if not hasattr(os, 'openpty'):
+        pytest.skip('needs pseudo terminals')
+    fds = [os.openpty() for i in range(2)]
+    yield [os.ttyname(slave) for master, slave in fds]
+    for master, slave in fds:
+        os.close(master)
+        os.close(slave)
+
+@pytest.fixture
+def monitor(ports):
+    monitor = sbmonitor.Monitor(ports, 115200, [], partial_sec=1.0, partial_chars=100)
+    yield monitor
+    for port in monitor.monitors:
+        port.port.close()
+
+def released(monitor):
+    return [(line.port, line.text, line.complete) for line in monitor.ring.lines]
+
+def test_lines_are_merged_in_the_order_they_started(monitor, ports):
+    a, b = monitor.monitors
+    t = monitor.origin
+    monitor.feed(a, b'one', t + 0.1)
+    monitor.feed(b, b'two\n', t + 0.2)
+    assert released(monitor) == []
+    monitor.feed(a, b'\n', t + 0.3)
+    assert released(monitor) == [(ports[0], 'one', True), (ports[1], 'two', True)]
+
+def test_a_partial_line_is_cut_after_partial_sec(monitor, ports):
+    a, b = monitor.monitors
+    t = monitor.origin
+    monitor.feed(a, b'no end', t + 0.1)
+    monitor.feed(b, b'two\n', t + 0.2)
+    monitor.feed(a, b' yet', t + 1.0)
+    assert released(monitor) == []
+    monitor.feed(a, b'...', t + 1.2)
+    assert released(monitor) == [(ports[0], 'no end yet...', False), (ports[1], 'two', True)]
+    assert a.cut_lines == 1
+    assert a.overruns() >= 1
+    assert b.cut_lines == 0
+
+def test_a_partial_line_is_cut_at_partial_chars(monitor, ports):
+    a, b = monitor.monitors
+    t = monitor.origin
+    monitor.feed(b, b'two\n', t + 0.1)
+    monitor.feed(a, b'x' * 60, t + 0.2)
+    monitor.feed(a, b'x' * 60, t + 0.3)
+    assert released(monitor) == [(ports[1], 'two', True), (ports[0], 'x' * 120, False)]
+    assert a.cut_lines == 1
@@ -0,0 +1,62 @@
+"""
+#include expansion by sbpreprocess.Preprocessor
+"""
+import os
+
+import pytest
+
+from sbpreprocess import Preprocessor, IncludeError
+
+def write(path, lines):
+    path.write_text('\n'.join(lines) + '\n')
+    return str(path)
+
+def test_line_map_points_into_the_included_files(tmp_path):
+    lib = write(tmp_path / 'lib.sb', ['sub Lib()', 'endsub'])
+    main = write(tmp_path / 'main.sb', ['dim a', '#include "lib.sb"', 'Lib()'])
+    preprocessor = Preprocessor()
+
+    assert preprocessor.expand(main) == 'dim a\nsub Lib()\nendsub\nLib()\n'
+    assert preprocessor.line_map == [(main, 1), (lib, 1), (lib, 2), (main, 3)]
+    assert preprocessor.original_location(3) == (lib, 2)
+    assert preprocessor.original_location(5) is None
+
+def test_include_cycle(tmp_path):
+    write(tmp_path / 'a.sb', ['#include "b.sb"'])
+    write(tmp_path / 'b.sb', ['#include "a.sb"'])
+
+    with pytest.raises(IncludeError, match='Include cycle: .*a.sb -> .*b.sb -> .*a.sb'):
+        Preprocessor().expand(str(tmp_path / 'a.sb'))
+
+def test_a_file_included_twice_is_not_a_cycle(tmp_path):
+    write(tmp_path / 'lib.sb', ['x = 1'])
+    main = write(tmp_path / 'main.sb', ['#include "lib.sb"', '#include "lib.sb"'])
+
+    assert Preprocessor().expand(main) == 'x = 1\nx = 1\n'
+
+def test_dependency_graph(tmp_path):
+    leaf = write(tmp_path / 'leaf.sb', ['y = 2'])
+    lib = write(tmp_path / 'lib.sb', ['#include "leaf.sb"'])
+    main = write(tmp_path / 'main.sb', ['#include "lib.sb"', '#include "leaf.sb"'])
+    preprocessor = Preprocessor()
+    preprocessor.expand(main)
+
+    assert preprocessor.graph == {main: [lib, leaf], lib: [leaf], leaf: []}
+    assert preprocessor.dependencies() == sorted([main, lib, leaf])
+
+def test_stale_after_an_included_file_is_touched(tmp_path):
+    lib = write(tmp_path / 'lib.sb', ['x = 1'])
+    main = write(tmp_path / 'main.sb', ['#include "lib.sb"'])
+    target = tmp_path / 'main.uwc'
+    preprocessor = Preprocessor()
+    preprocessor.expand(main)
+
+    assert preprocessor.is_stale(str(target))
+    target.write_bytes(b'compiled')
+    built = os.path.getmtime(target)
+    for path in (main, lib):
+        os.utime(path, (built - 10, built - 10))
+    assert not preprocessor.is_stale(str(target))
+
+    os.utime(lib, (built + 10, built + 10))
+    assert preprocessor.is_stale(str(target))
@@ -0,0 +1,79 @@
+"""
+SectorMap against the SectorMapIter walk that uwf_processor used before it
+"""
+import random
+import struct
+
+import pytest
+
+from uwf_sector_map import SectorMap
+
+class SectorMapIter():
+    """ The iterator SectorMap replaced, as it was in uwf_processor """
+    def __init__(self, tupSectors, tupSectorSz, nOffsetStart, nOffsetEnd):
+        if len(tupSectors)>0 and len(tupSectors) == len(tupSectorSz):
+            self.tSectors = tupSectors
+            self.tSectorSz = tupSectorSz
+        else:
+            raise Exception('Sector map invalid')
+        self.nOffset    = nOffsetStart
+        self.nOffsetEnd = nOffsetEnd
+
+    def __iter__(self):
+        self.tuple_Idx=0
+        self.sector_num=0
+        self.sectorThisBase=0
+        return self
+
+    def __next__(self):
+        for idx in range(self.tuple_Idx,len(self.tSectors)):
+            sector_numof=self.tSectors[idx]
+            sector_size =self.tSectorSz[idx]
+            for num in range(self.sector_num,sector_numof):
+                sectorNextBase = self.sectorThisBase + sector_size
+                if self.nOffset < sectorNextBase:
+                    self.nOffset = sectorNextBase
+                    self.sector_num=num
+                    self.tuple_Idx=idx
+                    return self.sectorThisBase
+                self.sectorThisBase=sectorNextBase
+                #check if above range end
+                if sectorNextBase >= self.nOffsetEnd:
+                    raise StopIteration
+            self.sector_num=0
+        raise StopIteration
+
+def old_sectors_in(runs, start, end):
+    return list(SectorMapIter([count for count, size in runs], [size for count, size in runs], start, end))
+
+def test_sectors_in_matches_the_old_walk():
+    rng = random.Random(0)
+    for i in range(2000):
+        runs = [(rng.randint(1, 5), rng.choice((256, 1024, 4096))) for run in range(rng.randint(1, 4))]
+        sector_map = SectorMap(runs)
+        start = rng.randrange(sector_map.size)
+        end = rng.randint(start + 1, sector_map.size)
+        assert sector_map.sectors_in(start, end) == old_sectors_in(runs, start, end), (runs, start, end)
+
+def test_sector_at_matches_the_old_walk():
+    runs = [(2, 4096), (3, 1024), (1, 16384)]
+    sector_map = SectorMap(runs)
+    for ofs in range(0, sector_map.size, 512):
+        start, size = sector_map.sector_at(ofs)
+        assert old_sectors_in(runs, ofs, ofs + 1) == [start]
+        assert start <= ofs < start + size
+
+def test_from_payload():
+    payload = struct.pack('<IIII', 4, 4096, 2, 65536)
+    sector_map = SectorMap.from_payload(payload, len(payload))
+    assert sector_map.runs == ((4, 4096), (2, 65536))
+    assert sector_map.size == 4 * 4096 + 2 * 65536
+    assert len(sector_map) == 6
+    assert sector_map.valid()
+    with pytest.raises(Exception):
+        SectorMap.from_payload(payload, len(payload) - 4)
+
+def test_offset_outside_the_map():
+    sector_map = SectorMap([(2, 4096)])
+    with pytest.raises(Exception):
+        sector_map.sector_at(2 * 4096)
@@ -0,0 +1,77 @@
+"""
+The adaptive block size and verify interval of uwf_tuning, and a download that uses them
+"""
+import uwf_stats
+import uwf_tuning
+import uwfloader
+from uwf_tuning import UwfTuner, GROW_AFTER_WINDOWS, RELAX_AFTER_WINDOWS, MAX_RETRIES
+
+SIZE = 16 * 1024
+
+def ack_windows(tuner, count):
+    for i in range(count):
+        tuner.window_acked()
+
+def test_grows_the_block_size_then_the_verify_interval():
+    tuner = UwfTuner(128, 4)
+    ack_windows(tuner, GROW_AFTER_WINDOWS - 1)
+    assert (tuner.block_size, tuner.verify_limit) == (128, 4)
+    ack_windows(tuner, 1)
+    assert (tuner.block_size, tuner.verify_limit) == (192, 4)
+    ack_windows(tuner, GROW_AFTER_WINDOWS)
+    assert (tuner.block_size, tuner.verify_limit) == (252, 4)
+    ack_windows(tuner, GROW_AFTER_WINDOWS)
+    assert (tuner.block_size, tuner.verify_limit) == (252, 8)
+    assert tuner.best == (252, 4)
+
+def test_steps_down_and_stays_below_what_failed():
+    tuner = UwfTuner(192, 8)
+    assert tuner.failed()
+    assert (tuner.block_size, tuner.verify_limit) == (128, 4)
+    # Clean windows do not grow back to the settings that failed
+    ack_windows(tuner, RELAX_AFTER_WINDOWS - 1)
+    assert (tuner.block_size, tuner.verify_limit) == (128, 4)
+    # Until enough of them in a row were clean
+    ack_windows(tuner, GROW_AFTER_WINDOWS)
+    assert tuner.block_size == 192
+
+def test_gives_up_after_failures_in_a_row():
+    tuner = UwfTuner(64, 2)
+    for i in range(MAX_RETRIES):
+        assert tuner.failed()
+    assert (tuner.block_size, tuner.verify_limit) == (64, 2)
+    assert not tuner.failed()
+    tuner = UwfTuner(64, 2)
+    for i in range(MAX_RETRIES + 1):
+        tuner.window_acked()
+        assert tuner.failed()
+
+def test_settings_not_in_the_steps_start_at_the_one_below():
+    tuner = UwfTuner(200, 5)
+    assert (tuner.block_size, tuner.verify_limit) == (192, 4)
+    tuner = UwfTuner(16, 1)
+    assert (tuner.block_size, tuner.verify_limit) == (64, 2)
+
+def test_remembered_per_device_type(tmp_path):
+    tuning = uwf_tuning.UwfTuning(str(tmp_path / 'tuning.json'))
+    assert tuning.load('BL654') is None
+    tuning.save('BL654', 252, 8)
+    tuning.save('BL653', 64, 2)
+    assert tuning.load('BL654') == (252, 8)
+    assert tuning.load('BL653') == (64, 2)
+
+def test_adaptive_download_steps_down_after_a_nak(loopback, write_image, make_data, tmp_path):
+    data = make_data(SIZE, 1)
+    tuning_path = str(tmp_path / 'tuning.json')
+    uwf_tuning.UwfTuning(tuning_path).save('GENERIC', 252, 16)
+    # Well into the write
+    device = loopback(nak_at=(60,))
+    stats = uwf_stats.UwfStats()
+
+    assert uwfloader.loadfirmware(device, device.baudrate, write_image('image.uwf', data), 'GENERIC', pipeline_window=0,
+                                  adaptive=True, tuning_path=tuning_path, journal_path=None, identity_path=None,
+                                  observer=stats) == uwfloader.EXIT_CODE_SUCCESS
+    assert stats.retries['tuning'] == 1
+    assert device.flash[:SIZE] == data
+    # What was verified after the NAK is remembered for the next download
+    assert uwf_tuning.UwfTuning(tuning_path).load('GENERIC') == (192, 8)
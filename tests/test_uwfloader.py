@@ -0,0 +1,191 @@
+"""
+Firmware downloads through uwfloader to the in-process bootloader of uwfemu
+"""
+import pytest
+
+import uwf_image
+import uwf_journal
+import uwf_processor
+import uwf_stats
+import uwfemu
+import uwfloader
+
+SECTOR_SIZE = uwfemu.DEFAULT_SECTOR_SIZE
+SIZE = 4 * SECTOR_SIZE
+
+def load(device, image_path, **options):
+    options.setdefault('journal_path', None)
+    options.setdefault('identity_path', None)
+    return uwfloader.loadfirmware(device, device.baudrate, image_path, 'GENERIC', **options)
+
+def test_nak_in_pipeline_falls_back_to_stop_and_wait(loopback, write_image, make_data):
+    data = make_data(SIZE, 1)
+    image_path = write_image('image.uwf', data)
+    # The platform, 4 erases, then well into the write, data and verify frames
+    device = loopback(nak_at=(30,))
+    stats = uwf_stats.UwfStats()
+
+    assert load(device, image_path, pipeline_window=8, observer=stats) == uwfloader.EXIT_CODE_SUCCESS
+    assert device.model.faults == 1
+    assert stats.retries['pipeline'] == 1
+    assert device.flash[:SIZE] == data
+
+def test_nak_in_one_region_keeps_the_pipeline_for_the_next(loopback, write_image, make_data):
+    data = make_data(SIZE, 2)
+    image_path = write_image('regions.uwf', data, regions=2)
+    device = loopback(nak_at=(10,))
+    processor = uwf_processor.new_processor('GENERIC', device, device.baudrate)
+
+    with uwf_image.UwfImage(image_path) as image:
+        error = processor.run(uwfloader.download(processor, image, 'GENERIC', 8,
+                                                 journal_path=None, identity_path=None))
+    assert error is None
+    assert device.model.faults == 1
+    assert processor.pipeline_window == 8
+    assert device.flash[:SIZE] == data
+
+@pytest.mark.parametrize('max_baudrate, retries', [(921600, 1), (460800, 2), (115200, 3)])
+def test_baud_ladder_drops_back_to_a_rate_that_syncs(loopback, write_image, make_data, max_baudrate, retries):
+    data = make_data(SIZE, 14)
+    device = loopback(max_baudrate=max_baudrate)
+    stats = uwf_stats.UwfStats()
+
+    assert load(device, write_image('image.uwf', data), baud_ladder=(1000000, 921600, 460800),
+                observer=stats) == uwfloader.EXIT_CODE_SUCCESS
+    assert device.baudrate == max_baudrate
+    assert stats.retries['baud'] == retries
+    assert device.flash[:SIZE] == data
+
+def test_delta_skips_the_sectors_already_in_place(loopback, write_image, make_data):
+    data = make_data(SIZE, 4)
+    changed = bytearray(data)
+    changed[SECTOR_SIZE + 100] ^= 0xFF
+    device = loopback()
+    assert load(device, write_image('image.uwf', data)) == uwfloader.EXIT_CODE_SUCCESS
+
+    device.model.counts.clear()
+    assert load(device, write_image('changed.uwf', bytes(changed)), delta=True) == uwfloader.EXIT_CODE_SUCCESS
+    assert device.model.counts['e'] == 1
+    # Only the blocks of the changed sector are written
+    assert device.model.counts['d'] <= -(-SECTOR_SIZE // uwf_processor.DATA_BLOCK_SIZE) + 1
+    assert device.flash[:SIZE] == changed
+
+def test_resume_continues_from_the_checkpoint(loopback, write_image, make_data, tmp_path):
+    data = make_data(SIZE, 3)
+    image_path = write_image('image.uwf', data)
+    journal_path = str(tmp_path / 'journal.json')
+    # A NAK part way through the write fails a stop-and-wait download, the journal is keyed on
+    # the device name
+    device = loopback(nak_at=(40,), name='loopback0')
+
+    assert load(device, image_path, pipeline_window=0, journal_path=journal_path) != uwfloader.EXIT_CODE_SUCCESS
+    assert device.flash[:SIZE] != data
+
+    device.model.counts.clear()
+    assert load(device, image_path, pipeline_window=0, resume=True,
+                journal_path=journal_path) == uwfloader.EXIT_CODE_SUCCESS
+    assert device.model.counts['e'] == 0
+    # The blocks verified before the NAK are not written again
+    assert device.model.counts['d'] < -(-SIZE // uwf_processor.DATA_BLOCK_SIZE)
+    assert device.flash[:SIZE] == data
+    # A finished download leaves nothing to resume
+    assert uwf_journal.UwfJournal(journal_path).read() == {}
+
+@pytest.mark.parametrize('nak_at', [(8,), (20,)])
+def test_scheduler_falls_back_after_a_nak(loopback, write_image, make_data, nak_at):
+    data = make_data(SIZE, 5)
+    image_path = write_image('regions.uwf', data, regions=2)
+    device = loopback(nak_at=nak_at)
+
+    assert load(device, image_path, pipeline_window=8, schedule=True) == uwfloader.EXIT_CODE_SUCCESS
+    assert device.model.faults == 1
+    assert device.model.counts['a'] == 2
+    assert device.flash[:SIZE] == data
+
+def test_schedule_needs_a_pipeline(loopback, write_image, make_data):
+    image_path = write_image('image.uwf', make_data(SIZE, 6))
+    device = loopback()
+
+    assert load(device, image_path, pipeline_window=1, schedule=True) != uwfloader.EXIT_CODE_SUCCESS
+    assert device.model.commands == 0
+
+def test_another_download_drops_the_checkpoint(loopback, write_image, make_data, tmp_path):
+    data = make_data(SIZE, 7)
+    other = make_data(SIZE, 8)
+    image_path = write_image('image.uwf', data)
+    journal_path = str(tmp_path / 'journal.json')
+    device = loopback(nak_at=(40,), name='loopback0')
+    assert load(device, image_path, pipeline_window=0, resume=True,
+                journal_path=journal_path) != uwfloader.EXIT_CODE_SUCCESS
+    assert uwf_journal.UwfJournal(journal_path).read() != {}
+
+    # Flashed without resuming, its erases make the checkpoint of the first image out of date
+    assert load(device, write_image('other.uwf', other), journal_path=journal_path) == uwfloader.EXIT_CODE_SUCCESS
+    assert uwf_journal.UwfJournal(journal_path).read() == {}
+
+    assert load(device, image_path, pipeline_window=0, resume=True,
+                journal_path=journal_path) == uwfloader.EXIT_CODE_SUCCESS
+    assert device.flash[:SIZE] == data
+
+def test_resume_checks_the_flash_before_skipping_the_erase(loopback, write_image, make_data, tmp_path):
+    data = make_data(SIZE, 9)
+    image_path = write_image('image.uwf', data)
+    journal_path = str(tmp_path / 'journal.json')
+    device = loopback(nak_at=(40,), name='loopback0')
+    assert load(device, image_path, pipeline_window=0, resume=True,
+                journal_path=journal_path) != uwfloader.EXIT_CODE_SUCCESS
+
+    # Changed behind the journal's back, e.g. by another tool
+    device.flash[:SIZE] = make_data(SIZE, 10)
+    device.model.counts.clear()
+    assert load(device, image_path, pipeline_window=0, resume=True,
+                journal_path=journal_path) == uwfloader.EXIT_CODE_SUCCESS
+    assert device.model.counts['e'] == SIZE // SECTOR_SIZE
+    assert device.flash[:SIZE] == data
+
+class LosingBootloaderModel(uwfemu.BootloaderModel):
+    """ Acknowledges the data frames numbered in 'lost', counting from 1, without writing them """
+    def __init__(self, lost):
+        uwfemu.BootloaderModel.__init__(self)
+        self.lost = set(lost)
+        self.data_frames = 0
+
+    def handle(self, frame):
+        if frame[:1] == b'd':
+            self.data_frames += 1
+            if self.data_frames in self.lost:
+                self.commands += 1
+                return b'a'
+        return uwfemu.BootloaderModel.handle(self, frame)
+
+@pytest.mark.parametrize('lost', [1, 8, 66])
+def test_every_data_block_is_verified(write_image, make_data, lost):
+    # The first block of a verify window, the last one, which sends the verify, and the last of all
+    device = uwfemu.LoopbackBootloader(LosingBootloaderModel((lost,)), latency=0.0)
+    assert load(device, write_image('image.uwf', make_data(SIZE, 11)), pipeline_window=0) != uwfloader.EXIT_CODE_SUCCESS
+
+@pytest.mark.parametrize('nak_at', [(30,), (33,)])
+def test_nak_in_pipeline_resyncs_and_rewinds_the_progress(loopback, write_image, make_data, nak_at):
+    # A NAK on a write frame and on a verify frame
+    data = make_data(SIZE, 12)
+    device = loopback(nak_at=nak_at)
+    progress = []
+
+    assert load(device, write_image('image.uwf', data), pipeline_window=8,
+                progress=lambda written, total: progress.append(written)) == uwfloader.EXIT_CODE_SUCCESS
+    # The sync at the start and the one after the NAK
+    assert device.model.counts['a'] == 2
+    assert max(progress) == progress[-1] == SIZE
+    assert device.flash[:SIZE] == data
+
+@pytest.mark.parametrize('pipeline_window', [0, 8])
+def test_each_sector_erase_is_a_phase(loopback, write_image, make_data, pipeline_window):
+    device = loopback(erase_time=0.02)
+    stats = uwf_stats.UwfStats()
+
+    assert load(device, write_image('regions.uwf', make_data(SIZE, 13), regions=2),
+                pipeline_window=pipeline_window, observer=stats) == uwfloader.EXIT_CODE_SUCCESS
+    erases = [(detail, seconds) for name, start, seconds, detail in stats.phases if name == 'erase']
+    assert [detail for detail, seconds in erases] == [uwfemu.DEFAULT_BASE_ADDRESS + n * SECTOR_SIZE for n in range(4)]
+    # Waiting behind the sector before it is not counted
+    assert all(0.015 < seconds < 0.05 for detail, seconds in erases)
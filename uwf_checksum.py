@@ -0,0 +1,38 @@
+##########################################################################################
+# Checksums of firmware data blocks as expected by the bootloader 'd' and 'v' commands
+##########################################################################################
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+CHECKSUM_LSB_MASK = 0xFF
+CHECKSUM_MASK = 0xFFFFFFFF
+
+def block_checksum(data):
+    """
+    Returns the sum of all bytes in 'data'
+    The 'd' command only sends the LSB of this, the 'v' command sends it in full
+    """
+    return sum(memoryview(data).cast('B'))
+
+def block_checksums(data, block_size):
+    """
+    Returns a list with the checksum of each 'block_size' chunk of 'data' in one pass
+    The last entry covers the remainder when len(data) is not a multiple of 'block_size'
+    """
+    view = memoryview(data).cast('B')
+    if numpy is not None and len(view) >= block_size:
+        whole = len(view) - (len(view) % block_size)
+        array = numpy.frombuffer(view, dtype=numpy.uint8)
+        sums = array[:whole].reshape(-1, block_size).sum(axis=1, dtype=numpy.uint32).tolist()
+        if whole < len(view):
+            sums.append(int(array[whole:].sum(dtype=numpy.uint32)))
+        return sums
+    return [sum(view[i:i+block_size]) for i in range(0, len(view), block_size)]
+
+def verify_checksum(checksums):
+    """
+    Returns the running checksum sent with the 'v' command for the given block checksums
+    """
+    return sum(checksums) & CHECKSUM_MASK
@@ -0,0 +1,147 @@
+##########################################################################################
+# Memory mapped, pre-validated index of the commands in a .uwf firmware file
+##########################################################################################
+import hashlib
+import mmap
+import struct
+
+UWF_COMMAND_HEADER_LENGTH = 6
+UWF_TARGET_PLATFORM_LENGTH = 4
+UWF_REGISTER_DEVICE_LENGTH = 11
+UWF_SELECT_DEVICE_LENGTH = 2
+UWF_SECTOR_MAP_LENGTH = 8
+UWF_ERASE_BLOCK_LENGTH = 8
+UWF_WRITE_BLOCK_LENGTH = 8
+UWF_UNREGISTER_DEVICE_LENGTH = 1
+
+UWF_OFFSET_HEADER_COMMAND_ID = 1
+UWF_OFFSET_HEADER_LENGTH_START = 2
+UWF_OFFSET_HEADER_LENGTH_END = 6
+
+UWF_COMMAND_TARGET_PLATFORM = 'T'
+UWF_COMMAND_REGISTER = 'G'
+UWF_COMMAND_SELECT = 'S'
+UWF_COMMAND_SECTOR_MAP = 'M'
+UWF_COMMAND_ERASE = 'E'
+UWF_COMMAND_WRITE = 'W'
+UWF_COMMAND_UNREGISTER = 'U'
+
+ERROR_IMAGE = 'UwfImage: {}'
+
+class UwfCommand():
+    """
+    One command from a .uwf file
+    'offset' is where the 6 byte header starts in the file and 'payload' is a zero-copy
+    memoryview of the 'length' bytes of data that follow it
+    """
+    def __init__(self, index, cmd, offset, length, payload, region):
+        self.index = index
+        self.cmd = cmd
+        self.offset = offset
+        self.length = length
+        self.payload = payload
+        # Index of the select command this command follows, None before the first one
+        self.region = region
+
+    def __repr__(self):
+        return f"UwfCommand({self.index}, '{self.cmd}', offset=0x{self.offset:x}, length={self.length})"
+
+class UwfImage():
+    """
+    Maps a .uwf file into memory once, validates every command header and length up front
+    and indexes the commands so that any number of downloads can share them read-only
+    """
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.commands = []
+        self.sha256 = None
+        with open(file_path, 'rb') as f:
+            try:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise Exception(ERROR_IMAGE.format(f"{file_path} is empty"))
+        self.view = memoryview(self.mm)
+        try:
+            self.build_index()
+        except:
+            self.close()
+            raise
+
+    def build_index(self):
+        pos = 0
+        region = None
+        while pos < len(self.view):
+            if pos + UWF_COMMAND_HEADER_LENGTH > len(self.view):
+                raise Exception(ERROR_IMAGE.format(f"Truncated command header at offset 0x{pos:x}"))
+            header = self.view[pos:pos+UWF_COMMAND_HEADER_LENGTH]
+            cmd = chr(header[0])
+            length = struct.unpack('<I', header[UWF_OFFSET_HEADER_LENGTH_START:UWF_OFFSET_HEADER_LENGTH_END])[0]
+            start = pos + UWF_COMMAND_HEADER_LENGTH
+            if start + length > len(self.view):
+                raise Exception(ERROR_IMAGE.format(f"Truncated '{cmd}' command data at offset 0x{pos:x}"))
+            if not self.valid_length(cmd, length):
+                raise Exception(ERROR_IMAGE.format(f"Invalid length {length} for '{cmd}' command at offset 0x{pos:x}"))
+            if cmd == UWF_COMMAND_SELECT:
+                region = len(self.commands)
+            self.commands.append(UwfCommand(len(self.commands), cmd, pos, length, self.view[start:start+length], region))
+            pos = start + length
+
+    def valid_length(self, cmd, length):
+        if cmd == UWF_COMMAND_TARGET_PLATFORM:
+            return length == UWF_TARGET_PLATFORM_LENGTH
+        elif cmd == UWF_COMMAND_REGISTER:
+            return length == UWF_REGISTER_DEVICE_LENGTH
+        elif cmd == UWF_COMMAND_SELECT:
+            return length == UWF_SELECT_DEVICE_LENGTH
+        elif cmd == UWF_COMMAND_SECTOR_MAP:
+            return length > 0 and length % UWF_SECTOR_MAP_LENGTH == 0
+        elif cmd == UWF_COMMAND_ERASE:
+            return length == UWF_ERASE_BLOCK_LENGTH
+        elif cmd == UWF_COMMAND_WRITE:
+            return length >= UWF_WRITE_BLOCK_LENGTH
+        elif cmd == UWF_COMMAND_UNREGISTER:
+            return length == UWF_UNREGISTER_DEVICE_LENGTH
+        # Unknown commands are skipped when downloading
+        return True
+
+    def region_commands(self, command, cmd):
+        """
+        Returns the 'cmd' commands that follow the same select command as 'command'
+        """
+        return [other for other in self.commands if other.region == command.region and other.cmd == cmd]
+
+    def write_data_length(self):
+        """
+        Returns the number of bytes of firmware data the write commands will send
+        """
+        return sum([command.length - UWF_WRITE_BLOCK_LENGTH for command in self.commands
+                    if command.cmd == UWF_COMMAND_WRITE])
+
+    def digest(self):
+        """
+        Returns the SHA-256 of the whole file as a hex string, worked out on first use
+        """
+        if self.sha256 is None:
+            self.sha256 = hashlib.sha256(self.view).hexdigest()
+        return self.sha256
+
+    def close(self):
+        self.commands = []
+        try:
+            self.view.release()
+            self.mm.close()
+        except BufferError:
+            # A caller still holds a view of the data, the mapping goes when that does
+            pass
+
+    def __iter__(self):
+        return iter(self.commands)
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,52 @@
+##########################################################################################
+# Checkpoint journal that lets an interrupted firmware download resume where it stopped
+##########################################################################################
+import os
+import time
+from sbstore import JsonStore, STORE_DIR
+
+JOURNAL_PATH = os.path.join(STORE_DIR, 'uwf_journal.json')
+JOURNAL_INTERVAL_SEC = 1.0     #minimum time between checkpoint writes to disk
+
+class UwfJournal(JsonStore):
+    """
+    Records, per port, image hash and bootloader ATS, the last verified point of a download
+    as the index of the UWF write command and the offset within its data
+    The ATS is the same on every module of a type, so it is the port that tells modules apart
+    """
+    def __init__(self, path=JOURNAL_PATH):
+        JsonStore.__init__(self, path, 'Checkpoint journal')
+
+    @staticmethod
+    def make_key(port, image_digest, identity):
+        return f"{port}|{image_digest}|{identity}"
+
+    def load(self, key):
+        """
+        Returns (command_index, offset) of the checkpoint for 'key', or None if there is none
+        """
+        entry = self.get(key)
+        if entry is None:
+            return None
+        return (entry['command'], entry['offset'])
+
+    def save(self, key, command_index, offset):
+        def change(entries):
+            entries[key] = {'command': command_index, 'offset': offset, 'time': time.time()}
+            return entries
+        self.update(change)
+
+    def clear_port(self, port, keep=None):
+        """ Drops the checkpoints of every image on 'port', except the one for the key 'keep' """
+        def change(entries):
+            kept = {key: entry for key, entry in entries.items() if key == keep or key.split('|', 1)[0] != port}
+            return kept if len(kept) != len(entries) else None
+        self.update(change)
+
+    def clear(self, key):
+        def change(entries):
+            if key not in entries:
+                return None
+            del entries[key]
+            return entries
+        self.update(change)
@@ -7,6 +7,10 @@ import serial
 import binascii
 import struct
 import time
+import collections
+import uwf_checksum
+from uwf_journal import UwfJournal, JOURNAL_INTERVAL_SEC
+from uwf_sector_map import SectorMap
 
 VERBOSELEVEL=2
 
@@ -19,6 +23,11 @@ DEVICE_TYPE_BT900    = 'BT900'
 
 SERIAL_TIMEOUT_SEC = 3
 DATA_BLOCK_SIZE=252      #16 to 252, uwflash uses 128, value must be divisible by 4
+PIPELINE_WINDOW=0        #0 or 1 is stop-and-wait, else max number of w/d/v frames awaiting an ack
+RESUME_VERIFY_SIZE=4096  #bytes of already written data checked by each verify before a download resumes
+RESYNC_ATTEMPTS=3     #syncs tried after a NAK in a pipeline before the download gives up
+BAUD_LADDER=(115200, 460800, 921600, 1000000)  #rates tried, fastest first, when negotiating the download rate
+BAUD_PROBE_TIMEOUT_SEC = 0.5
 
 COMMAND_ENTER_BOOTLOADER = b'AT+FUP\r'
 COMMAND_SYNC_WITH_BOOTLOADER = '80'
@@ -50,116 +59,94 @@ RESPONSE_ACKNOWLEDGE = 'a'
 RESPONSE_ERROR = 'f'
 RESPONSE_ACKNOWLEDGE_SIZE = 1
 
+ERASED_BYTE = 0xFF
+
+# What the generator methods of UwfProcessor yield for run() to carry out
+IO_READ = 'read'            #(IO_READ, size), the bytes read are sent back
+IO_READLINE = 'readline'    #(IO_READLINE,), the line read is sent back
+IO_SLEEP = 'sleep'          #(IO_SLEEP, seconds)
+
 ERROR_BOOTLOADER = 'enter_bootloader: {}\n'
 ERROR_TARGET_PLATFORM = 'process_command_target_platform: {}\n'
 ERROR_REGISTER_DEVICE = 'process_command_register_device: {}\n'
 ERROR_ERASE_BLOCKS = 'process_command_erase_blocks: {}\n'
 ERROR_WRITE_BLOCKS = 'process_command_write_blocks: {}\n'
 
-def init_processor(dev_type, port, baudrate):
+def processor_class(dev_type):
     """
-    Instantiates and returns the requested processor
+    Returns the processor class for 'dev_type', the generic UwfProcessor if it has none
     """
-
     if dev_type == DEVICE_TYPE_BL654IG:
         # Import the IG60_BL654 custom processor
         from uwf_processor_ig60_bl654 import UwfProcessorIg60Bl654
-        processor = UwfProcessorIg60Bl654(port, baudrate)
-        if VERBOSELEVEL>=2:
-            print(f"Initialise {dev_type}")
-        
+        return UwfProcessorIg60Bl654
     elif dev_type == DEVICE_TYPE_BL654:
         # Import the BL654 custom processor
         from uwf_processor_bl654 import UwfProcessorBl654
-        processor = UwfProcessorBl654(port, baudrate)
-        if VERBOSELEVEL>=2:
-            print(f"Initialise {dev_type}")
-        
+        return UwfProcessorBl654
     elif dev_type == DEVICE_TYPE_BL653:
         # Import the BL653 custom processor
         from uwf_processor_bl653 import UwfProcessorBl653
-        processor = UwfProcessorBl653(port, baudrate)
-        if VERBOSELEVEL>=2:
-            print(f"Initialise {dev_type}")
-        
+        return UwfProcessorBl653
     elif dev_type == DEVICE_TYPE_BL652:
-        # Import the BL653 custom processor
+        # Import the BL652 custom processor
         from uwf_processor_bl652 import UwfProcessorBl652
-        processor = UwfProcessorBl652(port, baudrate)
-        if VERBOSELEVEL>=2:
-            print(f"Initialise {dev_type}")
-        
+        return UwfProcessorBl652
     elif dev_type == DEVICE_TYPE_RM1XX:
         # Import the RM1XX custom processor
         from uwf_processor_rm1xx import UwfProcessorRM1XX
-        processor = UwfProcessorRM1XX(port, baudrate)
-        if VERBOSELEVEL>=2:
-            print(f"Initialise {dev_type}")
-
+        return UwfProcessorRM1XX
     elif dev_type == DEVICE_TYPE_BT900:
         # Import the BT900 custom processor
         from uwf_processor_bt900 import UwfProcessorBT900
-        processor = UwfProcessorBT900(port, baudrate)
-        if VERBOSELEVEL>=2:
-            print(f"Initialise {dev_type}")
-        
-    else:
-        # Use the generic processor
-        processor = UwfProcessor(port, baudrate)
-        if VERBOSELEVEL>=2:
-            print(f"Initialise {dev_type} as GENERIC")
-
-    processor.enter_bootloader()
+        return UwfProcessorBT900
+    # Use the generic processor
+    return UwfProcessor
 
+def new_processor(dev_type, port, baudrate, observer=None):
+    """
+    Instantiates and returns the requested processor, not yet in the bootloader
+    'observer' is a uwf_stats.UwfObserver told about the download as it runs
+    """
+    cls = processor_class(dev_type)
+    processor = cls(port, baudrate)
+    if VERBOSELEVEL>=2:
+        print(f"Initialise {dev_type}" if cls is not UwfProcessor else f"Initialise {dev_type} as GENERIC")
+    processor.observer = observer
     return processor
 
-class SectorMapIter():
-    def __init__(self, tupSectors, tupSectorSz, nOffsetStart, nOffsetEnd):
-        if len(tupSectors)>0 and len(tupSectors) == len(tupSectorSz):
-            self.tSectors = tupSectors
-            self.tSectorSz = tupSectorSz
-        else:
-            raise Exception('Sector map invalid')            
-        self.nOffset    = nOffsetStart
-        self.nOffsetEnd = nOffsetEnd
-
-    def __iter__(self):
-        self.tuple_Idx=0
-        self.sector_num=0
-        self.sectorThisBase=0
-        return self
-
-    def __next__(self):
-        for idx in range(self.tuple_Idx,len(self.tSectors)):
-            sector_numof=self.tSectors[idx]
-            sector_size =self.tSectorSz[idx]
-            for num in range(self.sector_num,sector_numof):
-                sectorNextBase = self.sectorThisBase + sector_size
-                if self.nOffset < sectorNextBase:
-                    self.nOffset = sectorNextBase
-                    self.sector_num=num
-                    self.tuple_Idx=idx
-                    return self.sectorThisBase
-                self.sectorThisBase=sectorNextBase
-                #check if above range end
-                if sectorNextBase >= self.nOffsetEnd:
-                    raise StopIteration  
-            self.sector_num=0
-        raise StopIteration
+def init_processor(dev_type, port, baudrate, observer=None):
+    """
+    Instantiates and returns the requested processor, in the bootloader
+    'observer' is a uwf_stats.UwfObserver told about the download as it runs
+    """
+    processor = new_processor(dev_type, port, baudrate, observer)
+    start = time.monotonic()
+    processor.run(processor.enter_bootloader())
+    processor.observe_phase('bootloader', start)
 
+    return processor
 
 class UwfProcessor():
     """
     Base class that captures the foundational data and functions
     to process a UWF file
+    The methods that talk to the bootloader are generators that yield the reads and sleeps
+    they wait for as IO_* tuples, run() carries those out with blocking calls on the port and
+    sbasync.AsyncUwfProcessor awaits them instead, so both share all of the protocol
     """
+    # Seconds to wait after resetting the module with a UART break before sending AT+FUP, and
+    # after resetting it the same way to reboot, None to send AT+FUP without a reset and to
+    # reboot with the bootloader's 'z' command
+    bootloader_reset_delay = None
+    reboot_reset_delay = None
+
     def __init__(self, port, baudrate):
         self.synchronized = False
         self.registered = False
         self.erased = False
         self.write_complete = False
-        self.sectors = []
-        self.sector_size = []
+        self.sector_map = None
         self.selected_handle = None
 
         # Number of bytes of data to write for each write command
@@ -168,8 +155,67 @@ class UwfProcessor():
         # The number of data blocks writes to perform before verifying
         self.verify_write_limit = 8
 
-        # Open the COM port to the Bluetooth adapter
-        self.ser = serial.Serial(port, baudrate, timeout=SERIAL_TIMEOUT_SEC)
+        # Adjusts write_block_size and verify_write_limit as the download runs, see uwf_tuning.UwfTuner
+        self.tuner = None
+        self.failed_frame = None
+
+        # The number of write/data/verify frames that can be sent before their acks are collected
+        self.pipeline_window = PIPELINE_WINDOW
+        # The window a non-ack dropped to stop-and-wait from, restored when the next region is selected
+        self.dropped_window = None
+
+        # Baud rates to try when syncing with the bootloader, empty to stay at 'baudrate'
+        self.baud_ladder = []
+
+        # Delta mode verifies each sector against the image and skips those that already match
+        self.delta = False
+        self.image = None
+        self.delta_skip = set()
+
+        # Sectors erased since the last select or sector map, skip_blank checks a sector is not
+        # already blank before erasing it, erase_skipped counts the sectors left alone
+        self.erased_sectors = set()
+        self.skip_blank = False
+        self.erase_skipped = 0
+        self.erase_seconds = 0.0
+        self.delta_bytes_saved = 0
+
+        # Checkpoint journal of verified offsets, and where to resume from when 'resume' is set
+        # Checkpoints are only recorded with 'record_checkpoints', a download always drops those
+        # of the port that its erases make out of date
+        self.journal = None
+        self.record_checkpoints = False
+        self.resume = False
+        self.resume_point = None
+        self.write_command = None
+        self.checkpoint_time = 0.0
+        self.checkpoint_pending = None
+        self.ats = None
+
+        # Number of data bytes acknowledged so far, passed to progress_callback as it grows
+        self.bytes_written = 0
+        self.unverified_bytes = 0    #bytes of bytes_written acknowledged since the last verify, written again after a rewind
+        self.progress_callback = None
+        self.verified_frame = None    #last verify frame acknowledged, sent again to check a resync
+
+        # Called with each frame sent through send_frames or send_frames_pipelined once it is acknowledged
+        self.ack_callback = None
+
+        # Told the time taken by each phase and round trip, see uwf_stats.UwfObserver
+        self.observer = None
+        self.frame_times = collections.deque()    #send times of the frames awaiting an ack in a pipeline
+        self.frame_start = 0.0    #send time of the frame last answered
+        self.ack_time = 0.0       #when the last frame was acknowledged
+
+        # Open the COM port to the Bluetooth adapter, unless an already open port was supplied
+        if isinstance(port, str):
+            self.ser = serial.Serial(port, baudrate, timeout=SERIAL_TIMEOUT_SEC)
+            self.port_name = port
+        else:
+            self.ser = port
+            # The device an open port was opened on, None if it has no name, e.g. an emulator
+            name = getattr(port, 'name', None)
+            self.port_name = name if isinstance(name, str) else None
         
         #initialise storage for registered memory blocks
         self.mem_base_address = {}
@@ -178,11 +224,54 @@ class UwfProcessor():
         self.mem_bank_algo    = {}
         
 
+    def run(self, steps):
+        """
+        Runs the generator 'steps', e.g. process_command_write_blocks(command), doing the reads
+        and sleeps it yields on the port as they come and returns what it returns
+        An exception from the port is raised inside 'steps' so that it can clean up
+        """
+        result = None
+        failure = None
+        while True:
+            try:
+                request = steps.send(result) if failure is None else steps.throw(failure)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                result, failure = self.perform(request), None
+            except BaseException as e:
+                result, failure = None, e
+
+    def perform(self, request):
+        if request[0] == IO_READ:
+            return self.ser.read(request[1])
+        if request[0] == IO_READLINE:
+            return self.ser.readline()
+        time.sleep(request[1])
+        return None
+
     def write_to_comm(self, data, resp_size):
+        start = time.monotonic()
         self.ser.write(data)
-        return self.ser.read(resp_size)
+        response = yield (IO_READ, resp_size)
+        self.observe_round_trip(data, response, start)
+        return response
+
+    def observe_round_trip(self, data, response, start):
+        if self.observer is not None:
+            self.observer.round_trip(data[0], time.monotonic() - start, len(data), len(response))
+
+    def observe_phase(self, name, start, detail=None):
+        if self.observer is not None:
+            self.observer.phase(name, start, time.monotonic() - start, detail)
+
+    def observe_retry(self, reason):
+        if self.observer is not None:
+            self.observer.retry(reason)
 
     def enter_bootloader(self, postdelay=0.5):
+        if self.bootloader_reset_delay is not None:
+            yield from self.reset_via_uartbreak(post_delay=self.bootloader_reset_delay)
         if VERBOSELEVEL>=2:
             print(f"Entering Bootloader mode..")
             
@@ -194,10 +283,10 @@ class UwfProcessor():
         self.ser.write(COMMAND_ENTER_BOOTLOADER)
 
         #wait for the module to reset and start
-        time.sleep(postdelay)
+        yield (IO_SLEEP, postdelay)
         
         # Verify no error
-        response = self.ser.readline()
+        response = yield (IO_READLINE,)
         if len(response) != 0:
             result = False
         elif VERBOSELEVEL>=2:
@@ -205,47 +294,111 @@ class UwfProcessor():
 
         return result
         
-    def process_command_target_platform(self, file, data_length):
+    def process_command_target_platform(self, command):
         if VERBOSELEVEL>=3:
             print(f"TARGET_PLATFORM")
         error = None
 
-        # Synchronize with the bootloader
+        # Synchronize with the bootloader, at the fastest rate it answers at if a ladder was given
+        start = time.monotonic()
+        if len(self.baud_ladder) > 0:
+            error = yield from self.negotiate_baudrate()
+        else:
+            error = yield from self.sync_with_bootloader()
+        self.observe_phase('sync', start)
+
+        if error is None:
+            # Send the target platform data
+            start = time.monotonic()
+            response = yield from self.write_to_comm(self.platform_frame(command), RESPONSE_ACKNOWLEDGE_SIZE)
+            error = self.platform_acked(response)
+            self.observe_phase('platform', start)
+        if error is None:
+            yield from self.start_journal()
+
+        return error
+
+    def platform_frame(self, command):
+        platform_command = bytearray(COMMAND_PLATFORM_CHECK, 'utf-8')
+        platform_id = command.payload
+        if VERBOSELEVEL>=2:
+            targetId = struct.unpack('I', platform_id)[0]
+            print(f"Platform: id={'0x%08X'%(targetId)}")
+        return platform_command + platform_id
+
+    def platform_acked(self, response):
+        """
+        Checks the response to the platform frame, starting the session if it was acknowledged
+        Returns None on success, otherwise an error string
+        """
+        if response.decode('utf-8') == RESPONSE_ACKNOWLEDGE:
+            self.synchronized = True
+            return None
+        elif response.decode('utf-8') == RESPONSE_ERROR:
+            return ERROR_TARGET_PLATFORM.format('Invalid platform ID')
+        return ERROR_TARGET_PLATFORM.format('Non-ack to platform ID')
+
+    def sync_with_bootloader(self):
+        """
+        Sends the sync byte and acknowledges the ATS response at the current baud rate
+        Returns None on success, otherwise an error string
+        """
+        error = None
         port_cmd_bytes = bytearray.fromhex(COMMAND_SYNC_WITH_BOOTLOADER)
-        response = self.write_to_comm(port_cmd_bytes, RESPONSE_ATS_SIZE)
+        ats = yield from self.write_to_comm(port_cmd_bytes, RESPONSE_ATS_SIZE)
 
-        if len(response) == RESPONSE_ATS_SIZE:
+        if len(ats) == RESPONSE_ATS_SIZE:
             # Acknowledge the response
             port_cmd_bytes = bytearray(RESPONSE_ACKNOWLEDGE, 'utf-8')
-            response = self.write_to_comm(port_cmd_bytes, RESPONSE_ACKNOWLEDGE_SIZE)
+            response = yield from self.write_to_comm(port_cmd_bytes, RESPONSE_ACKNOWLEDGE_SIZE)
 
-            if response.decode('utf-8') == RESPONSE_ACKNOWLEDGE:
-                # Send the target platform data
-                platform_command = bytearray(COMMAND_PLATFORM_CHECK, 'utf-8')
-                platform_id = file.read(data_length)
-                if VERBOSELEVEL>=2:
-                    targetId = struct.unpack('I', platform_id)[0]
-                    print(f"Platform: id={'0x%08X'%(targetId)}")
-                port_cmd_bytes = platform_command + platform_id
-                response = self.write_to_comm(port_cmd_bytes, RESPONSE_ACKNOWLEDGE_SIZE)
-
-                if response.decode('utf-8') == RESPONSE_ACKNOWLEDGE:
-                    self.synchronized = True
-                elif response.decode('utf-8') == RESPONSE_ERROR:
-                    error = ERROR_TARGET_PLATFORM.format('Invalid platform ID')
-                else:
-                    error = ERROR_TARGET_PLATFORM.format('Non-ack to platform ID')
-            else:
+            if response != bytearray(RESPONSE_ACKNOWLEDGE, 'utf-8'):
                 error = ERROR_TARGET_PLATFORM.format('Non-ack or error in ATS acknowledge response')
+            else:
+                self.ats = bytes(ats)
         else:
             error = ERROR_TARGET_PLATFORM.format('Failed to sync with the bootloader')
 
         return error
 
-    def process_command_register_device(self, file, data_length):
+    def negotiate_baudrate(self):
+        """
+        Syncs with the bootloader at the fastest rate in baud_ladder that completes the sync/ack
+        exchange, relying on the bootloader detecting the rate from the sync byte
+        Drops back a step on each failure and finally tries the rate the session started at
+        """
+        initial_baudrate = self.ser.baudrate
+        initial_timeout = self.ser.timeout
+
+        error = None
+        for baudrate in self.baud_candidates(initial_baudrate):
+            self.ser.baudrate = baudrate
+            self.ser.timeout = initial_timeout if baudrate == initial_baudrate else BAUD_PROBE_TIMEOUT_SEC
+            error = yield from self.sync_with_bootloader()
+            if error is None:
+                break
+            if VERBOSELEVEL>=2:
+                print(f"No sync at {baudrate} baud, dropping back")
+            self.observe_retry('baud')
+            self.ser.reset_input_buffer()
+        self.ser.timeout = initial_timeout
+
+        if error is None and VERBOSELEVEL>=2:
+            print(f"Bootloader synced at {self.ser.baudrate} baud")
+        return error
+
+    def baud_candidates(self, initial_baudrate):
+        """
+        Returns the rates to try when negotiating, fastest first and ending with 'initial_baudrate'
+        """
+        ladder = sorted(set([rate for rate in self.baud_ladder if rate > initial_baudrate]), reverse=True)
+        ladder.append(initial_baudrate)
+        return ladder
+
+    def process_command_register_device(self, command):
         if VERBOSELEVEL>=3:
             print(f"REGISTER_DEVICE")
-        register_device_data = file.read(data_length)
+        register_device_data = command.payload
         #extract handle
         handle = struct.unpack('B', register_device_data[:UWF_OFFSET_HANDLE])[0]
         #extract base address
@@ -268,205 +421,677 @@ class UwfProcessor():
 
         return None
 
-    def process_command_select_device(self, file, data_length):
+    def process_command_select_device(self, command):
         if VERBOSELEVEL>=3:
             print(f"SELECT_DEVICE")
-        select_device_data = file.read(data_length)
+        select_device_data = command.payload
         self.selected_handle = struct.unpack('B', select_device_data[:UWF_OFFSET_HANDLE])[0]
         self.selected_bank = struct.unpack('B', select_device_data[UWF_OFFSET_HANDLE:UWF_OFFSET_BANK])[0]
+        self.erased_sectors = set()
+        if self.dropped_window is not None:
+            # A new region, give the pipeline another go
+            self.pipeline_window = self.dropped_window
+            self.dropped_window = None
         if VERBOSELEVEL>=2:
             print(f"Select Device: hndl={self.selected_handle} bank={self.selected_bank}")
 
         return None
 
-    #will return True if 'memsize' is equal to the sum of all sectors mentioned in the map
-    def __VerifySectorMap(self,banksize):
-        sum=0
-        for i in range(len(self.sectors)):
-            sum += self.sectors[i] * self.sector_size[i]
-        if sum != banksize:
-            return False
-        return True
-
-    def process_command_sector_map(self, file, data_length):
+    def process_command_sector_map(self, command):
         if VERBOSELEVEL>=3:
             print(f"SECTOR_MAP")
-        sector_map_data = file.read(data_length)
-        arrsize=int(data_length/(UWF_UI32_SIZE+UWF_UI32_SIZE))
-        if arrsize*(UWF_UI32_SIZE+UWF_UI32_SIZE) != data_length:
-            raise Exception('SectorMap length error in uwf file')
-        pos=0
-        self.sectors = []
-        self.sector_size = []
-        while arrsize>0:
-            sectors = struct.unpack('<I', sector_map_data[pos:pos+UWF_UI32_SIZE])[0]
-            self.sectors.append(sectors)
-            pos = pos+UWF_UI32_SIZE
-            sector_size = struct.unpack('<I', sector_map_data[pos:pos+UWF_UI32_SIZE])[0]
-            self.sector_size.append(sector_size)
-            pos = pos+UWF_UI32_SIZE
-            arrsize -= 1
+        self.sector_map = SectorMap.from_payload(command.payload, command.length)
+        self.erased_sectors = set()
         if VERBOSELEVEL>=2:
-            print(f"Sector Map: sectors={self.sectors} size={self.sector_size}")
+            print(f"Sector Map: {self.sector_map}")
         if not self.selected_handle is None :
-            if self.__VerifySectorMap(self.mem_bank_size[self.selected_handle]) == False:
+            if self.sector_map.size != self.mem_bank_size[self.selected_handle]:
                 raise Exception('SectorMap not consistent with bank size')
         return None
 
-    def process_command_erase_blocks(self, file, data_length):
+    def process_command_erase_blocks(self, command):
         """
-        Erases blocks according to the sector size value from the the UWF file
+        Erases the sectors that the erase blocks of this region cover, each one once
+        The first erase block of a region erases the sectors of all of them, sectors that delta
+        mode finds already in place, or that skip_blank finds already erased, are left alone
         """
         if VERBOSELEVEL>=3:
             print(f"ERASE_BLOCK")
-        error = None
+        error, baseaddr, sectors = self.erase_sectors(command)
+
+        if error is None and sectors is not None:
+            start = time.monotonic()
+            checks = self.sector_checks(command, sectors, baseaddr)
+            if len(checks) > 0:
+                responses = yield from self.query_frames([check[1] for check in checks], self.pipeline_window)
+                sectors = self.sectors_to_erase(sectors, checks, responses)
+                self.observe_phase('erase_check', start, baseaddr+checks[0][0])
+            frames = self.erase_frames(sectors, baseaddr, command.index)
+            if self.pipeline_window > 1:
+                failed = yield from self.send_frames_pipelined(frames, self.pipeline_window)
+                error = None if failed is None else self.frame_error(failed)
+            else:
+                error = yield from self.send_frames(frames)
+            if error is None:
+                self.erased = True
+            self.erase_finished(command, sectors, start)
+
+        return error
+
+    def erase_sectors(self, command):
+        """
+        Validates the erase command and returns (error, baseaddr, sectors) where 'sectors' lists
+        the bank offsets of the sectors still to erase, or is None if there is nothing to send
+        """
+        if self.resume_point is not None and command.index < self.resume_point[0]:
+            # Erased before the download being resumed was interrupted
+            if VERBOSELEVEL>=2:
+                print("Erase Block: skipped, resuming")
+            self.erased = True
+            return (None, None, None)
 
         if self.synchronized       and \
            self.registered         and \
-           len(self.sectors)>0     and self.sectors[0] > 0 and \
-           len(self.sector_size)>0 and self.sector_size[0] > 0:
-            # Get the UWF erase data
-            erase_data = file.read(data_length)
+           self.sector_map is not None and self.sector_map.valid():
             baseaddr=self.mem_base_address[self.selected_handle]
-            offset = struct.unpack('<I', erase_data[:UWF_OFFSET_ERASE_START_ADDR])[0]
-            size = struct.unpack('<I', erase_data[UWF_OFFSET_ERASE_START_ADDR:UWF_OFFSET_ERASE_SIZE])[0]
+            offset, size = self.erase_range(command)
             if VERBOSELEVEL>=2:
                 print(f"Erase Block: addr=0x{baseaddr+offset:08x} (offset=0x{offset:x}) size={size} (0x{size:x})")
-            
+
             if offset+size <= self.mem_bank_size[self.selected_handle]:
-                erase_command = bytearray(COMMAND_ERASE_SECTOR, 'utf-8')
-                map_iter=SectorMapIter(self.sectors, self.sector_size, offset, offset+size)
-                for ofs in map_iter:
-                    erase_sector = struct.pack('<I', ofs+baseaddr)
-                    port_cmd_bytes = erase_command + erase_sector
-                    response = self.write_to_comm(port_cmd_bytes, RESPONSE_ACKNOWLEDGE_SIZE)
-                    if response.decode('utf-8') != RESPONSE_ACKNOWLEDGE:
-                        error = ERROR_ERASE_BLOCKS.format('Non-ack to erase command')
-                        break
-                    if VERBOSELEVEL>=2:
-                        print('.',end='',flush=True)
-                else:
-                    self.erased = True
-                if VERBOSELEVEL>=2:
-                    print('.',end='\n',flush=True)
-            else:
-                error = ERROR_ERASE_BLOCKS.format('Erase block size plus offset > bank size')
-        else:
-            error = ERROR_ERASE_BLOCKS.format('Target platform, register device, or sector map commands not yet processed')
+                return (None, baseaddr, self.erase_plan(command))
+            return (ERROR_ERASE_BLOCKS.format('Erase block size plus offset > bank size'), None, None)
+        return (ERROR_ERASE_BLOCKS.format('Target platform, register device, or sector map commands not yet processed'), None, None)
 
-        return error
+    def erase_range(self, command):
+        erase_data = command.payload
+        offset = struct.unpack('<I', erase_data[:UWF_OFFSET_ERASE_START_ADDR])[0]
+        size = struct.unpack('<I', erase_data[UWF_OFFSET_ERASE_START_ADDR:UWF_OFFSET_ERASE_SIZE])[0]
+        return (offset, size)
+
+    def erase_plan(self, command):
+        """
+        Returns the sorted bank offsets of the sectors covered by 'command' and the erase blocks
+        after it in the same region, up to any later sector map, that are not yet erased
+        The sectors are then recorded as erased so that the later erase blocks send nothing
+        """
+        commands = [command]
+        if self.image is not None:
+            for other in self.image.commands[command.index+1:]:
+                if other.region != command.region or other.cmd == 'M':
+                    break
+                if other.cmd == 'E':
+                    commands.append(other)
+
+        bank_size = self.mem_bank_size[self.selected_handle]
+        planned = set()
+        for erase in commands:
+            offset, size = self.erase_range(erase)
+            if size > 0 and offset+size <= bank_size:
+                # Invalid blocks are reported when their own command is processed
+                planned.update(self.sector_map.sectors_in(offset, offset+size))
+        sectors = sorted(planned - self.erased_sectors)
+        self.erased_sectors.update(sectors)
+        return sectors
 
-    def process_command_write_blocks(self, file, data_length):
+    def sector_checks(self, command, sectors, baseaddr):
+        """
+        Returns [(ofs, verify frame, data bytes)] for the sectors to check before erasing them,
+        in delta mode against the image and with skip_blank for being blank already
+        """
+        if self.delta and self.image is not None:
+            writes = self.region_writes(command)
+            return [(ofs,) + self.delta_verify_frame(writes, ofs, baseaddr) for ofs in sectors]
+        if self.skip_blank:
+            return [(ofs, self.blank_verify_frame(ofs, baseaddr), 0) for ofs in sectors]
+        return []
+
+    def blank_verify_frame(self, ofs, baseaddr):
+        """ Returns the verify frame that succeeds if the sector at 'ofs' holds only 0xFF bytes """
+        size = self.sector_map.sector_at(ofs)[1]
+        return self.verify_frame(struct.pack('<I', ofs+baseaddr), size, ERASED_BYTE * size)
+
+    def sectors_to_erase(self, sectors, checks, responses):
+        """
+        Returns the sectors whose check was not acknowledged, recording the delta matches
+        """
+        matched = set()
+        for check, response in zip(checks, responses):
+            if self.delta and self.image is not None:
+                if self.delta_verified(check[0], check[2], response):
+                    matched.add(check[0])
+            elif response == bytearray(RESPONSE_ACKNOWLEDGE, 'utf-8'):
+                matched.add(check[0])
+        self.erase_skipped += len(matched)
+        if VERBOSELEVEL>=2:
+            print('='*len(matched),end='',flush=True)
+        return [ofs for ofs in sectors if ofs not in matched]
+
+    def erase_frames(self, sectors, baseaddr, index=None):
+        """
+        Returns the erase frames for 'sectors' in the (command, port_cmd_bytes, verify_pos, end_pos, index)
+        form of write_block_frames, the positions are those of the sector in 'sectors' and 'index'
+        is the index of the UWF erase command
+        """
+        return [(COMMAND_ERASE_SECTOR, self.erase_frame(ofs, baseaddr), pos, pos+1, index) for pos, ofs in enumerate(sectors)]
+
+    def erase_frame(self, ofs, baseaddr):
+        erase_command = bytearray(COMMAND_ERASE_SECTOR, 'utf-8')
+        return erase_command + struct.pack('<I', ofs+baseaddr)
+
+    def erase_finished(self, command, sectors, start):
+        seconds = time.monotonic() - start
+        self.erase_seconds += seconds
+        if VERBOSELEVEL>=2:
+            print('.',end='\n',flush=True)
+        if VERBOSELEVEL>=1:
+            print(f"Erase: {len(sectors)} sectors in {seconds:.3f}s, {self.erase_skipped} left alone so far, {self.erase_seconds:.3f}s erasing in total")
+        if self.delta and VERBOSELEVEL>=1:
+            print(f"Delta: {len(self.delta_skip)} sectors already match, {self.delta_bytes_saved} bytes not written")
+
+    def region_writes(self, command):
+        """
+        Returns [(offset, data)] of the write commands in the region of 'command', gathered once
+        for all the sectors that delta mode checks in the region
+        """
+        return [(struct.unpack('<I', write.payload[:UWF_OFFSET_WRITE_OFFSET])[0], write.payload[UWF_WRITE_BLOCK_HDR_LENGTH:])
+                for write in self.image.region_commands(command, 'W')]
+
+    def delta_verify_frame(self, writes, ofs, baseaddr):
+        """
+        Returns the verify frame that checks whether the sector at bank offset 'ofs' already holds
+        what erasing it and then writing the 'writes' of its region would leave there, and the
+        number of bytes of image data that fall in that sector
+        The verify is a sum of bytes so a reordering of bytes within a sector goes unnoticed
+        """
+        size = self.sector_map.sector_at(ofs)[1]
+        expected = bytearray(b'\xff' * size)
+        data_bytes = 0
+        for write_offset, data in writes:
+            start = max(ofs, write_offset)
+            end = min(ofs + size, write_offset + len(data))
+            if start < end:
+                expected[start-ofs:end-ofs] = data[start-write_offset:end-write_offset]
+                data_bytes += end - start
+
+        verify_command = bytearray(COMMAND_VERIFY_DATA, 'utf-8')
+        return (verify_command + struct.pack('<III', ofs+baseaddr, size, uwf_checksum.block_checksum(expected)), data_bytes)
+
+    def delta_verified(self, ofs, data_bytes, response):
+        """
+        Adds a matching sector to delta_skip so that its writes are skipped too
+        """
+        if response != bytearray(RESPONSE_ACKNOWLEDGE, 'utf-8'):
+            return False
+        self.delta_skip.add(ofs)
+        self.delta_bytes_saved += data_bytes
+        return True
+
+    def delta_block_matches(self, ofs, size):
+        """
+        Returns True if every sector that the 'size' bytes at bank offset 'ofs' touch was found to match
+        """
+        for start in self.sector_map.sectors_in(ofs, ofs + size):
+            if start not in self.delta_skip:
+                return False
+        return True
+
+    def process_command_write_blocks(self, command):
         """
         Sends the write command, then a data block 'X' times, then verifies
         The size of the data block and the number of data blocks before verification are configurable
         """
         if VERBOSELEVEL>=3:
             print(f"WRITE_BLOCK")
-        error = None
+        start = time.monotonic()
+        error, data, offset, baseaddr, pos = self.write_plan(command)
 
-        if self.erased:
-            last_write = False
-            verify_checksum = 0
-            verify_count = 1
-            verify_data_block_size = 0
+        if error is None and data is not None:
+            if self.pipeline_window > 1:
+                failed = yield from self.send_frames_pipelined(self.write_block_frames(data, offset, baseaddr, pos), self.pipeline_window)
+                if failed is not None:
+                    error, pos = yield from self.pipeline_failed(failed, offset)
+            while error is None and self.pipeline_window <= 1:
+                error = yield from self.send_frames(self.write_block_frames(data, offset, baseaddr, pos))
+                if error is None or not self.tuning_failed():
+                    break
+                # Write again from the last verified point with the smaller settings
+                error = None
+                pos = self.failed_frame[2]
+            self.write_finished(command, data, error)
+            self.observe_phase('write', start, offset+baseaddr)
 
-            # Get the UWF write data
-            write_data = file.read(UWF_WRITE_BLOCK_HDR_LENGTH)
-            baseaddr=self.mem_base_address[self.selected_handle]
-            offset = struct.unpack('<I', write_data[:UWF_OFFSET_WRITE_OFFSET])[0]
-            flags = struct.unpack('<I', write_data[UWF_OFFSET_WRITE_OFFSET:UWF_OFFSET_WRITE_FLAGS])[0]
-            remaining_data_size = data_length - UWF_WRITE_BLOCK_HDR_LENGTH
-            if VERBOSELEVEL>=2:
-                print(f"Write Block: addr=0x{offset+baseaddr:08x} (offset=0x{offset:x}) flags=0x{flags:x}  len={remaining_data_size} (0x{remaining_data_size:x})")
-
-            if remaining_data_size <= self.mem_bank_size[self.selected_handle]:
-                verify_start_addr = struct.pack('<I', offset+baseaddr)
-                while remaining_data_size > 0:
-                    if remaining_data_size < self.write_block_size:
-                        bytes_to_write = remaining_data_size
-                        last_write = True
-                    else:
-                        bytes_to_write = self.write_block_size
-
-                    if VERBOSELEVEL>=2:
-                        print('.',end='',flush=True)
-                        
-                    # Send the write command
-                    write_command = bytearray(COMMAND_WRITE_SECTOR, 'utf-8')
-                    start_addr = struct.pack('<I', offset+baseaddr)
-                    data_block_size = struct.pack('B', bytes_to_write)
-                    port_cmd_bytes = write_command + start_addr + data_block_size
-                    response = self.write_to_comm(port_cmd_bytes, RESPONSE_ACKNOWLEDGE_SIZE)
-
-                    if response.decode('utf-8') == RESPONSE_ACKNOWLEDGE:
-                        # Prepare the data
-                        data_command = bytearray(COMMAND_DATA_SECTION, 'utf-8')
-                        data = file.read(bytes_to_write)
-
-                        # Generate the checksum
-                        i = 0
-                        checksum = 0
-                        while i < len(data):
-                            checksum += struct.unpack('B', data[i:i+1])[0]
-                            i += 1
-                        checksum_bytes = struct.pack('<I', checksum)
-
-                        # Write the data
-                        port_cmd_bytes = data_command + data
-                        port_cmd_bytes.append(checksum_bytes[0])    # Only need the LSB of the checksum
-                        response = self.write_to_comm(port_cmd_bytes, RESPONSE_ACKNOWLEDGE_SIZE)
-
-                        if response.decode('utf-8') == RESPONSE_ACKNOWLEDGE:
-                            # Data write was successful; move on to the next data block
-                            offset += len(data)
-                            remaining_data_size -= len(data)
-
-                            # Verify the data after the expected number of data blocks have been written
-                            if last_write or verify_count >= self.verify_write_limit:
-                                verify_command = bytearray(COMMAND_VERIFY_DATA, 'utf-8')
-                                verify_data_block_size_bytes = struct.pack('<I', verify_data_block_size)
-                                verify_checksum_bytes = struct.pack('<I', verify_checksum)
-                                port_cmd_bytes = verify_command + verify_start_addr + verify_data_block_size_bytes + verify_checksum_bytes        # Need the full checksum here
-                                response = self.write_to_comm(port_cmd_bytes, RESPONSE_ACKNOWLEDGE_SIZE)
-
-                                if response.decode('utf-8') == RESPONSE_ACKNOWLEDGE:
-                                    # Verification successful; reset for next verification
-                                    verify_start_addr = struct.pack('<I', offset+baseaddr)
-                                    verify_count = 1
-                                    verify_checksum = 0
-                                    verify_data_block_size = 0
-                                else:
-                                    # Verification failed; abort
-                                    error = ERROR_WRITE_BLOCKS.format('Non-ack to verify command')
-                                    break
-                            else:
-                                verify_count += 1
-                                verify_checksum += checksum
-                                verify_data_block_size += len(data)
-                        else:
-                            # Failed to write the data; abort
-                            error = ERROR_WRITE_BLOCKS.format('Non-ack to data write')
-                            break
-                    else:
-                        # Write command failed; abort
-                        error = ERROR_WRITE_BLOCKS.format('Non-ack to write command')
-                        break
-                else:
-                    self.write_complete = True
+        return error
+
+    def write_plan(self, command):
+        """
+        Validates the write command and returns (error, data, offset, baseaddr, pos) where 'data'
+        is the data to write from position 'pos' onwards, or None if there is nothing to send
+        """
+        pos = 0
+        if self.resume_point is not None and command.index <= self.resume_point[0]:
+            if command.index < self.resume_point[0]:
+                # Written and verified before the download being resumed was interrupted
                 if VERBOSELEVEL>=2:
-                    print('.',end='\n',flush=True)
-            else:
-                error = ERROR_WRITE_BLOCKS.format('Data to write > bank size')
-        else:
-            error = ERROR_WRITE_BLOCKS.format('Erase command not yet processed')
+                    print("Write Block: skipped, resuming")
+                self.write_complete = True
+                return (None, None, None, None, None)
+            pos = self.resume_point[1]
 
+        if not self.erased:
+            return (ERROR_WRITE_BLOCKS.format('Erase command not yet processed'), None, None, None, None)
+
+        self.write_command = command
+        # Get the UWF write data
+        write_data = command.payload[:UWF_WRITE_BLOCK_HDR_LENGTH]
+        baseaddr=self.mem_base_address[self.selected_handle]
+        offset = struct.unpack('<I', write_data[:UWF_OFFSET_WRITE_OFFSET])[0]
+        flags = struct.unpack('<I', write_data[UWF_OFFSET_WRITE_OFFSET:UWF_OFFSET_WRITE_FLAGS])[0]
+        remaining_data_size = command.length - UWF_WRITE_BLOCK_HDR_LENGTH
+        if VERBOSELEVEL>=2:
+            print(f"Write Block: addr=0x{offset+baseaddr:08x} (offset=0x{offset:x}) flags=0x{flags:x}  len={remaining_data_size} (0x{remaining_data_size:x})")
+
+        if remaining_data_size > self.mem_bank_size[self.selected_handle]:
+            return (ERROR_WRITE_BLOCKS.format('Data to write > bank size'), None, None, None, None)
+        if self.sector_map is not None and offset + remaining_data_size > self.sector_map.size:
+            return (ERROR_WRITE_BLOCKS.format('Write block size plus offset > sector map size'), None, None, None, None)
+        return (None, command.payload[UWF_WRITE_BLOCK_HDR_LENGTH:], offset, baseaddr, pos)
+
+    def pipeline_failed(self, failed, offset):
+        """
+        Drops to stop-and-wait for the rest of the region after a frame in the pipeline was not
+        acknowledged and returns (error, pos) where pos is the last verified point to rewind to
+        This assumes that the bootloader keeps framing after a NAKed 'w', taking the 'd' frames
+        still in flight as data by their length and answering each with one byte, so that only
+        a response per pending frame is drained. The resync checks that it is in step again
+        """
+        self.dropped_window = self.pipeline_window
+        self.pipeline_window = 0
+        if VERBOSELEVEL>=2:
+            print(f"\nNon-ack in pipeline, resuming at offset=0x{offset+failed[2]:x} in stop-and-wait mode")
+        self.observe_retry('pipeline')
+        if self.tuner is not None:
+            self.tuner.failed()
+            self.apply_tuning()
+        self.rewind_progress()
+        error = yield from self.resync()
+        return (error, failed[2])
+
+    def resync(self):
+        """
+        Syncs with the bootloader again after a NAK in a pipeline and verifies the last window
+        it acknowledged, so that nothing still in flight is taken for the next command
+        Returns None on success, otherwise an error string
+        """
+        for attempt in range(RESYNC_ATTEMPTS):
+            self.ser.reset_input_buffer()
+            error = yield from self.sync_with_bootloader()
+            if error is None:
+                break
+        if error is None and self.verified_frame is not None:
+            response = yield from self.write_to_comm(self.verified_frame[1], RESPONSE_ACKNOWLEDGE_SIZE)
+            if response != bytearray(RESPONSE_ACKNOWLEDGE, 'utf-8'):
+                error = ERROR_WRITE_BLOCKS.format('Last verified data does not match after resync')
         return error
 
-    def process_command_unregister(self, file, data_length):
+    def rewind_progress(self):
+        """ Takes the data acknowledged since the last verify, which is written again, out of the progress """
+        self.bytes_written -= self.unverified_bytes
+        self.unverified_bytes = 0
+        if self.progress_callback is not None:
+            self.progress_callback(self.bytes_written)
+
+    def apply_tuning(self):
+        """
+        Takes the tuner's settings, write_block_frames picks them up at the next verify window
+        """
+        if self.write_block_size != self.tuner.block_size or self.verify_write_limit != self.tuner.verify_limit:
+            if VERBOSELEVEL>=3:
+                print(f"Tuning: block size {self.tuner.block_size}, {self.tuner.verify_limit} blocks per verify")
+        self.write_block_size = self.tuner.block_size
+        self.verify_write_limit = self.tuner.verify_limit
+
+    def tuning_failed(self):
+        """
+        Steps the tuner down after a frame sent one at a time was not acknowledged
+        Returns True if the write should be tried again from failed_frame's verify position
+        """
+        if self.tuner is None or not self.tuner.failed():
+            return False
+        if VERBOSELEVEL>=2:
+            print(f"\nNon-ack, writing again from the last verify with {self.tuner.block_size} byte blocks")
+        self.observe_retry('tuning')
+        self.apply_tuning()
+        self.rewind_progress()
+        self.ser.reset_input_buffer()
+        return True
+
+    def write_finished(self, command, data, error):
+        if error is None:
+            self.write_complete = True
+            self.checkpoint(command.index, len(data))
+        if VERBOSELEVEL>=2:
+            print('.',end='\n',flush=True)
+
+    def write_block_frames(self, data, offset, baseaddr, pos=0):
+        """
+        Generates the write, data and verify frames that write 'data' at 'offset' from 'pos' onwards
+        Each frame is yielded as (command, port_cmd_bytes, verify_pos, end_pos, index) where verify_pos is
+        the position in 'data' of the last verified point, which is where writing can restart from,
+        end_pos is the position in 'data' that has been written once the frame is acknowledged and
+        index is the index of the UWF write command the data belongs to
+        """
+        index = self.write_command.index
+        last_write = False
+        window_checksums = []
+        verify_count = 1
+        verify_data_block_size = 0
+        verify_pos = pos
+        verify_start_addr = struct.pack('<I', offset+pos+baseaddr)
+
+        # Checksum every block up front rather than byte by byte as each one is sent, again
+        # from where the block size changes when a tuner changes it
+        data = memoryview(data)
+        block_size = self.write_block_size
+        checksums = uwf_checksum.block_checksums(data[pos:], block_size)
+        block_index = 0
+
+        while pos < len(data):
+            if verify_count == 1 and block_size != self.write_block_size:
+                # Start of a verify window, take the tuner's new block size
+                block_size = self.write_block_size
+                checksums = uwf_checksum.block_checksums(data[pos:], block_size)
+                block_index = 0
+            remaining_data_size = len(data) - pos
+            if remaining_data_size < block_size:
+                bytes_to_write = remaining_data_size
+                last_write = True
+            else:
+                bytes_to_write = block_size
+
+            if len(self.delta_skip) > 0 and self.delta_block_matches(offset+pos, bytes_to_write):
+                # Delta mode found this block already in place, verify what came before it
+                if verify_count > 1:
+                    yield (COMMAND_VERIFY_DATA, self.verify_frame(verify_start_addr, verify_data_block_size, uwf_checksum.verify_checksum(window_checksums)), verify_pos, pos, index)
+                pos += bytes_to_write
+                block_index += 1
+                verify_pos = pos
+                verify_start_addr = struct.pack('<I', offset+pos+baseaddr)
+                verify_count = 1
+                window_checksums = []
+                verify_data_block_size = 0
+                continue
+
+            # The write command
+            write_command = bytearray(COMMAND_WRITE_SECTOR, 'utf-8')
+            start_addr = struct.pack('<I', offset+pos+baseaddr)
+            data_block_size = struct.pack('B', bytes_to_write)
+            yield (COMMAND_WRITE_SECTOR, write_command + start_addr + data_block_size, verify_pos, pos, index)
+
+            # Prepare the data
+            data_command = bytearray(COMMAND_DATA_SECTION, 'utf-8')
+            block = data[pos:pos+bytes_to_write]
+
+            checksum = checksums[block_index]
+            block_index += 1
+
+            # The data write
+            port_cmd_bytes = data_command + block
+            port_cmd_bytes.append(checksum & uwf_checksum.CHECKSUM_LSB_MASK)    # Only need the LSB of the checksum
+            yield (COMMAND_DATA_SECTION, port_cmd_bytes, verify_pos, pos+len(block), index)
+            pos += len(block)
+            window_checksums.append(checksum)
+            verify_data_block_size += len(block)
+
+            # Verify the data after the expected number of data blocks have been written, the
+            # window includes this block so that everything up to 'pos' is verified once acked
+            if last_write or verify_count >= self.verify_write_limit:
+                yield (COMMAND_VERIFY_DATA, self.verify_frame(verify_start_addr, verify_data_block_size, uwf_checksum.verify_checksum(window_checksums)), verify_pos, pos, index)
+
+                # Reset for next verification
+                verify_pos = pos
+                verify_start_addr = struct.pack('<I', offset+pos+baseaddr)
+                verify_count = 1
+                window_checksums = []
+                verify_data_block_size = 0
+            else:
+                verify_count += 1
+
+    def verify_frame(self, verify_start_addr, verify_data_block_size, verify_checksum):
+        verify_command = bytearray(COMMAND_VERIFY_DATA, 'utf-8')
+        verify_data_block_size_bytes = struct.pack('<I', verify_data_block_size)
+        verify_checksum_bytes = struct.pack('<I', verify_checksum & uwf_checksum.CHECKSUM_MASK)
+        return verify_command + verify_start_addr + verify_data_block_size_bytes + verify_checksum_bytes        # Need the full checksum here
+
+    def send_frames(self, frames):
+        """
+        Sends each frame and waits for its ack before sending the next one
+        Returns None if all frames were acknowledged, otherwise an error string
+        """
+        ack = bytearray(RESPONSE_ACKNOWLEDGE, 'utf-8')
+        for frame in frames:
+            command, port_cmd_bytes = frame[0], frame[1]
+            if command in (COMMAND_WRITE_SECTOR, COMMAND_ERASE_SECTOR) and VERBOSELEVEL>=2:
+                print('.',end='',flush=True)
+            start = time.monotonic()
+            self.frame_start = start
+            response = yield from self.write_to_comm(port_cmd_bytes, RESPONSE_ACKNOWLEDGE_SIZE)
+            if command == COMMAND_VERIFY_DATA:
+                self.observe_phase('verify', start)
+            if response != ack:
+                return self.frame_error(frame)
+            self.frame_acked(frame)
+        return None
+
+    def frame_error(self, frame):
+        self.failed_frame = frame
+        if frame[0] == COMMAND_ERASE_SECTOR:
+            return ERROR_ERASE_BLOCKS.format('Non-ack to erase command')
+        if frame[0] == COMMAND_WRITE_SECTOR:
+            return ERROR_WRITE_BLOCKS.format('Non-ack to write command')
+        elif frame[0] == COMMAND_DATA_SECTION:
+            return ERROR_WRITE_BLOCKS.format('Non-ack to data write')
+        return ERROR_WRITE_BLOCKS.format('Non-ack to verify command')
+
+    def query_frames(self, frames, window):
+        """
+        Sends each of the 'frames' and returns the list of their one byte responses, keeping at
+        most 'window' frames unanswered, the responses from a timeout onwards are empty
+        """
+        responses = []
+        sent = 0
+        while len(responses) < len(frames):
+            while sent < len(frames) and sent - len(responses) < max(1, window):
+                self.ser.write(frames[sent])
+                self.frame_times.append(time.monotonic())
+                sent += 1
+            response = yield (IO_READ, RESPONSE_ACKNOWLEDGE_SIZE)
+            self.query_answered(frames[len(responses)], response)
+            if len(response) == 0:
+                # Timed out, give up on the rest and discard any late responses
+                yield (IO_READ, sent - len(responses) - 1)
+                self.ser.reset_input_buffer()
+                self.frame_times.clear()
+                responses += [b''] * (len(frames) - len(responses))
+                break
+            responses.append(response)
+        return responses
+
+    def query_answered(self, frame, response):
+        start = self.frame_times.popleft()
+        if self.observer is not None:
+            self.observer.round_trip(frame[0], time.monotonic() - start, len(frame), len(response))
+
+    def send_frames_pipelined(self, frames, window):
+        """
+        Sends frames without waiting for each ack, keeping at most 'window' frames unacknowledged
+        Acks are matched to frames in the order they arrive as every frame is answered with one byte
+        Returns None if all frames were acknowledged, otherwise the first frame that was not
+        """
+        pending = collections.deque()
+        failed = None
+        for frame in frames:
+            if frame[0] in (COMMAND_WRITE_SECTOR, COMMAND_ERASE_SECTOR) and VERBOSELEVEL>=2:
+                print('.',end='',flush=True)
+            self.ser.write(frame[1])
+            pending.append(frame)
+            self.frame_sent(frame)
+            # Collect the acks that have already arrived, only block when the window is full
+            failed = yield from self.collect_acks(pending, len(pending) >= window)
+            if failed is not None:
+                break
+        while failed is None and len(pending) > 0:
+            failed = yield from self.collect_acks(pending, True)
+
+        if failed is not None:
+            # Discard the responses to the frames still in flight before carrying on
+            yield (IO_READ, len(pending))
+            self.ser.reset_input_buffer()
+            self.frame_times.clear()
+        return failed
+
+    def collect_acks(self, pending, block):
+        """
+        Reads the acks available for the oldest 'pending' frames, waiting for at least one if 'block'
+        Returns None if they were all acks, otherwise the first frame that was not acknowledged
+        """
+        waiting = min(self.ser.in_waiting, len(pending))
+        if waiting == 0:
+            if not block:
+                return None
+            waiting = RESPONSE_ACKNOWLEDGE_SIZE
+        response = yield (IO_READ, waiting)
+        if len(response) == 0:
+            # Timed out waiting for the ack
+            frame = pending.popleft()
+            self.frame_answered(frame, 0)
+            return frame
+        for value in response:
+            frame = pending.popleft()
+            self.frame_answered(frame, RESPONSE_ACKNOWLEDGE_SIZE)
+            if value != ord(RESPONSE_ACKNOWLEDGE):
+                return frame
+            self.frame_acked(frame)
+        return None
+
+    def frame_sent(self, frame):
+        if self.observer is not None:
+            self.frame_times.append(time.monotonic())
+
+    def frame_answered(self, frame, received):
+        """
+        Reports the round trip of the oldest frame in a pipeline, which includes the time it
+        waited behind the frames sent before it
+        """
+        if self.observer is not None and len(self.frame_times) > 0:
+            self.frame_start = self.frame_times.popleft()
+            self.observer.round_trip(frame[1][0], time.monotonic() - self.frame_start, len(frame[1]), received)
+
+    def frame_acked(self, frame):
+        if frame[0] == COMMAND_DATA_SECTION:
+            # The data frame is the command, the data and the checksum LSB
+            self.bytes_written += len(frame[1]) - 2
+            self.unverified_bytes += len(frame[1]) - 2
+            if self.progress_callback is not None:
+                self.progress_callback(self.bytes_written)
+        elif frame[0] == COMMAND_VERIFY_DATA:
+            self.unverified_bytes = 0
+            self.verified_frame = frame
+            self.checkpoint(frame[4], frame[3])
+            if self.tuner is not None and self.tuner.window_acked():
+                self.apply_tuning()
+        elif frame[0] == COMMAND_ERASE_SECTOR:
+            # The bootloader erases one sector at a time, in a pipeline this one from when it was
+            # sent or the sector before it was done, whichever came later
+            self.observe_phase('erase', max(self.frame_start, self.ack_time), struct.unpack('<I', frame[1][1:5])[0])
+        self.ack_time = time.monotonic()
+        if self.ack_callback is not None:
+            self.ack_callback(frame)
+
+    def journal_key(self):
+        return UwfJournal.make_key(self.port_name, self.image.digest(), binascii.hexlify(self.ats).decode())
+
+    def start_journal(self):
+        """
+        Called once synchronised, when the bootloader's ATS is known, to look up the checkpoint to
+        resume from if resuming was asked for and check that the flash still holds what it says
+        The port's other checkpoints are dropped as this download overwrites what they describe
+        """
+        if self.journal is None or self.image is None:
+            return
+        if self.resume:
+            self.resume_point = self.journal.load(self.journal_key())
+            if self.resume_point is not None:
+                yield from self.check_resume_point()
+            if self.resume_point is not None and VERBOSELEVEL>=1:
+                print(f"Resuming at write command {self.resume_point[0]} offset=0x{self.resume_point[1]:x}")
+        self.journal.clear_port(self.port_name, self.journal_key() if self.resume_point is not None else None)
+
+    def check_resume_point(self):
+        """
+        Verifies the data written up to the checkpoint before any erase is skipped for it, and
+        downloads afresh if the flash no longer holds it, e.g. after another image was flashed
+        """
+        start = time.monotonic()
+        frames = self.resume_verify_frames()
+        responses = yield from self.query_frames(frames, self.pipeline_window)
+        ack = bytearray(RESPONSE_ACKNOWLEDGE, 'utf-8')
+        if any(response != ack for response in responses):
+            if VERBOSELEVEL>=1:
+                print("Flash does not match the checkpoint, downloading afresh")
+            self.resume_point = None
+        self.observe_phase('resume_check', start)
+
+    def resume_verify_frames(self):
+        """
+        Returns the verify frames for the data of the write commands up to the resume point, in
+        pieces of up to RESUME_VERIFY_SIZE bytes, at the base address of the bank each one selects
+        """
+        frames = []
+        base_addresses = {}
+        handle = None
+        for command in self.image.commands[:self.resume_point[0]+1]:
+            if command.cmd == 'G':
+                base_addresses[command.payload[0]] = struct.unpack('<I', command.payload[UWF_OFFSET_HANDLE:UWF_OFFSET_BASE_ADDRESS])[0]
+            elif command.cmd == 'S':
+                handle = command.payload[0]
+            elif command.cmd == 'W' and handle in base_addresses:
+                offset = struct.unpack('<I', command.payload[:UWF_OFFSET_WRITE_OFFSET])[0]
+                data = command.payload[UWF_WRITE_BLOCK_HDR_LENGTH:]
+                if command.index == self.resume_point[0]:
+                    data = data[:self.resume_point[1]]
+                for pos in range(0, len(data), RESUME_VERIFY_SIZE):
+                    block = data[pos:pos+RESUME_VERIFY_SIZE]
+                    frames.append(self.verify_frame(struct.pack('<I', base_addresses[handle]+offset+pos), len(block),
+                                                    uwf_checksum.block_checksum(block)))
+        return frames
+
+    def checkpoint(self, command_index, pos, flush=False):
+        """
+        Records that the data of write command 'command_index' is verified up to 'pos'
+        The journal is only written every JOURNAL_INTERVAL_SEC unless 'flush' is set
+        """
+        if self.journal is None or self.image is None or not self.record_checkpoints:
+            return
+        self.checkpoint_pending = (command_index, pos)
+        now = time.monotonic()
+        if flush or now - self.checkpoint_time >= JOURNAL_INTERVAL_SEC:
+            self.journal.save(self.journal_key(), command_index, pos)
+            self.checkpoint_time = now
+            self.checkpoint_pending = None
+
+    def flush_checkpoint(self):
+        if self.checkpoint_pending is not None:
+            self.checkpoint(self.checkpoint_pending[0], self.checkpoint_pending[1], flush=True)
+
+    def clear_checkpoint(self):
+        if self.journal is not None and self.image is not None and self.ats is not None:
+            self.journal.clear(self.journal_key())
+
+    def process_command_unregister(self, command):
         if VERBOSELEVEL>=3:
             print(f"UNREGISTER_DEVICE")
-        unregister_device_data = file.read(data_length)
+        unregister_device_data = command.payload
         handle = struct.unpack('B', unregister_device_data[:UWF_OFFSET_HANDLE])[0]
         if VERBOSELEVEL>=2:
             print(f"Unregister Device: hndl={handle}")
@@ -478,17 +1103,20 @@ class UwfProcessor():
             print(f"Reseting via uart_break")
         self.ser.setDTR(False)
         self.ser.break_condition=True
-        time.sleep(brk_timeout)
+        yield (IO_SLEEP, brk_timeout)
         self.ser.break_condition=False
         self.ser.setDTR(True)
-        time.sleep(post_delay)
+        yield (IO_SLEEP, post_delay)
         return None
             
     def process_reboot(self):
-        if VERBOSELEVEL>=2:
-            print(f"Reboot")
-        port_cmd_bytes = bytearray(COMMAND_REBOOT_BOOTLOADER, 'utf-8')
-        self.ser.write(port_cmd_bytes)
+        if self.reboot_reset_delay is not None:
+            yield from self.reset_via_uartbreak(post_delay=self.reboot_reset_delay)
+        else:
+            if VERBOSELEVEL>=2:
+                print(f"Reboot")
+            port_cmd_bytes = bytearray(COMMAND_REBOOT_BOOTLOADER, 'utf-8')
+            self.ser.write(port_cmd_bytes)
 
         # Cleanup
         self.ser.close()
@@ -4,6 +4,9 @@ class UwfProcessorBT900(UwfProcessor):
     """
     Class that encapsulates how to process UWF commands for BT900 module upgrade
     """
+    # Seconds to wait after the UART break resets, see UwfProcessor
+    bootloader_reset_delay = 2.5
+    reboot_reset_delay = 0.5
 
     def __init__(self, port, baudrate):
         UwfProcessor.__init__(self, port, baudrate)
@@ -12,11 +15,3 @@ class UwfProcessorBT900(UwfProcessor):
         self.expected_handle = 0
         self.expected_num_banks = 1
         self.expected_bank_algo = 1
-
-    def enter_bootloader(self):
-        self.reset_via_uartbreak(post_delay=2.5)
-        return UwfProcessor.enter_bootloader(self)
-
-    def process_reboot(self):
-        self.reset_via_uartbreak()
-        self.ser.close()
@@ -1,6 +1,6 @@
 import dbus
 from uwf_processor import UwfProcessor
-from uwf_processor import ERROR_REGISTER_DEVICE
+from uwf_processor import ERROR_REGISTER_DEVICE, IO_READLINE
 
 VERBOSELEVEL=0
 
@@ -36,14 +36,14 @@ class UwfProcessorRM1XX(UwfProcessor):
             success = True
 
             # Clear the serial line before starting
-            self.ser.readline()
+            yield (IO_READLINE,)
 
         return success
 
-    def process_command_register_device(self, file, data_length):
+    def process_command_register_device(self, command):
         error = None
 
-        UwfProcessor.process_command_register_device(self, file, data_length)
+        UwfProcessor.process_command_register_device(self, command)
 
         # Validate the registration data
         if self.handle == self.expected_handle and self.num_banks == self.expected_num_banks and self.bank_size > 0 and self.bank_algo == self.expected_bank_algo:
@@ -60,3 +60,5 @@ class UwfProcessorRM1XX(UwfProcessor):
 
         # Cleanup
         self.ser.close()
+        # A generator like the method it overrides, with nothing to wait for
+        yield from ()
@@ -0,0 +1,279 @@
+##########################################################################################
+# Streams the erase and write frames of a whole .uwf image through one pipeline
+##########################################################################################
+import collections
+import struct
+import time
+import uwf_processor
+from uwf_image import UWF_COMMAND_TARGET_PLATFORM, UWF_COMMAND_REGISTER, UWF_COMMAND_SELECT, \
+                      UWF_COMMAND_SECTOR_MAP, UWF_COMMAND_ERASE, UWF_COMMAND_WRITE, UWF_COMMAND_UNREGISTER
+
+BITS_PER_BYTE = 10      #start, 8 data and stop bits on the line
+ERASE_SPACING = 4       #data frames sent between two erase frames moved ahead into another region's writes
+
+class UwfScheduler():
+    """
+    Sends the erase and write commands that follow the target platform command as one stream
+    of frames, so that the pipeline does not drain at every command boundary, and moves the
+    erase frames of each region in between the data frames of the region before it, so that
+    the line carries write data while the device is busy erasing
+    Register, select, sector map and unregister commands never reach the bootloader, they
+    only change which addresses the frames carry, so they are replayed on the host while the
+    stream is planned and their state is restored as each write command is generated
+    A region's erases only move ahead if none of its sectors overlap the writes of the region
+    they are moved into, otherwise they are sent at their own place in the image
+    """
+    def __init__(self, processor, image):
+        self.processor = processor
+        self.image = image
+        self.start = 0
+        for command in image:
+            if command.cmd == UWF_COMMAND_TARGET_PLATFORM:
+                self.start = command.index + 1
+                break
+        self.erases = collections.OrderedDict()     #{erase command index: (region, baseaddr, sectors, checks, ranges)}
+        self.states = {}            #{write command index: host state to restore before generating it}
+        self.writes = {}            #{region: [(start address, end address)]}
+        self.order = []             #regions in the order their erase or write commands appear
+        self.hoist = {}             #{region: region its erases are moved into}
+        self.emitted = set()        #regions whose erase frames were generated
+        self.error = None
+        self.fallback = False
+        self.verified = None        #(command index, pos) of the last verify acknowledged
+        self.boundaries = collections.deque()   #[(frame sent before a command started, time and bytes_sent when the command's first frame was)]
+        self.last_frame = None
+        self.started = set()        #indexes of the commands whose first frame was sent
+        self.bytes_sent = 0
+        self.counted = (0.0, 0)     #time and bytes_sent up to which idle link time was counted, so overlapping waits count once
+        self.hoisted = 0
+        self.overlaps = 0
+        self.idle_removed = 0.0
+
+    def preamble(self):
+        """ Returns the commands up to and including the target platform command, sent as usual """
+        return self.image.commands[:self.start]
+
+    def remaining(self):
+        """ Returns the commands after the preamble, sent as usual after falling back """
+        return self.image.commands[self.start:]
+
+    def plan(self):
+        """
+        Replays the host side commands and works out the sectors each erase command erases
+        Returns None on success, otherwise the error string
+        """
+        p = self.processor
+        for command in self.remaining():
+            error = None
+            if command.cmd == UWF_COMMAND_REGISTER:
+                error = p.process_command_register_device(command)
+            elif command.cmd == UWF_COMMAND_SELECT:
+                error = p.process_command_select_device(command)
+            elif command.cmd == UWF_COMMAND_SECTOR_MAP:
+                error = p.process_command_sector_map(command)
+            elif command.cmd == UWF_COMMAND_ERASE:
+                error = self.plan_erase(command)
+            elif command.cmd == UWF_COMMAND_WRITE:
+                self.plan_write(command)
+            elif command.cmd == UWF_COMMAND_UNREGISTER:
+                error = p.process_command_unregister(command)
+            if error != None:
+                return error
+        return None
+
+    def plan_erase(self, command):
+        p = self.processor
+        error, baseaddr, sectors = p.erase_sectors(command)
+        if error is None and sectors is not None:
+            checks = p.sector_checks(command, sectors, baseaddr)
+            ranges = [(baseaddr+ofs, baseaddr+ofs+p.sector_map.sector_at(ofs)[1]) for ofs in sectors]
+            self.erases[command.index] = (command.region, baseaddr, sectors, checks, ranges)
+            self.appears(command.region)
+        return error
+
+    def plan_write(self, command):
+        p = self.processor
+        self.states[command.index] = (p.selected_handle, p.selected_bank, p.sector_map)
+        if p.selected_handle in p.mem_base_address:
+            start = p.mem_base_address[p.selected_handle] + struct.unpack('<I', command.payload[:uwf_processor.UWF_OFFSET_WRITE_OFFSET])[0]
+            self.writes.setdefault(command.region, []).append((start, start + command.length - uwf_processor.UWF_WRITE_BLOCK_HDR_LENGTH))
+        self.appears(command.region)
+
+    def appears(self, region):
+        if region not in self.order:
+            self.order.append(region)
+
+    def check_frames(self):
+        """ Returns the delta or blank check frames of every erase command, in order """
+        return [check[1] for erase in self.erases.values() for check in erase[3]]
+
+    def checked(self, responses):
+        """
+        Drops the sectors whose checks were acknowledged from the erases and decides which
+        regions' erases can move into the writes of the region before them
+        """
+        p = self.processor
+        pos = 0
+        for index, (region, baseaddr, sectors, checks, ranges) in list(self.erases.items()):
+            if len(checks) > 0:
+                sectors = p.sectors_to_erase(sectors, checks, responses[pos:pos+len(checks)])
+                pos += len(checks)
+                ranges = [r for r, ofs in zip(ranges, self.erases[index][2]) if ofs in sectors]
+            self.erases[index] = (region, baseaddr, sectors, checks, ranges)
+        self.arrange()
+
+    def arrange(self):
+        for previous, region in zip(self.order, self.order[1:]):
+            ranges = [r for erase in self.erases.values() if erase[0] == region for r in erase[4]]
+            writes = self.writes.get(previous, [])
+            if len(ranges) > 0 and len(writes) > 0 and not overlapping(ranges, writes):
+                self.hoist[region] = previous
+
+    def region_erase_frames(self, region):
+        """ Returns the erase frames of every erase command of 'region' and marks them generated """
+        p = self.processor
+        self.emitted.add(region)
+        frames = []
+        for index, (erase_region, baseaddr, sectors, checks, ranges) in self.erases.items():
+            if erase_region == region:
+                frames += p.erase_frames(sectors, baseaddr, index)
+        p.erased = True
+        return frames
+
+    def frames(self):
+        """
+        Generates the frames of every erase and write command after the preamble, with the
+        erase frames of the next region spread over the data frames of the current one
+        """
+        p = self.processor
+        pending = collections.deque()
+        data_frames = 0
+        writing = None
+        for command in self.remaining():
+            if command.cmd == UWF_COMMAND_ERASE:
+                while len(pending) > 0:
+                    yield self.sent(pending.popleft())
+                if command.region not in self.emitted and command.index in self.erases:
+                    for frame in self.region_erase_frames(command.region):
+                        yield self.sent(frame)
+            elif command.cmd == UWF_COMMAND_WRITE:
+                if command.region != writing:
+                    while len(pending) > 0:
+                        yield self.sent(pending.popleft())
+                    writing = command.region
+                    for region, into in self.hoist.items():
+                        if into == writing and region not in self.emitted:
+                            moved = self.region_erase_frames(region)
+                            self.hoisted += len(moved)
+                            pending.extend(moved)
+                p.selected_handle, p.selected_bank, p.sector_map = self.states[command.index]
+                error, data, offset, baseaddr, pos = p.write_plan(command)
+                if error is not None:
+                    self.error = error
+                    return
+                if data is None:
+                    continue
+                for frame in p.write_block_frames(data, offset, baseaddr, pos):
+                    yield self.sent(frame)
+                    if frame[0] == uwf_processor.COMMAND_DATA_SECTION:
+                        data_frames += 1
+                        if len(pending) > 0 and data_frames % ERASE_SPACING == 0:
+                            yield self.sent(pending.popleft())
+        while len(pending) > 0:
+            yield self.sent(pending.popleft())
+
+    def sent(self, frame):
+        """ Notes the frame sent before each command starts and when the command's first frame went out """
+        if frame[4] not in self.started:
+            self.started.add(frame[4])
+            if self.last_frame is not None:
+                self.boundaries.append((self.last_frame, time.monotonic(), self.bytes_sent))
+        self.last_frame = frame
+        self.bytes_sent += len(frame[1])
+        return frame
+
+    def frame_acked(self, frame):
+        """
+        Set as the processor's ack_callback, sending each command on its own would have left
+        the link idle from sending the first frame of a command until the frame before it was
+        acknowledged, the link time of the bytes sent in that time is what streaming saved
+        """
+        if frame[0] == uwf_processor.COMMAND_VERIFY_DATA:
+            self.verified = (frame[4], frame[3])
+        if len(self.boundaries) > 0 and self.boundaries[0][0] is frame:
+            last, sent, bytes_sent = self.boundaries.popleft()
+            start = max(sent, self.counted[0])
+            now = time.monotonic()
+            idle = min(now - start, (self.bytes_sent - max(bytes_sent, self.counted[1])) * BITS_PER_BYTE / self.processor.ser.baudrate)
+            self.counted = (now, self.bytes_sent)
+            if idle > 0:
+                self.overlaps += 1
+                self.idle_removed += idle
+                if self.processor.observer is not None:
+                    self.processor.observer.phase('overlap', start, idle)
+
+    def run(self):
+        """
+        Generator for the processor's run() that sends the checks and then the whole stream of
+        erase and write frames
+        Returns None on success, otherwise the error string, or sets 'fallback' if a frame was
+        not acknowledged and the remaining commands should be sent one at a time
+        """
+        p = self.processor
+        error = self.plan()
+        if error is None and self.checks_see_writes():
+            # Checking every sector up front would miss what earlier regions write over it
+            self.fallback = True
+            p.erased_sectors = set()
+        elif error is None:
+            checks = self.check_frames()
+            self.checked((yield from p.query_frames(checks, p.pipeline_window)) if len(checks) > 0 else [])
+            p.ack_callback = self.frame_acked
+            try:
+                failed = yield from p.send_frames_pipelined(self.frames(), p.pipeline_window)
+            finally:
+                p.ack_callback = None
+            error = yield from self.finished(failed)
+        return error
+
+    def checks_see_writes(self):
+        """
+        Returns True if a sector that is checked before erasing it is also written by a region
+        that comes before its own
+        """
+        for region, baseaddr, sectors, checks, ranges in self.erases.values():
+            if len(checks) > 0:
+                for earlier in self.order[:self.order.index(region)]:
+                    if overlapping(ranges, self.writes.get(earlier, [])):
+                        return True
+        return False
+
+    def finished(self, failed):
+        p = self.processor
+        if failed is not None:
+            # Carry on in stop-and-wait mode from the last verified point, planning the
+            # erases that are not behind it again
+            self.fallback = True
+            p.pipeline_window = 0
+            p.erased_sectors = set()
+            p.observe_retry('pipeline')
+            if self.verified is not None:
+                p.resume_point = self.verified
+            if p.tuner is not None:
+                p.tuner.failed()
+                p.apply_tuning()
+            if uwf_processor.VERBOSELEVEL>=2:
+                print("\nNon-ack in scheduled stream, continuing in stop-and-wait mode")
+            p.rewind_progress()
+            return (yield from p.resync())
+        if self.error is None:
+            p.write_complete = True
+        if uwf_processor.VERBOSELEVEL>=2:
+            print('.',end='\n',flush=True)
+        if uwf_processor.VERBOSELEVEL>=1:
+            print(f"Schedule: {self.hoisted} erases moved into earlier writes, {self.idle_removed:.3f}s of idle link time removed at {self.overlaps} command boundaries")
+        return self.error
+
+def overlapping(ranges, others):
+    """ Returns True if any of the (start, end) 'ranges' overlaps any of the 'others' """
+    return any(start < other_end and other_start < end for start, end in ranges for other_start, other_end in others)
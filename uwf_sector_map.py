@@ -0,0 +1,70 @@
+##########################################################################################
+# Sector layout of a flash bank, as described by a UWF sector map command
+##########################################################################################
+import bisect
+import struct
+
+UWF_UI32_SIZE = 4
+
+class SectorMap():
+    """
+    Immutable map of the sectors of a bank, built once per sector map command
+    'runs' is a list of (number of sectors, sector size) in address order. The bank offset
+    that each run starts at is summed up front so that the sector holding an offset is found
+    with a bisect over the runs and a division within the run
+    """
+    def __init__(self, runs):
+        self.runs = tuple((count, size) for count, size in runs)
+        run_starts = []
+        offset = 0
+        for count, size in self.runs:
+            run_starts.append(offset)
+            offset += count * size
+        self.run_starts = tuple(run_starts)
+        self.size = offset
+        self.count = sum([count for count, size in self.runs if size > 0])
+
+    @classmethod
+    def from_payload(cls, payload, length):
+        """ Parses the (number of sectors, sector size) pairs of a sector map command """
+        arrsize = int(length/(UWF_UI32_SIZE+UWF_UI32_SIZE))
+        if arrsize*(UWF_UI32_SIZE+UWF_UI32_SIZE) != length:
+            raise Exception('SectorMap length error in uwf file')
+        return cls(struct.iter_unpack('<II', payload[:length]))
+
+    def __len__(self):
+        return self.count
+
+    def __str__(self):
+        return f"sectors={[count for count, size in self.runs]} size={[size for count, size in self.runs]}"
+
+    def valid(self):
+        """ Returns True if the first run has sectors of a non-zero size """
+        return len(self.runs) > 0 and self.runs[0][0] > 0 and self.runs[0][1] > 0
+
+    def run_at(self, ofs):
+        if ofs < 0 or ofs >= self.size:
+            raise Exception('Offset outside sector map')
+        # Runs of no sectors start where the next run does, so the last run starting at or
+        # before 'ofs' is the one holding it
+        return bisect.bisect_right(self.run_starts, ofs) - 1
+
+    def sector_at(self, ofs):
+        """ Returns (start, size) of the sector holding bank offset 'ofs' """
+        run = self.run_at(ofs)
+        count, size = self.runs[run]
+        start = self.run_starts[run] + (ofs - self.run_starts[run]) // size * size
+        return (start, size)
+
+    def sectors_in(self, start, end):
+        """ Returns the start offsets of the sectors that the bank offsets 'start' to 'end' touch """
+        sectors = []
+        ofs = start
+        while ofs < min(end, self.size):
+            run = self.run_at(ofs)
+            count, size = self.runs[run]
+            run_end = min(end, self.run_starts[run] + count * size)
+            first = self.run_starts[run] + (ofs - self.run_starts[run]) // size * size
+            sectors.extend(range(first, run_end, size))
+            ofs = self.run_starts[run] + count * size
+        return sectors
@@ -0,0 +1,146 @@
+##########################################################################################
+# Timing, throughput and retry instrumentation for firmware downloads
+##########################################################################################
+import collections
+import csv
+import json
+import time
+
+# Upper bounds, in seconds, of the round trip histogram buckets, the last bucket is unbounded
+RTT_BUCKETS = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+
+# Names of the bootloader commands by their first byte, 'a' acknowledges the sync response
+COMMAND_NAMES = {0x80: 'sync', ord('a'): 'sync_ack', ord('p'): 'platform', ord('e'): 'erase',
+                 ord('w'): 'write', ord('d'): 'data', ord('v'): 'verify', ord('z'): 'reboot'}
+
+class UwfObserver():
+    """
+    Receives events from a UwfProcessor as the download runs, subclass it and set it as the
+    processor's observer, or pass it to uwfloader.loadfirmware
+        phase       a step of the download finished, 'start' is its time.monotonic() start and
+                    'detail' the address of the erase or write block where there is one
+        round_trip  the response to the bootloader command starting with byte 'command' arrived,
+                    'received' is 0 if it timed out
+        retry       the download fell back after a failure, 'reason' is 'baud', 'pipeline'
+                    or 'tuning'
+    Phases are bootloader, sync, platform, erase_check for each erase command that checks its
+    sectors, erase for each sector erased, keyed by its address, write for each write command,
+    verify for each verify frame in stop-and-wait mode, and reboot
+    A scheduled download reports overlap instead of write, for each command whose first frame
+    was sent before the frames ahead of it were acknowledged
+    """
+    def phase(self, name, start, seconds, detail=None):
+        pass
+
+    def round_trip(self, command, seconds, sent, received):
+        pass
+
+    def retry(self, reason):
+        pass
+
+class RoundTrips():
+    """ Count, total, extremes and histogram of the round trip times of one command type """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = 0.0
+        self.timeouts = 0
+        self.histogram = [0] * (len(RTT_BUCKETS) + 1)
+
+    def add(self, seconds, received):
+        self.count += 1
+        self.total += seconds
+        self.minimum = seconds if self.minimum is None else min(self.minimum, seconds)
+        self.maximum = max(self.maximum, seconds)
+        if received == 0:
+            self.timeouts += 1
+        bucket = 0
+        while bucket < len(RTT_BUCKETS) and seconds > RTT_BUCKETS[bucket]:
+            bucket += 1
+        self.histogram[bucket] += 1
+
+    def summary(self):
+        return {'count': self.count, 'total': self.total, 'mean': self.total / self.count if self.count else 0.0,
+                'min': self.minimum, 'max': self.maximum, 'timeouts': self.timeouts,
+                'histogram': {bucket_label(i): n for i, n in enumerate(self.histogram) if n > 0}}
+
+def bucket_label(index):
+    if index < len(RTT_BUCKETS):
+        return f"<={RTT_BUCKETS[index]*1000:g}ms"
+    return f">{RTT_BUCKETS[-1]*1000:g}ms"
+
+class UwfStats(UwfObserver):
+    """
+    Collects everything a UwfObserver is told for one download session and writes it out as
+    JSON or CSV, phase start times are in seconds from when the UwfStats was created
+    """
+    def __init__(self, port=None):
+        self.port = port
+        self.started = time.time()
+        self.origin = time.monotonic()
+        self.phases = []        #[(name, start, seconds, detail)] in the order they finished
+        self.round_trips = collections.OrderedDict()    #{command name: RoundTrips}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.retries = collections.Counter()
+
+    def phase(self, name, start, seconds, detail=None):
+        self.phases.append((name, start - self.origin, seconds, detail))
+
+    def round_trip(self, command, seconds, sent, received):
+        name = COMMAND_NAMES.get(command, f"0x{command:02x}")
+        self.round_trips.setdefault(name, RoundTrips()).add(seconds, received)
+        self.bytes_sent += sent
+        self.bytes_received += received
+
+    def retry(self, reason):
+        self.retries[reason] += 1
+
+    def phase_totals(self):
+        """ Returns {phase name: {'count': n, 'seconds': total}} in the order phases first finished """
+        totals = collections.OrderedDict()
+        for name, start, seconds, detail in self.phases:
+            total = totals.setdefault(name, {'count': 0, 'seconds': 0.0})
+            total['count'] += 1
+            total['seconds'] += seconds
+        return totals
+
+    def summary(self):
+        elapsed = time.monotonic() - self.origin
+        return {'port': self.port, 'started': self.started, 'elapsed': elapsed,
+                'bytes_sent': self.bytes_sent, 'bytes_received': self.bytes_received,
+                'throughput': self.bytes_sent / elapsed if elapsed > 0 else 0.0,
+                'retries': dict(self.retries), 'phase_totals': self.phase_totals(),
+                'round_trips': {name: rtt.summary() for name, rtt in self.round_trips.items()}}
+
+    def dump_json(self, path):
+        report = self.summary()
+        report['phases'] = [{'name': name, 'start': start, 'seconds': seconds, 'detail': detail}
+                            for name, start, seconds, detail in self.phases]
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=1)
+
+    def dump_csv(self, path):
+        """ One row per phase, round trip histogram bucket and total, distinguished by 'record' """
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['record', 'name', 'start', 'seconds', 'count', 'detail'])
+            for name, start, seconds, detail in self.phases:
+                writer.writerow(['phase', name, f"{start:.6f}", f"{seconds:.6f}", 1, '' if detail is None else f"0x{detail:08x}"])
+            for name, rtt in self.round_trips.items():
+                writer.writerow(['rtt_total', name, '', f"{rtt.total:.6f}", rtt.count, f"timeouts={rtt.timeouts}"])
+                for index, count in enumerate(rtt.histogram):
+                    if count > 0:
+                        writer.writerow(['rtt', name, '', '', count, bucket_label(index)])
+            for reason, count in self.retries.items():
+                writer.writerow(['retry', reason, '', '', count, ''])
+            writer.writerow(['bytes', 'sent', '', '', self.bytes_sent, ''])
+            writer.writerow(['bytes', 'received', '', '', self.bytes_received, ''])
+
+    def dump(self, path):
+        """ Writes CSV if 'path' ends in .csv, otherwise JSON """
+        if path.lower().endswith('.csv'):
+            self.dump_csv(path)
+        else:
+            self.dump_json(path)
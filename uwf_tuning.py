@@ -0,0 +1,104 @@
+##########################################################################################
+# Adaptive write block size and verify interval for firmware downloads
+##########################################################################################
+import os
+import time
+from sbstore import JsonStore, STORE_DIR
+
+TUNING_PATH = os.path.join(STORE_DIR, 'uwf_tuning.json')
+
+BLOCK_SIZES = (64, 128, 192, 252)       #bytes per data block tried, each at most 252 and divisible by 4
+VERIFY_LIMITS = (2, 4, 8, 16, 32)       #data blocks per verify tried
+START_BLOCK_SIZE = 128                  #as uwflash uses, for a device type not tuned before
+START_VERIFY_LIMIT = 4
+GROW_AFTER_WINDOWS = 4                  #clean verified windows needed before trying larger settings
+RELAX_AFTER_WINDOWS = 16                #clean verified windows after which settings that failed are tried again
+MAX_RETRIES = 3                         #failures in a row, without a verified window between, before giving up
+
+class UwfTuner():
+    """
+    Picks the data block size and number of blocks per verify as a download runs
+    Every GROW_AFTER_WINDOWS verified windows without a failure it steps up the block size,
+    or the verify interval once the block size is at its largest, and after a NAK or timeout
+    it steps both down and does not grow back to the settings that failed until
+    RELAX_AFTER_WINDOWS windows in a row were clean, so a one-off glitch does not cap them
+    'best' is the pair of the last verified window, the one to remember
+    """
+    def __init__(self, block_size=START_BLOCK_SIZE, verify_limit=START_VERIFY_LIMIT):
+        self.block_index = nearest_index(BLOCK_SIZES, block_size)
+        self.verify_index = nearest_index(VERIFY_LIMITS, verify_limit)
+        self.block_ceiling = len(BLOCK_SIZES) - 1
+        self.verify_ceiling = len(VERIFY_LIMITS) - 1
+        self.clean_windows = 0
+        self.windows_since_failure = 0
+        self.failures = 0
+        self.best = None
+
+    @property
+    def block_size(self):
+        return BLOCK_SIZES[self.block_index]
+
+    @property
+    def verify_limit(self):
+        return VERIFY_LIMITS[self.verify_index]
+
+    def window_acked(self):
+        """ Called as each verify is acknowledged, returns True if the settings changed """
+        self.failures = 0
+        self.best = (self.block_size, self.verify_limit)
+        self.windows_since_failure += 1
+        if self.windows_since_failure % RELAX_AFTER_WINDOWS == 0:
+            self.block_ceiling = min(self.block_ceiling + 1, len(BLOCK_SIZES) - 1)
+            self.verify_ceiling = min(self.verify_ceiling + 1, len(VERIFY_LIMITS) - 1)
+        self.clean_windows += 1
+        if self.clean_windows < GROW_AFTER_WINDOWS:
+            return False
+        self.clean_windows = 0
+        if self.block_index < self.block_ceiling:
+            self.block_index += 1
+            return True
+        if self.verify_index < self.verify_ceiling:
+            self.verify_index += 1
+            return True
+        return False
+
+    def failed(self):
+        """ Called after a NAK or timeout, returns False once the write should be given up on """
+        self.failures += 1
+        self.clean_windows = 0
+        self.windows_since_failure = 0
+        self.block_ceiling = max(0, min(self.block_ceiling, self.block_index - 1))
+        self.verify_ceiling = max(0, min(self.verify_ceiling, self.verify_index - 1))
+        self.block_index = max(0, self.block_index - 1)
+        self.verify_index = max(0, self.verify_index - 1)
+        return self.failures <= MAX_RETRIES
+
+def nearest_index(values, value):
+    """ Returns the index of the largest of 'values' that is at most 'value', or 0 """
+    index = 0
+    for i in range(len(values)):
+        if values[i] <= value:
+            index = i
+    return index
+
+class UwfTuning(JsonStore):
+    """
+    Remembers the best block size and verify interval found per device type
+    """
+    def __init__(self, path=TUNING_PATH):
+        JsonStore.__init__(self, path, 'Tuning')
+
+    def load(self, dev_type):
+        """
+        Returns (block_size, verify_limit) remembered for 'dev_type', or None if there are none
+        """
+        entry = self.get(dev_type)
+        if entry is None:
+            return None
+        return (entry['block_size'], entry['verify_limit'])
+
+    def save(self, dev_type, block_size, verify_limit):
+        def change(entries):
+            entries[dev_type] = {'block_size': block_size, 'verify_limit': verify_limit, 'time': time.time()}
+            return entries
+        self.update(change)
@@ -0,0 +1,439 @@
+#!/usr/bin/env python3
+"""
+This is a stand-in for the Laird UART bootloader, for testing and benchmarking firmware downloads without hardware.
+
+Usage: python3 uwfemu.py [options]
+       options
+           --tcp PORT          listen on a TCP port instead of creating a pseudo terminal
+           --sectors N         number of flash sectors, default 256
+           --sector-size N     bytes per flash sector, default 4096
+           --base ADDR         address of the first sector, default 0
+           --platform-id ID    platform id the 'p' command must match, default any
+           --byte-delay SECS   time each byte spends on the line, default 10/115200
+           --latency SECS      processing time per command, default 0.002
+           --nak-rate P        probability of answering a command with 'f' instead of acting on it
+           --drop-rate P       probability of not answering a command at all
+           --nak-at N,..       numbers of the commands to answer with 'f', counting from 1
+           --seed N            seed for the fault injection
+
+The pseudo terminal path or TCP port is printed on startup. Point uwfload.py or sbutil.py at
+the pty with model GENERIC, or open socket://localhost:PORT with serial.serial_for_url and pass
+the port object to uwfloader.loadfirmware. Command counts are printed when stopped with Ctrl-C.
+A LoopbackBootloader answers the same protocol in-process, as a port object for loadfirmware.
+"""
+
+#-----------------------------------------------------------------------------
+# constants
+#-----------------------------------------------------------------------------
+
+DEFAULT_SECTORS=256
+DEFAULT_SECTOR_SIZE=4096
+DEFAULT_BASE_ADDRESS=0
+DEFAULT_BYTE_DELAY=10.0/115200
+DEFAULT_LATENCY=0.002
+DEFAULT_BAUDRATE=115200
+DEFAULT_MAX_BAUDRATE=921600     #fastest rate a LoopbackBootloader syncs at
+DEFAULT_TIMEOUT=3               #read timeout a LoopbackBootloader reports, as uwf_processor opens ports with
+
+EMULATOR_ATS=b'UWFEMU LOADER '
+
+#-----------------------------------------------------------------------------
+# Module imports
+#-----------------------------------------------------------------------------
+import argparse
+import collections
+import os
+import random
+import select
+import socket
+import struct
+import threading
+import time
+import tty
+from uwf_sector_map import SectorMap
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class BootloaderModel(object):
+    """
+    The bootloader protocol and a simulated flash laid out by a sector map
+    'sector_map' is a list of (number of sectors, sector size) in address order, as in a UWF 'M' command
+    """
+    def __init__(self, sector_map=((DEFAULT_SECTORS, DEFAULT_SECTOR_SIZE),), base_address=DEFAULT_BASE_ADDRESS,
+                 platform_id=None, ats=EMULATOR_ATS, nak_rate=0.0, drop_rate=0.0, nak_at=(), seed=None):
+        self.base_address = base_address
+        self.platform_id = platform_id
+        self.ats = ats
+        self.nak_rate = nak_rate
+        self.drop_rate = drop_rate
+        self.nak_at = set(nak_at)
+        self.random = random.Random(seed)
+
+        self.sector_map = SectorMap(sector_map)
+        self.flash = bytearray(b'\xff' * self.sector_map.size)
+
+        self.write_addr = 0
+        self.write_len = 0
+        self.commands = 0
+        self.counts = collections.Counter()
+        self.faults = 0
+
+    def frame_length(self, rx):
+        """ Returns the length of the frame at the start of 'rx', or 0 if that is not known yet """
+        cmd = rx[0]
+        if cmd == ord('A'):
+            # AT commands sent before the bootloader runs, e.g. AT+FUP
+            end = rx.find(b'\r')
+            return end + 1 if end >= 0 else 0
+        if cmd == ord('d'):
+            return 1 + self.write_len + 1
+        return {0x80: 1, ord('a'): 1, ord('p'): 5, ord('e'): 5, ord('w'): 6, ord('v'): 13, ord('z'): 1}.get(cmd, 1)
+
+    def times_frame(self, frame):
+        """ AT commands sent before the bootloader runs are not timed as part of the download """
+        return frame[0] != ord('A')
+
+    def sector_at(self, offset):
+        """ Returns (start, end) offsets of the sector holding 'offset' """
+        start, size = self.sector_map.sector_at(offset)
+        return (start, start + size)
+
+    def offset(self, addr, size=0):
+        offset = addr - self.base_address
+        if offset < 0 or offset + size > len(self.flash):
+            return None
+        return offset
+
+    def handle(self, frame):
+        """ Acts on one frame and returns the bytes to send back """
+        cmd = frame[:1]
+        if frame[0] == 0x80:
+            return self.ats
+        if cmd == b'A':
+            return b''
+        self.commands += 1
+        self.counts[cmd.decode('latin-1')] += 1
+        if cmd == b'w':
+            # Taken even when the command is faulted, the length frames the data that follows
+            self.write_addr = struct.unpack('<I', frame[1:5])[0]
+            self.write_len = frame[5]
+        if cmd != b'a':
+            # The ack to the ATS is never faulted so that syncing always works
+            if self.commands in self.nak_at or (self.nak_rate and self.random.random() < self.nak_rate):
+                self.faults += 1
+                return b'f'
+            if self.drop_rate and self.random.random() < self.drop_rate:
+                self.faults += 1
+                return b''
+
+        if cmd == b'a':
+            return b'a'
+        elif cmd == b'p':
+            platform_id = struct.unpack('<I', frame[1:5])[0]
+            return b'a' if self.platform_id is None or platform_id == self.platform_id else b'f'
+        elif cmd == b'e':
+            offset = self.offset(struct.unpack('<I', frame[1:5])[0], 1)
+            if offset is None:
+                return b'f'
+            start, end = self.sector_at(offset)
+            self.flash[start:end] = b'\xff' * (end - start)
+            return b'a'
+        elif cmd == b'w':
+            return b'a' if self.offset(self.write_addr, self.write_len) is not None else b'f'
+        elif cmd == b'd':
+            block = frame[1:-1]
+            offset = self.offset(self.write_addr, len(block))
+            if offset is None or sum(block) & 0xFF != frame[-1]:
+                return b'f'
+            # Programming flash can only clear bits
+            for i in range(len(block)):
+                self.flash[offset + i] &= block[i]
+            return b'a'
+        elif cmd == b'v':
+            addr, size, checksum = struct.unpack('<III', frame[1:13])
+            offset = self.offset(addr, size)
+            if offset is None:
+                return b'f'
+            return b'a' if sum(self.flash[offset:offset+size]) == checksum else b'f'
+        elif cmd == b'z':
+            return b''
+        return b'f'
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class LoopbackBootloader(object):
+    """
+    Serial port look-alike that answers the bootloader protocol of 'model' in-process, for
+    benchmarks and tests that need no pty or thread
+    Responses become readable only once the modelled wire and processing time has elapsed
+    """
+    def __init__(self, model=None, baudrate=DEFAULT_BAUDRATE, latency=DEFAULT_LATENCY,
+                 max_baudrate=DEFAULT_MAX_BAUDRATE, erase_time=0.0):
+        self.baudrate = baudrate
+        self.max_baudrate = max_baudrate
+        self.timeout = DEFAULT_TIMEOUT
+        self.latency = latency
+        self.erase_time = erase_time
+        self.model = model if model is not None else BootloaderModel()
+        self.flash = self.model.flash
+        self.break_condition = False
+        self.rx = bytearray()
+        self.tx = collections.deque()
+        self.line_free = 0.0
+        self.device_free = 0.0
+        self.commands = 0
+
+    def byte_time(self):
+        # 8 data bits plus start and stop bits
+        return 10.0 / self.baudrate
+
+    def write(self, data):
+        if self.baudrate > self.max_baudrate:
+            # Too fast for the bootloader, nothing it receives makes sense
+            return len(data)
+        self.line_free = max(self.line_free, time.monotonic()) + len(data) * self.byte_time()
+        self.rx += data
+        self.parse(self.line_free)
+        return len(data)
+
+    def parse(self, arrival):
+        while len(self.rx) > 0:
+            length = self.model.frame_length(self.rx)
+            if length == 0 or len(self.rx) < length:
+                break
+            frame = bytes(self.rx[:length])
+            del self.rx[:length]
+            response = self.model.handle(frame)
+            self.commands += 1
+            done = max(arrival, self.device_free) + self.latency
+            if frame[:1] == b'e' and response == b'a':
+                done += self.erase_time
+            self.device_free = done
+            for i in range(len(response)):
+                self.tx.append((done + (i + 1) * self.byte_time(), response[i:i+1]))
+
+    @property
+    def in_waiting(self):
+        now = time.monotonic()
+        count = 0
+        for available, value in self.tx:
+            if available > now:
+                break
+            count += 1
+        return count
+
+    def read(self, size=1):
+        # Only bytes already queued will ever arrive, so never wait out the timeout
+        response = b''
+        while len(response) < size and len(self.tx) > 0:
+            available, value = self.tx.popleft()
+            delay = available - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            response += value
+        return response
+
+    def readline(self):
+        return self.read(self.in_waiting)
+
+    def reset_input_buffer(self):
+        for i in range(self.in_waiting):
+            self.tx.popleft()
+
+    def setDTR(self, state):
+        pass
+
+    def close(self):
+        pass
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class BootloaderEmulator(object):
+    """
+    Serves a BootloaderModel, or any model with the same frame_length, handle and times_frame
+    methods, on a pseudo terminal or TCP socket from a background thread
+    Each byte takes 'byte_delay' seconds on the line in each direction and each command
+    takes 'latency' seconds to process once all of it has arrived
+    """
+    def __init__(self, model, byte_delay=DEFAULT_BYTE_DELAY, latency=DEFAULT_LATENCY):
+        self.model = model
+        self.byte_delay = byte_delay
+        self.latency = latency
+        self.master = None
+        self.slave = None
+        self.server = None
+        self.conn = None
+        self.path = None
+        self.stopped = False
+        self.thread = None
+        self.rx = bytearray()
+        self.rx_free = 0.0
+        self.tx_free = 0.0
+        # Times the emulator answered and then found nothing more to do, i.e. the host was waiting on it
+        self.round_trips = 0
+        self.first_command_time = None
+        self.last_command_time = None
+
+    def open_pty(self):
+        """ Creates the pseudo terminal, starts serving and returns the path for the host to open """
+        self.master, self.slave = os.openpty()
+        # No echo or line editing, bytes pass through as on a UART
+        tty.setraw(self.slave)
+        self.path = os.ttyname(self.slave)
+        self.start()
+        return self.path
+
+    def listen_tcp(self, port=0, host='localhost'):
+        """ Listens for one connection at a time, starts serving and returns the port number """
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(1)
+        self.path = f"socket://{host}:{self.server.getsockname()[1]}"
+        self.start()
+        return self.server.getsockname()[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve, name='uwfemu', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        if self.thread is not None:
+            self.thread.join()
+        for fd in (self.master, self.slave):
+            if fd is not None:
+                os.close(fd)
+        for sock in (self.conn, self.server):
+            if sock is not None:
+                sock.close()
+
+    def source(self):
+        """ Returns what to wait on for input, accepting a TCP connection if there is none """
+        if self.server is None:
+            return self.master
+        if self.conn is None:
+            if len(select.select([self.server], [], [], 0.1)[0]) > 0:
+                self.conn = self.server.accept()[0]
+                self.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return None
+        return self.conn
+
+    def recv(self):
+        if self.conn is not None:
+            data = self.conn.recv(4096)
+            if len(data) == 0:
+                # Host closed, wait for the next one
+                self.conn.close()
+                self.conn = None
+            return data
+        return os.read(self.master, 4096)
+
+    def send(self, data):
+        if self.conn is not None:
+            self.conn.sendall(data)
+        else:
+            os.write(self.master, data)
+
+    def serve(self):
+        while not self.stopped:
+            source = self.source()
+            if source is None or len(select.select([source], [], [], 0.1)[0]) == 0:
+                continue
+            try:
+                data = self.recv()
+            except OSError:
+                continue
+            # The bytes were written by the host before now, they finish arriving a line time later
+            self.rx_free = max(self.rx_free, time.monotonic()) + len(data) * self.byte_delay
+            self.rx += data
+            answered = self.process()
+            if answered and len(select.select([source], [], [], 0)[0]) == 0:
+                self.round_trips += 1
+
+    def process(self):
+        """ Handles every complete frame received so far and returns True if any were answered """
+        answered = False
+        while len(self.rx) > 0:
+            length = self.model.frame_length(self.rx)
+            if length == 0 or len(self.rx) < length:
+                break
+            frame = bytes(self.rx[:length])
+            del self.rx[:length]
+            response = self.model.handle(frame)
+            now = time.monotonic()
+            if self.model.times_frame(frame):
+                if self.first_command_time is None:
+                    self.first_command_time = now
+                self.last_command_time = now
+            # Bytes still buffered after this frame arrived after it
+            arrival = self.rx_free - len(self.rx) * self.byte_delay
+            done = max(arrival, now) + self.latency
+            self.tx_free = max(self.tx_free, done) + len(response) * self.byte_delay
+            delay = self.tx_free - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            if len(response) > 0:
+                self.send(response)
+                answered = True
+        return answered
+
+    def active_seconds(self):
+        """ Returns the time from the first bootloader command to the last """
+        if self.first_command_time is None:
+            return 0.0
+        return self.last_command_time - self.first_command_time
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def setup_arg_parser():
+    parser = argparse.ArgumentParser(
+        description='Emulate the Laird UART bootloader on a pseudo terminal or TCP socket.')
+    parser.add_argument('--tcp', type=int, metavar="PORT", help="Listen on a TCP port instead of a pty")
+    parser.add_argument('--sectors', type=int, default=DEFAULT_SECTORS, metavar="N",
+                        help=f"Number of flash sectors, default={DEFAULT_SECTORS}")
+    parser.add_argument('--sector-size', type=int, default=DEFAULT_SECTOR_SIZE, metavar="N",
+                        help=f"Bytes per flash sector, default={DEFAULT_SECTOR_SIZE}")
+    parser.add_argument('--base', type=lambda text: int(text, 0), default=DEFAULT_BASE_ADDRESS, metavar="ADDR",
+                        help=f"Address of the first sector, default={DEFAULT_BASE_ADDRESS}")
+    parser.add_argument('--platform-id', type=lambda text: int(text, 0), metavar="ID",
+                        help="Platform id the 'p' command must match, default=any")
+    parser.add_argument('--byte-delay', type=float, default=DEFAULT_BYTE_DELAY, metavar="SECS",
+                        help=f"Line time per byte, default={DEFAULT_BYTE_DELAY:.7f}")
+    parser.add_argument('--latency', type=float, default=DEFAULT_LATENCY, metavar="SECS",
+                        help=f"Processing time per command, default={DEFAULT_LATENCY}")
+    parser.add_argument('--nak-rate', type=float, default=0.0, metavar="P",
+                        help="Probability of answering a command with 'f'")
+    parser.add_argument('--drop-rate', type=float, default=0.0, metavar="P",
+                        help="Probability of not answering a command")
+    parser.add_argument('--nak-at', default='', metavar="N,..",
+                        help="Numbers of the commands to answer with 'f', counting from 1")
+    parser.add_argument('--seed', type=int, help="Seed for the fault injection")
+    return parser
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def main():
+    parser=setup_arg_parser()
+    args = parser.parse_args()
+    model = BootloaderModel(((args.sectors, args.sector_size),), args.base, args.platform_id,
+                            nak_rate=args.nak_rate, drop_rate=args.drop_rate,
+                            nak_at=[int(n) for n in args.nak_at.split(',') if n], seed=args.seed)
+    emulator = BootloaderEmulator(model, args.byte_delay, args.latency)
+    if args.tcp is not None:
+        emulator.listen_tcp(args.tcp)
+    else:
+        emulator.open_pty()
+    print(f"Bootloader emulator on {emulator.path}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    emulator.stop()
+    print(f"{model.commands} commands {dict(model.counts)}, {model.faults} faults injected, {emulator.round_trips} round trips")
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+if __name__ == "__main__":
+    main()
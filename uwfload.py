@@ -2,11 +2,20 @@
 """
 This is a command line tool for downloading firmware to Laird "SmartBASIC" devices.
 
-Usage: python3 uwfload.py serialport baudrate model filepath
+Usage: python3 uwfload.py [options] serialport baudrate model filepath
            port      example on windows would be COM123
            baudrate  e.g. 115200
            model     one of BL652,BL653,BL654,BL654IG,RM1XX,BT900,GENERIC
            filepath  path and name of .uwf file (delimited by "" if space in name)
+       options
+           --pipeline N  send up to N write/data/verify frames before collecting acks
+           --fast [RATES]  sync with the bootloader at the fastest of RATES that works
+           --delta       only erase and write the sectors that differ from the image
+           --resume      checkpoint the download and continue an interrupted one from its last checkpoint
+           --adaptive    tune the block size and verify interval to the module and link
+           --skip-blank  do not erase sectors that are already blank
+           --schedule    stream all erases and writes, erasing a region while the one before it is written
+           --stats FILE  write timings, round trips and retries to FILE as JSON or CSV
 
 Original works by:
   uwf_processer_*.py, uwfloader.py
@@ -31,22 +40,56 @@ DEFAULT_MODULE='BL654'
 # Module imports
 #-----------------------------------------------------------------------------
 import uwfloader
+import uwf_stats
+import uwf_processor
+import argparse
 import os
 import sys
 import serial
 
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def setup_arg_parser():
+    parser = argparse.ArgumentParser(
+        description='Download a .uwf firmware file to a Laird module.')
+    parser.add_argument('serialport', help="is like COM12 on Windows, or /dev/ttyUSB34 on Linux")
+    parser.add_argument('baudrate', type=int, help="is like 115200")
+    parser.add_argument('model', help="is one of BL652,BL653,BL654,BL654IG,RM1XX,BT900,GENERIC")
+    parser.add_argument('filepath', help='Delimit with "" when it contains spaces')
+    parser.add_argument('--pipeline', type=int, default=uwf_processor.PIPELINE_WINDOW, metavar="N",
+                        help=f"Number of write frames sent ahead of their acks, 0 is stop-and-wait, default={uwf_processor.PIPELINE_WINDOW}")
+    parser.add_argument('--delta', action="store_true",
+                        help="Only erase and write the sectors whose contents differ from the image")
+    parser.add_argument('--skip-blank', action="store_true",
+                        help="Skip erasing sectors that a verify shows are already blank")
+    parser.add_argument('--schedule', action="store_true",
+                        help="Send all erases and writes as one pipelined stream, erasing each region while the one before it is written")
+    parser.add_argument('--adaptive', action="store_true",
+                        help="Tune the write block size and blocks per verify as the download runs, remembering the best per module type")
+    parser.add_argument('--resume', action="store_true",
+                        help="Keep a checkpoint journal and continue an interrupted download from its last checkpoint without erasing again")
+    parser.add_argument('--fast', nargs='?', const=','.join(map(str, uwf_processor.BAUD_LADDER)), metavar="RATES",
+                        help=f"Sync with the bootloader at the fastest working rate from a comma separated list, default={','.join(map(str, uwf_processor.BAUD_LADDER))}")
+    parser.add_argument('--stats', metavar="FILE",
+                        help="Write per phase timings, round trip histograms, byte counts and retries to FILE, as CSV if it ends in .csv, else JSON")
+    return parser
+
 #-----------------------------------------------------------------------------
 #-----------------------------------------------------------------------------
 def main():
-    if len(sys.argv) != 5:
-        print(f"Usage: python3 {sys.argv[0]} serialport baudrate model filepath")
-        print('      [serialport] is like COM12 on Windows, or /dev/ttyUSB34 on Linux')
-        print('      [baudrate] is like 115200')
-        print('      [model] is one of BL652,BL653,BL654,BL654IG,RM1XX,BT900,GENERIC')
-        print('      Delimit [filepath] with "" when it contains spaces')
-    else:
-        #download firmware
-        uwfloader.loadfirmware(sys.argv[1],sys.argv[2],sys.argv[4],sys.argv[3])
+    parser=setup_arg_parser()
+    args = parser.parse_args()
+    if args.schedule and args.pipeline <= 1:
+        parser.error("--schedule needs --pipeline 2 or more")
+    #download firmware
+    stats = uwf_stats.UwfStats(args.serialport) if args.stats else None
+    uwfloader.loadfirmware(args.serialport,args.baudrate,args.filepath,args.model,
+                           pipeline_window=args.pipeline,
+                           baud_ladder=uwfloader.parse_baud_ladder(args.fast) if args.fast else None,
+                           delta=args.delta, resume=args.resume, observer=stats,
+                           adaptive=args.adaptive, skip_blank=args.skip_blank, schedule=args.schedule)
+    if stats is not None:
+        stats.dump(args.stats)
         
         
 #-----------------------------------------------------------------------------
@@ -5,96 +5,193 @@
 ##########################################################################################
 import sys
 import errno
+import time
 import serial
-import struct
 import uwf_processor
+from uwf_journal import UwfJournal, JOURNAL_PATH
+from uwf_tuning import UwfTuner, UwfTuning, TUNING_PATH
+from sbidentity import IdentityCache, IDENTITY_PATH
+from uwf_scheduler import UwfScheduler
+from uwf_image import UwfImage
+from uwf_image import UWF_COMMAND_TARGET_PLATFORM, UWF_COMMAND_REGISTER, UWF_COMMAND_SELECT, \
+                      UWF_COMMAND_SECTOR_MAP, UWF_COMMAND_ERASE, UWF_COMMAND_WRITE, UWF_COMMAND_UNREGISTER
 
 VERBOSELEVEL=0
 
 EXIT_CODE_SUCCESS = 0
 
-UWF_READ_SUCCESS = 1
-UWF_READ_DONE = 0
-UWF_COMMAND_HEADER_LENGTH = 6
-UWF_TARGET_PLATFORM_LENGTH = 4
-UWF_REGISTER_DEVICE_LENGTH = 11
-UWF_SELECT_DEVICE_LENGTH = 2
-UWF_SECTOR_MAP_LENGTH = 8
-UWF_ERASE_BLOCK_LENGTH = 8
-UWF_WRITE_BLOCK_LENGTH = 8
-UWF_UNREGISTER_DEVICE_LENGTH = 1
+ERROR_SCHEDULE = 'download: schedule needs a pipeline_window above 1, not {}\n'
 
-UWF_OFFSET_HEADER_COMMAND_ID = 1
-UWF_OFFSET_HEADER_LENGTH_START = 2
-UWF_OFFSET_HEADER_LENGTH_END = 6
+def parse_baud_ladder(text):
+    """
+    Converts a comma separated list of baud rates, e.g. '460800,921600', into a list of ints
+    """
+    return [int(rate) for rate in text.split(',') if rate.strip()]
 
-UWF_COMMAND_TARGET_PLATFORM = 'T'
-UWF_COMMAND_REGISTER = 'G'
-UWF_COMMAND_SELECT = 'S'
-UWF_COMMAND_SECTOR_MAP = 'M'
-UWF_COMMAND_ERASE = 'E'
-UWF_COMMAND_WRITE = 'W'
-UWF_COMMAND_UNREGISTER = 'U'
+def process_commands(processor, image):
+    """
+    Generator for processor.run() that passes each indexed UWF command to the processor in
+    turn, stopping at the first error
+    Returns None on success, otherwise the error string
+    """
+    for command in image:
+        if command.cmd == UWF_COMMAND_TARGET_PLATFORM:
+            error = yield from processor.process_command_target_platform(command)
+        elif command.cmd == UWF_COMMAND_REGISTER:
+            error = processor.process_command_register_device(command)
+        elif command.cmd == UWF_COMMAND_SELECT:
+            error = processor.process_command_select_device(command)
+        elif command.cmd == UWF_COMMAND_SECTOR_MAP:
+            error = processor.process_command_sector_map(command)
+        elif command.cmd == UWF_COMMAND_ERASE:
+            error = yield from processor.process_command_erase_blocks(command)
+        elif command.cmd == UWF_COMMAND_WRITE:
+            error = yield from processor.process_command_write_blocks(command)
+        elif command.cmd == UWF_COMMAND_UNREGISTER:
+            error = processor.process_command_unregister(command)
+        else:
+            # Unknown command; skip to the next section and continue
+            error = None
 
+        if error != None:
+            return error
+    return None
 
-def loadfirmware(port, baudrate, file_path, dev_type=None):
-    exit_code = EXIT_CODE_SUCCESS    # Success (for now)
+def process_scheduled(processor, image):
+    """
+    Generator for processor.run() that passes the commands up to the target platform command
+    to the processor in turn and sends the rest as one stream through a UwfScheduler, carrying
+    on with process_commands from the last verified point if a frame in the stream is not
+    acknowledged
+    Returns None on success, otherwise the error string
+    """
+    scheduler = UwfScheduler(processor, image)
+    error = yield from process_commands(processor, scheduler.preamble())
+    if error == None:
+        error = yield from scheduler.run()
+    if error == None and scheduler.fallback:
+        error = yield from process_commands(processor, scheduler.remaining())
+    return error
+
+def open_image(file_path):
+    """
+    Returns (image, exit_code), mapping and validating the .uwf file at 'file_path' before
+    the device is touched, 'image' is None unless exit_code is EXIT_CODE_SUCCESS
+    A UwfImage passed as 'file_path' is returned as it is
+    """
+    if not isinstance(file_path, str):
+        return (file_path, EXIT_CODE_SUCCESS)
     try:
-        # Open the UWF file
-        f = open(file_path,'rb')
+        return (UwfImage(file_path), EXIT_CODE_SUCCESS)
     except IOError as i:
         # Failed to open the file
         sys.stderr.write('{}\n'.format(i))
-        exit_code = errno.ENOENT
+        return (None, errno.ENOENT)
+    except Exception as e:
+        sys.stderr.write('{}\n'.format(e))
+        return (None, errno.EPERM)
+
+def failed_exit_code(exception):
+    """ Reports an exception that stopped a download and returns its errno style exit code """
+    sys.stderr.write('{}\n'.format(exception))
+    if isinstance(exception, serial.SerialException):
+        return errno.ENETUNREACH
+    return errno.EPERM
+
+def download(processor, image, dev_type=None, pipeline_window=uwf_processor.PIPELINE_WINDOW,
+             baud_ladder=None, progress=None, delta=False, resume=False, journal_path=None,
+             adaptive=False, tuning_path=TUNING_PATH, skip_blank=False, schedule=False,
+             identity_path=IDENTITY_PATH):
+    """
+    Generator for processor.run() that sets the processor up with the options of loadfirmware,
+    enters the bootloader, sends the commands of 'image' and reboots the module
+    Returns None on success, otherwise the error string
+    """
+    if schedule and pipeline_window <= 1:
+        # The erases only overlap the writes through the pipeline, refuse before touching the module
+        processor.ser.close()
+        return ERROR_SCHEDULE.format(pipeline_window)
+    processor.pipeline_window = pipeline_window
+    if baud_ladder:
+        processor.baud_ladder = list(baud_ladder)
+    processor.delta = delta
+    processor.skip_blank = skip_blank
+    processor.image = image
+    if processor.port_name is not None:
+        # Opened even when not resuming so that the download drops the port's out of date checkpoints
+        processor.journal = UwfJournal(journal_path or JOURNAL_PATH)
+        processor.record_checkpoints = resume or journal_path is not None
+    processor.resume = resume
+    if adaptive:
+        tuning = UwfTuning(tuning_path)
+        processor.tuner = UwfTuner(*(tuning.load(dev_type or 'GENERIC') or ()))
+        processor.apply_tuning()
+    if progress is not None:
+        total = image.write_data_length()
+        processor.progress_callback = lambda bytes_written: progress(bytes_written, total)
+
+    start = time.monotonic()
+    yield from processor.enter_bootloader()
+    processor.observe_phase('bootloader', start)
+    if schedule:
+        error = yield from process_scheduled(processor, image)
     else:
-        if f.mode == 'rb':
-            # Initialize the processor
-            try:
-                processor = uwf_processor.init_processor(dev_type, port, baudrate)
-                status = UWF_READ_SUCCESS
-                while (status == UWF_READ_SUCCESS):
-                    # Read the next section (in bytes)
-                    bytes = f.read(UWF_COMMAND_HEADER_LENGTH)
-                    if bytes:
-                        cmd = bytes[:UWF_OFFSET_HEADER_COMMAND_ID].decode('utf-8')
-                        data_length = struct.unpack('<I', bytes[UWF_OFFSET_HEADER_LENGTH_START:UWF_OFFSET_HEADER_LENGTH_END])[0]
+        error = yield from process_commands(processor, image)
+    if error == None:
+        processor.clear_checkpoint()
+    start = time.monotonic()
+    yield from processor.process_reboot()
+    processor.observe_phase('reboot', start)
+    # The module now runs other firmware, so what was cached about it is out of date
+    if identity_path is not None and processor.port_name is not None:
+        IdentityCache(identity_path).invalidate(processor.port_name)
+    if adaptive and processor.tuner.best is not None:
+        tuning.save(dev_type or 'GENERIC', *processor.tuner.best)
+    return error
 
-                        if cmd == UWF_COMMAND_TARGET_PLATFORM and data_length == UWF_TARGET_PLATFORM_LENGTH:
-                            error = processor.process_command_target_platform(f, data_length)
-                        elif cmd == UWF_COMMAND_REGISTER and data_length == UWF_REGISTER_DEVICE_LENGTH:
-                            error = processor.process_command_register_device(f, data_length)
-                        elif cmd == UWF_COMMAND_SELECT and data_length == UWF_SELECT_DEVICE_LENGTH:
-                            error = processor.process_command_select_device(f, data_length)
-                        elif cmd == UWF_COMMAND_SECTOR_MAP:
-                            error = processor.process_command_sector_map(f, data_length)
-                        elif cmd == UWF_COMMAND_ERASE and data_length == UWF_ERASE_BLOCK_LENGTH:
-                            error = processor.process_command_erase_blocks(f, data_length)
-                        elif cmd == UWF_COMMAND_WRITE and data_length >= UWF_WRITE_BLOCK_LENGTH:
-                            error = processor.process_command_write_blocks(f, data_length)
-                        elif cmd == UWF_COMMAND_UNREGISTER and data_length == UWF_UNREGISTER_DEVICE_LENGTH:
-                            error = processor.process_command_unregister(f, data_length)
-                        else:
-                            # Unknown command; read to the next section and continue
-                            f.read(data_length)
-                            status = UWF_READ_SUCCESS
+def loadfirmware(port, baudrate, file_path, dev_type=None, pipeline_window=uwf_processor.PIPELINE_WINDOW,
+                 baud_ladder=None, progress=None, delta=False, resume=False, journal_path=None,
+                 observer=None, adaptive=False, tuning_path=TUNING_PATH, skip_blank=False,
+                 schedule=False, identity_path=IDENTITY_PATH):
+    """
+    Downloads a .uwf file to the device on 'port' and returns an errno style exit code
+    'file_path' can also be a UwfImage shared between several downloads
+    'progress' is called with (bytes_written, bytes_total) as each block of data is acknowledged
+    'delta' skips erasing and writing the sectors whose contents already match the image
+    'resume' continues from the last checkpoint in the journal at 'journal_path', JOURNAL_PATH
+    unless given, without erasing again
+    Checkpoints are only recorded with 'resume' or a 'journal_path', and only for a port with a
+    device name as they are keyed on it, any download to the port drops those of other images
+    'observer' is a uwf_stats.UwfObserver, e.g. a UwfStats, told the time taken by each phase
+    and round trip, the bytes sent and received and any retries
+    'adaptive' tunes the block size and verify interval as the download runs, starting from
+    the best settings remembered for 'dev_type' in the file at 'tuning_path'
+    'skip_blank' verifies that each sector is not already blank before erasing it
+    'schedule' sends the erases and writes as one pipelined stream, erasing each region while
+    the one before it is written, it fails without a pipeline_window above 1
+    The identity cached for the device 'port' names in the file at 'identity_path' is dropped
+    once the module has rebooted, as its version changes, unless 'identity_path' is None
+    """
+    image, exit_code = open_image(file_path)
 
-                        if error != None:
-                            processor.process_reboot()
-                            status = UWF_READ_DONE
-                            sys.stderr.write(error)
-                            exit_code = errno.EPERM
-                    else:
-                        # Reached the end of the file
-                        processor.process_reboot()
-                        status = UWF_READ_DONE
-            except serial.SerialException as s:
-                sys.stderr.write('{}\n'.format(s))
-                exit_code = errno.ENETUNREACH
-            except Exception as e:
-                sys.stderr.write('{}\n'.format(e))
+    if exit_code == EXIT_CODE_SUCCESS:
+        # Initialize the processor
+        processor = None
+        try:
+            processor = uwf_processor.new_processor(dev_type, port, baudrate, observer)
+            error = processor.run(download(processor, image, dev_type, pipeline_window, baud_ladder, progress,
+                                           delta, resume, journal_path, adaptive, tuning_path, skip_blank,
+                                           schedule, identity_path))
+            if error != None:
+                sys.stderr.write(error)
                 exit_code = errno.EPERM
-        # Close the local file
-        f.close()
+        except Exception as e:
+            exit_code = failed_exit_code(e)
 
-    return exit_code
+        if exit_code != EXIT_CODE_SUCCESS and processor is not None:
+            # Keep the last verified point so that the download can be resumed
+            processor.flush_checkpoint()
+        if image is not file_path:
+            image.close()
 
+    return exit_code
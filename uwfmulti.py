@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+This is a command line tool for downloading firmware to many Laird "SmartBASIC" devices at once.
+
+Usage: python3 uwfmulti.py [options] model filepath port [port ...]
+           model     one of BL652,BL653,BL654,BL654IG,RM1XX,BT900,GENERIC
+           filepath  path and name of .uwf file (delimited by "" if space in name)
+           port      serial port or glob, e.g. COM12 or "/dev/ttyUSB*"
+       options
+           -b BAUD       baud rate, default 115200
+           --pipeline N  send up to N write/data/verify frames before collecting acks
+           --fast [RATES]  sync with the bootloader at the fastest of RATES that works
+           --delta       only erase and write the sectors that differ from the image
+           --resume      checkpoint the download and continue an interrupted one from its last checkpoint
+           --adaptive    tune the block size and verify interval to each module and link
+           --skip-blank  do not erase sectors that are already blank
+           --schedule    stream all erases and writes, erasing a region while the one before it is written
+           --json        print the summary as JSON instead of a table
+
+The .uwf file is mapped and indexed once and the same UwfImage is downloaded to every
+port from its own thread. Progress is reported on stderr while the downloads run
+and the exit code is 0 only if every device was flashed successfully.
+"""
+
+#-----------------------------------------------------------------------------
+# constants
+#-----------------------------------------------------------------------------
+
+VERBOSELEVEL=0
+DEFAULT_BAUD=115200
+PROGRESS_INTERVAL_SEC=1.0
+
+#-----------------------------------------------------------------------------
+# Module imports
+#-----------------------------------------------------------------------------
+import uwfloader
+import uwf_processor
+import uwf_image
+import argparse
+import errno
+import glob
+import json
+import sys
+import threading
+import time
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class FlashJob(object):
+    """
+    Download of the UwfImage shared by all the jobs to one port, run on its own thread
+    """
+    def __init__(self, port, baudrate, image, dev_type, pipeline_window, baud_ladder, delta=False, resume=False,
+                 adaptive=False, skip_blank=False, schedule=False):
+        self.port = port
+        self.baudrate = baudrate
+        self.image = image
+        self.dev_type = dev_type
+        self.pipeline_window = pipeline_window
+        self.baud_ladder = baud_ladder
+        self.delta = delta
+        self.resume = resume
+        self.adaptive = adaptive
+        self.skip_blank = skip_blank
+        self.schedule = schedule
+        self.bytes_written = 0
+        self.bytes_total = image.write_data_length()
+        self.exit_code = None
+        self.seconds = 0.0
+        self.thread = threading.Thread(target=self.run, name=str(port), daemon=True)
+
+    def progress(self, bytes_written, bytes_total):
+        self.bytes_written = bytes_written
+
+    def run(self):
+        start = time.monotonic()
+        try:
+            self.exit_code = uwfloader.loadfirmware(self.port, self.baudrate, self.image, self.dev_type,
+                                                    pipeline_window=self.pipeline_window,
+                                                    baud_ladder=self.baud_ladder,
+                                                    progress=self.progress,
+                                                    delta=self.delta,
+                                                    resume=self.resume,
+                                                    adaptive=self.adaptive,
+                                                    skip_blank=self.skip_blank,
+                                                    schedule=self.schedule)
+        except Exception as e:
+            sys.stderr.write(f"{self.port}: {e}\n")
+            self.exit_code = errno.EPERM
+        self.seconds = time.monotonic() - start
+
+    def percent(self):
+        if self.bytes_total == 0:
+            return 100
+        return min(100, 100 * self.bytes_written // self.bytes_total)
+
+    def summary(self):
+        return {
+            'port': str(self.port),
+            'exit_code': self.exit_code,
+            'result': 'OK' if self.exit_code == uwfloader.EXIT_CODE_SUCCESS else errno.errorcode.get(self.exit_code, str(self.exit_code)),
+            'seconds': round(self.seconds, 3),
+            'bytes': self.bytes_written,
+            'bytes_per_sec': round(self.bytes_written / self.seconds) if self.seconds > 0 else 0,
+        }
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def expand_ports(patterns):
+    """ Expands any glob patterns in 'patterns' and returns the sorted, unique list of ports """
+    ports = []
+    for pattern in patterns:
+        matches = glob.glob(pattern) if glob.has_magic(pattern) else [pattern]
+        for port in sorted(matches):
+            if port not in ports:
+                ports.append(port)
+    return ports
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def flash_all(ports, baudrate, image, dev_type, pipeline_window=uwf_processor.PIPELINE_WINDOW,
+              baud_ladder=None, progress_interval=PROGRESS_INTERVAL_SEC, delta=False, resume=False, adaptive=False,
+              skip_blank=False, schedule=False):
+    """
+    Downloads the UwfImage to every port concurrently and returns the list of finished FlashJobs
+    """
+    jobs = [FlashJob(port, baudrate, image, dev_type, pipeline_window, baud_ladder, delta, resume, adaptive, skip_blank,
+                     schedule)
+            for port in ports]
+    for job in jobs:
+        job.thread.start()
+    while any([job.thread.is_alive() for job in jobs]):
+        time.sleep(progress_interval)
+        status = ' '.join([f"{job.port}:{job.percent()}%" for job in jobs])
+        sys.stderr.write(f"{status}\n")
+    for job in jobs:
+        job.thread.join()
+    return jobs
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def print_summary(jobs, as_json=False):
+    results = [job.summary() for job in jobs]
+    if as_json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'port':<20} {'result':<12} {'seconds':>9} {'bytes':>9} {'bytes/s':>9}")
+    for result in results:
+        print(f"{result['port']:<20} {result['result']:<12} {result['seconds']:>9.3f} {result['bytes']:>9} {result['bytes_per_sec']:>9}")
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def setup_arg_parser():
+    parser = argparse.ArgumentParser(
+        description='Download a .uwf firmware file to several Laird modules concurrently.')
+    parser.add_argument('model', help="is one of BL652,BL653,BL654,BL654IG,RM1XX,BT900,GENERIC")
+    parser.add_argument('filepath', help='Delimit with "" when it contains spaces')
+    parser.add_argument('ports', nargs='+', help='Serial ports or globs like "/dev/ttyUSB*"')
+    parser.add_argument('-b', '--baud', type=int, default=DEFAULT_BAUD, help=f"Baud rate, default={DEFAULT_BAUD}")
+    parser.add_argument('--pipeline', type=int, default=uwf_processor.PIPELINE_WINDOW, metavar="N",
+                        help=f"Number of write frames sent ahead of their acks, 0 is stop-and-wait, default={uwf_processor.PIPELINE_WINDOW}")
+    parser.add_argument('--skip-blank', action="store_true",
+                        help="Skip erasing sectors that a verify shows are already blank")
+    parser.add_argument('--schedule', action="store_true",
+                        help="Send all erases and writes as one pipelined stream, erasing each region while the one before it is written")
+    parser.add_argument('--adaptive', action="store_true",
+                        help="Tune the write block size and blocks per verify as the download runs, remembering the best per module type")
+    parser.add_argument('--resume', action="store_true",
+                        help="Keep a checkpoint journal and continue an interrupted download from its last checkpoint without erasing again")
+    parser.add_argument('--fast', nargs='?', const=','.join(map(str, uwf_processor.BAUD_LADDER)), metavar="RATES",
+                        help=f"Sync with the bootloader at the fastest working rate from a comma separated list, default={','.join(map(str, uwf_processor.BAUD_LADDER))}")
+    parser.add_argument('--delta', action="store_true",
+                        help="Only erase and write the sectors whose contents differ from the image")
+    parser.add_argument('--json', action="store_true", help="Print the summary as JSON")
+    return parser
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def main():
+    parser=setup_arg_parser()
+    args = parser.parse_args()
+    if args.schedule and args.pipeline <= 1:
+        parser.error("--schedule needs --pipeline 2 or more")
+    # Per block progress from every thread would interleave on stdout
+    uwf_processor.VERBOSELEVEL=VERBOSELEVEL
+
+    ports = expand_ports(args.ports)
+    if len(ports) == 0:
+        print("No serial ports match")
+        return 2
+
+    try:
+        image = uwf_image.UwfImage(args.filepath)
+    except Exception as e:
+        print(e)
+        return 2
+
+    with image:
+        jobs = flash_all(ports, args.baud, image, args.model, args.pipeline,
+                         uwfloader.parse_baud_ladder(args.fast) if args.fast else None,
+                         delta=args.delta, resume=args.resume,
+                         adaptive=args.adaptive, skip_blank=args.skip_blank, schedule=args.schedule)
+    print_summary(jobs, args.json)
+    return 0 if all([job.exit_code == uwfloader.EXIT_CODE_SUCCESS for job in jobs]) else 1
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+if __name__ == "__main__":
+    sys.exit(main())